@@ -1,451 +1,3992 @@
+import argparse
 import ast
-import difflib
+import bisect
+import contextlib
+import copy
+import functools
+import gc
+import hashlib
+import importlib.util
+import io
+import json
+import marshal
+import os
+import re
 import sys
-from itertools import zip_longest
+import threading
+import time
+import tokenize
+import tracemalloc
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice, zip_longest
 
 py39 = sys.version_info.minor >= 9
 py310 = sys.version_info.minor >= 10
 py311 = sys.version_info.minor >= 11
 py312 = sys.version_info.minor >= 12
+py313 = sys.version_info.minor >= 13
+
+# list fields whose order --unordered ignores unless told otherwise;
+# __all__ and other list literals need "List.elts" and "Tuple.elts"
+UNORDERED_FIELDS = (
+    "Import.names",
+    "ImportFrom.names",
+    "Set.elts",
+    "Dict.keys",
+    "ClassDef.decorator_list",
+)
+
+# smallest number of top-level statements worth shipping to a worker
+PARALLEL_MIN_CHUNK = 256
+
+# bytes of source parsed at once when streaming, more when a single
+# top-level statement is longer
+STREAM_CHUNK_SIZE = 1 << 20
+
+# bump when the comparison changes so stale on-disk results are not reused
+CACHE_VERSION = 2
+# sources at least this long get their fingerprint cached by ast_equal
+# once they are seen a second time, shorter ones are cheaper to parse again
+FINGERPRINT_MIN_SIZE = 2048
+FINGERPRINT_CACHE_SIZE = 4096
+
+# smallest subtree, in nodes, reported as moved
+MOVE_MIN_SIZE = 10
+# MinHash sketches of files pair removed files with added ones when at
+# least this share of their subtrees agree; the LSH_BANDS bands of
+# MINHASH_SIZE / LSH_BANDS values each find candidates around that share
+RENAME_THRESHOLD = 0.5
+MINHASH_SIZE = 64
+LSH_BANDS = 16
+# edit distance up to which the line differ looks for the shortest edit
+# of a region before giving up and replacing it as a whole
+DIFF_MAX_COST = 1024
+# characters of dump a Budget lets a comparison render by default, the
+# indentation of deeply nested trees grows quadratically with the depth
+RENDER_MAX_CHARS = 1 << 26
+# items of a list of differing values written to a jsonl record
+JSON_MAX_ITEMS = 32
 
 
 class DiffFound(Exception):
+    # kept for compatibility, the comparator no longer raises it
     pass
 
 
-def _gen_diff(node_name, node1, node2):
-    if len(node1.generators) != len(node2.generators):
-        raise DiffFound("length of ast.%s.generators differ" % node_name)
-    for gen1, gen2 in zip(node1.generators, node2.generators):
-        if len(gen1.ifs) != len(gen2.ifs):
-            raise DiffFound("length of ast.comprehension.ifs differ")
+class Difference:
+    """A difference between two nodes.
 
+    kind is one of "type", "length", "value", "binding" and "field".
+    old and new hold the differing values (type names, lengths, field
+    values) and pos1, pos2 the (lineno, col_offset) of the nodes.  The
+    message is only formatted when it is asked for.
 
-def _for_diff(node_name, node1, node2):
-    if len(node1.body) != len(node2.body):
-        raise DiffFound("length of ast.%s.body differ" % node_name)
-    elif len(node1.orelse) != len(node2.orelse):
-        raise DiffFound("length of ast.%s.orelse differ" % node_name)
+    Ignoring the names of locals, names that do not refer to the same
+    binding on both sides, such as swapped locals, are reported as
+    "binding" with the names as spelled in old and new.
 
+    A comparison stopped by its Budget ends with an "inconclusive"
+    record, with the reason in old, the number of nodes compared in new
+    and the positions of the nodes it stopped at.
 
-def _funcdef_diff(node_name, node1, node2):
-    if len(node1.decorator_list) != len(node2.decorator_list):
-        raise DiffFound("length of ast.%s.decorator_list differ" % node_name)
-    if node1.name != node2.name:
-        raise DiffFound(
-            "ast.%s.name differ %s %s" % (node_name, node1.name, node2.name)
+    end1 and end2 hold the (end_lineno, end_col_offset) of the nodes
+    where the walk sets pos1 and pos2.
+
+    Comparing a field regardless of order, elements of one side without
+    a counterpart when both sides have a different number of them are
+    reported one by one as "unmatched", with the type of the element in
+    old or new and its position in pos1 or pos2.
+    """
+
+    __slots__ = (
+        "kind",
+        "node_type",
+        "field",
+        "old",
+        "new",
+        "pos1",
+        "pos2",
+        "end1",
+        "end2",
+    )
+
+    def __init__(self, kind, node_type, field=None, old=None, new=None):
+        self.kind = kind
+        self.node_type = node_type
+        self.field = field
+        self.old = old
+        self.new = new
+        self.pos1 = None
+        self.pos2 = None
+        self.end1 = None
+        self.end2 = None
+
+    @property
+    def message(self):
+        kind = self.kind
+        if kind == "type":
+            if self.field is None:
+                return "different type %s %s" % (self.old, self.new)
+            return "type of ast.%s.%s differ %s %s" % (
+                self.node_type,
+                self.field,
+                self.old,
+                self.new,
+            )
+        if kind == "length":
+            return "length of ast.%s.%s differ" % (self.node_type, self.field)
+        if kind == "value":
+            return "ast.%s.%s differ %s %s" % (
+                self.node_type,
+                self.field,
+                self.old,
+                self.new,
+            )
+        if kind == "binding":
+            return "ast.%s.%s refer to different bindings %s %s" % (
+                self.node_type,
+                self.field,
+                self.old,
+                self.new,
+            )
+        if kind == "inconclusive":
+            return "inconclusive: %s after %d nodes" % (self.old, self.new)
+        if kind == "unmatched":
+            return "unmatched element of ast.%s.%s %s %s" % (
+                self.node_type,
+                self.field,
+                self.old,
+                self.new,
+            )
+        return "ast.%s.%s differ" % (self.node_type, self.field)
+
+    @property
+    def label(self):
+        # message without the differing values, to group differences by
+        kind = self.kind
+        if kind == "type" and self.field is None:
+            return "different type %s %s" % (self.old, self.new)
+        if kind == "type":
+            return "type of ast.%s.%s" % (self.node_type, self.field)
+        if kind == "length":
+            return "length of ast.%s.%s" % (self.node_type, self.field)
+        if kind == "binding":
+            return "binding of ast.%s.%s" % (self.node_type, self.field)
+        if kind == "inconclusive":
+            return "inconclusive"
+        if kind == "unmatched":
+            return "unmatched element of ast.%s.%s" % (self.node_type, self.field)
+        return "ast.%s.%s" % (self.node_type, self.field)
+
+    def as_tuple(self):
+        if self.kind == "inconclusive":
+            return Inconclusive(self.pos1, self.pos2, self.old, self.new)
+        return self.pos1, self.pos2, self.message
+
+    def locate(self, index1, index2):
+        """Return the result of as_tuple() as Located, with character
+        columns and excerpts from the LineIndex of either source.
+
+        An index may be None for a side without source text.
+        """
+        located = Located(self.pos1, self.pos2, self.message)
+        located.end1 = self.end1
+        located.end2 = self.end2
+        for side, index, pos, end in [
+            ("1", index1, self.pos1, self.end1),
+            ("2", index2, self.pos2, self.end2),
+        ]:
+            if index is not None:
+                setattr(located, "column" + side, index.column(pos))
+                setattr(located, "end_column" + side, index.column(end))
+                setattr(located, "excerpt" + side, index.excerpt(pos, end))
+        return located
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return "<Difference %s %s %s>" % (self.pos1, self.pos2, self.message)
+
+
+class Located(tuple):
+    """A (pos1, pos2, message) result carrying the extent and source of
+    both nodes.
+
+    end1 and end2 are the (end_lineno, end_col_offset) of the nodes,
+    column1, end_column1, column2 and end_column2 the offsets of pos1,
+    end1, pos2 and end2 in characters rather than UTF-8 bytes and
+    excerpt1 and excerpt2 the source text of the nodes.  Each is None
+    where it is not known.
+    """
+
+    end1 = end2 = None
+    column1 = end_column1 = column2 = end_column2 = None
+    excerpt1 = excerpt2 = None
+
+    def __new__(cls, pos1, pos2, message):
+        return tuple.__new__(cls, (pos1, pos2, message))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+
+class LineIndex:
+    """Offsets of the lines of a source, built once per file.
+
+    Nodes give their col_offset in UTF-8 bytes.  column() turns one into
+    a character column and excerpt() cuts the source between two
+    positions, both without splitting the source again, so locating any
+    number of differences in a file stays linear in its size.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, bytes):
+            # honours coding cookies and translates newlines as the
+            # parser does
+            source = importlib.util.decode_source(source)
+        else:
+            source = source.replace("\r\n", "\n").replace("\r", "\n")
+        self.data = data = source.encode("utf-8")
+        self.starts = starts = [0]
+        start = data.find(b"\n")
+        while start != -1:
+            starts.append(start + 1)
+            start = data.find(b"\n", start + 1)
+
+    @classmethod
+    def from_file(cls, fname):
+        return cls(_read_source(fname))
+
+    def offset(self, pos):
+        lineno, col_offset = pos
+        return self.starts[lineno - 1] + col_offset
+
+    def line(self, lineno):
+        start = self.starts[lineno - 1]
+        end = self.data.find(b"\n", start)
+        return self.data[start : None if end == -1 else end].decode("utf-8")
+
+    def column(self, pos):
+        if pos is None:
+            return None
+        start = self.starts[pos[0] - 1]
+        return len(self.data[start : start + pos[1]].decode("utf-8", "replace"))
+
+    def excerpt(self, pos, end):
+        if pos is None or end is None:
+            return None
+        return self.data[self.offset(pos) : self.offset(end)].decode("utf-8", "replace")
+
+
+class Inconclusive(tuple):
+    """The (pos1, pos2, message) result of a comparison stopped by its
+    Budget before finding a difference.
+
+    pos1 and pos2 are where it stopped, reason tells which limit was hit
+    and nodes how many pairs of nodes were compared.  Being a result
+    other than None, it is never mistaken for equal trees.
+    """
+
+    def __new__(cls, pos1, pos2, reason, nodes):
+        self = tuple.__new__(
+            cls, (pos1, pos2, "inconclusive: %s after %d nodes" % (reason, nodes))
         )
-    if len(node1.body) != len(node2.body):
-        raise DiffFound("length of ast.%s.body differ" % node_name)
-    if (node1.returns is None) != (node2.returns is None):
-        raise DiffFound("ast.%s.returns differ" % node_name)
-    args1 = node1.args
-    args2 = node2.args
-    if len(args1.args) != len(args2.args):
-        raise DiffFound("length of ast.%s.args.args differ" % node_name)
-    if len(args1.defaults) != len(args2.defaults):
-        raise DiffFound("length of ast.%s.args.defaults differ" % node_name)
-    if len(args1.posonlyargs) != len(args2.posonlyargs):
-        raise DiffFound("length of ast.%s.args.posonlyargs differ" % node_name)
+        self.reason = reason
+        self.nodes = nodes
+        return self
+
+    def __getnewargs__(self):
+        return self[0], self[1], self.reason, self.nodes
+
+
+class _BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    """Limits on the work spent on one comparison.
+
+    max_nodes caps the number of node pairs compared and timeout, in
+    seconds from now, the wall time.  One budget can be shared by the
+    phases of a comparison, the time spent parsing and rendering counts
+    against the deadline as well.  max_render caps the characters of
+    each dump rendered.
+    """
+
+    def __init__(self, max_nodes=None, timeout=None, max_render=RENDER_MAX_CHARS):
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+        self.max_render = max_render
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.nodes = 0
+
+    def check(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise _BudgetExceeded("timeout of %gs exceeded" % self.timeout)
+
+    def charge(self):
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            self.nodes -= 1
+            raise _BudgetExceeded("node budget of %d exhausted" % self.max_nodes)
+        self.check()
+
+
+def _length(node_name, field, list1, list2):
+    if len(list1) != len(list2):
+        return Difference("length", node_name, field, len(list1), len(list2))
+    return None
+
+
+def _presence(node_name, field, value1, value2):
+    if (value1 is None) != (value2 is None):
+        return Difference("field", node_name, field, value1, value2)
+    return None
+
+
+def _gen_diff(node_name, node1, node2):
+    diff = _length(node_name, "generators", node1.generators, node2.generators)
+    if diff is not None:
+        return diff
+    for gen1, gen2 in zip(node1.generators, node2.generators):
+        diff = _length("comprehension", "ifs", gen1.ifs, gen2.ifs)
+        if diff is not None:
+            return diff
+    return None
+
+
+def _arguments_diff(node_name, args1, args2, positional_names=True):
+    diff = (
+        _length(node_name, "args.args", args1.args, args2.args)
+        or _length(node_name, "args.defaults", args1.defaults, args2.defaults)
+        or _length(node_name, "args.posonlyargs", args1.posonlyargs, args2.posonlyargs)
+    )
+    if diff is not None:
+        return diff
     for i, (poa1, poa2) in enumerate(zip(args1.posonlyargs, args2.posonlyargs)):
-        if poa1.arg != poa2.arg:
-            raise DiffFound(
-                "ast.%s.args.posonlyargs[%d].arg differ %s %s"
-                % (node_name, i, poa1.arg, poa2.arg)
+        if positional_names and poa1.arg != poa2.arg:
+            return Difference(
+                "value", node_name, "args.posonlyargs[%d].arg" % i, poa1.arg, poa2.arg
             )
-    if len(args1.kwonlyargs) != len(args2.kwonlyargs):
-        raise DiffFound("length of ast.%s.args.kwonlyargs differ" % node_name)
+    diff = _length(node_name, "args.kwonlyargs", args1.kwonlyargs, args2.kwonlyargs)
+    if diff is not None:
+        return diff
     for i, (koa1, koa2) in enumerate(zip(args1.kwonlyargs, args2.kwonlyargs)):
         if koa1.arg != koa2.arg:
-            raise DiffFound(
-                "ast.%s.args.kwonlyargs[%d].arg differ %s %s"
-                % (node_name, i, koa1.arg, koa2.arg)
+            return Difference(
+                "value", node_name, "args.kwonlyargs[%d].arg" % i, koa1.arg, koa2.arg
             )
     for kd1, kd2 in zip(args1.kw_defaults, args2.kw_defaults):
-        if (kd1 is None) != (kd2 is None):
-            raise DiffFound("ast.%s.args.kw_defaults differ" % node_name)
-    if (args1.vararg is None) != (args2.vararg is None):
-        raise DiffFound("ast.%s.args.vararg differ" % node_name)
-    if (args1.kwarg is None) != (args2.kwarg is None):
-        raise DiffFound("ast.%s.args.kwarg differ" % node_name)
+        diff = _presence(node_name, "args.kw_defaults", kd1, kd2)
+        if diff is not None:
+            return diff
+    return _presence(node_name, "args.vararg", args1.vararg, args2.vararg) or _presence(
+        node_name, "args.kwarg", args1.kwarg, args2.kwarg
+    )
+
+
+def _lambda_diff(node_name, node1, node2, positional_names=True):
+    return _arguments_diff(node_name, node1.args, node2.args, positional_names)
+
+
+def _funcdef_diff(node_name, node1, node2, positional_names=True):
+    diff = _length(
+        node_name, "decorator_list", node1.decorator_list, node2.decorator_list
+    )
+    if diff is not None:
+        return diff
+    if node1.name != node2.name:
+        return Difference("value", node_name, "name", node1.name, node2.name)
+    return (
+        _length(node_name, "body", node1.body, node2.body)
+        or _presence(node_name, "returns", node1.returns, node2.returns)
+        or _arguments_diff(node_name, node1.args, node2.args, positional_names)
+    )
+
+
+def _local_funcdef_diff(node_name, node1, node2):
+    return _funcdef_diff(node_name, node1, node2, positional_names=False)
+
+
+def _local_lambda_diff(node_name, node1, node2):
+    return _lambda_diff(node_name, node1, node2, positional_names=False)
+
+
+def _classdef_diff(node_name, node1, node2):
+    diff = _length(
+        node_name, "decorator_list", node1.decorator_list, node2.decorator_list
+    )
+    if diff is not None:
+        return diff
+    if node1.name != node2.name:
+        return Difference("value", node_name, "name", node1.name, node2.name)
+    return _length(node_name, "bases", node1.bases, node2.bases) or _length(
+        node_name, "body", node1.body, node2.body
+    )
 
 
 def _with_diff(node_name, node1, node2):
-    if len(node1.items) != len(node2.items):
-        raise DiffFound("length of ast.%s.items differ" % node_name)
+    diff = _length(node_name, "items", node1.items, node2.items)
+    if diff is not None:
+        return diff
     for i, (item1, item2) in enumerate(zip(node1.items, node2.items)):
-        if (item1.optional_vars is None) != (item2.optional_vars is None):
-            raise DiffFound("ast.%s.items[%d].optional_vars differ" % (node_name, i))
-    if len(node1.body) != len(node2.body):
-        raise DiffFound("length of ast.%s.body differ" % node_name)
+        diff = _presence(
+            node_name,
+            "items[%d].optional_vars" % i,
+            item1.optional_vars,
+            item2.optional_vars,
+        )
+        if diff is not None:
+            return diff
+    return _length(node_name, "body", node1.body, node2.body)
+
+
+def _call_diff(node_name, node1, node2):
+    diff = _length(node_name, "args", node1.args, node2.args) or _length(
+        node_name, "keywords", node1.keywords, node2.keywords
+    )
+    if diff is not None:
+        return diff
+    if any(k1.arg != k2.arg for k1, k2 in zip(node1.keywords, node2.keywords)):
+        return Difference(
+            "field", node_name, "keywords", node1.keywords, node2.keywords
+        )
+    return None
+
+
+def _compare_diff(node_name, node1, node2):
+    diff = _length(node_name, "comparators", node1.comparators, node2.comparators)
+    if diff is not None:
+        return diff
+    if list(map(type, node1.ops)) != list(map(type, node2.ops)):
+        return Difference("field", node_name, "ops", node1.ops, node2.ops)
+    return None
+
+
+def _subscript_diff(node_name, node1, node2):
+    slice1 = node1.slice
+    slice2 = node2.slice
+    if type(slice1) is not type(slice2):
+        return Difference(
+            "type", node_name, "slice", type(slice1).__name__, type(slice2).__name__
+        )
+    if isinstance(slice1, ast.Slice):
+        return (
+            _presence(node_name, "slice.lower", slice1.lower, slice2.lower)
+            or _presence(node_name, "slice.upper", slice1.upper, slice2.upper)
+            or _presence(node_name, "slice.step", slice1.step, slice2.step)
+        )
+    return None
+
+
+def _import_diff(node_name, node1, node2):
+    if node_name == "ImportFrom" and node1.module != node2.module:
+        return Difference("value", node_name, "module", node1.module, node2.module)
+    diff = _length(node_name, "names", node1.names, node2.names)
+    if diff is not None:
+        return diff
+    for name1, name2 in zip(node1.names, node2.names):
+        if name1.name != name2.name:
+            return Difference("value", "alias", "name", name1.name, name2.name)
+        if name1.asname != name2.asname:
+            return Difference("value", "alias", "asname", name1.asname, name2.asname)
+    return None
+
+
+def _dynamic_diff(node_name, field, value1, value2):
+    # for fields whose type is not known from the class signature
+    if isinstance(value1, list) and isinstance(value2, list):
+        diff = _length(node_name, field, value1, value2)
+        if diff is None and [v is None for v in value1] != [v is None for v in value2]:
+            diff = Difference("field", node_name, field, value1, value2)
+        return diff
+    if isinstance(value1, ast.AST) or isinstance(value2, ast.AST):
+        return _presence(node_name, field, value1, value2)
+    if value1 != value2:
+        return Difference("value", node_name, field, value1, value2)
+    return None
+
 
+# Checks the generated comparators cannot express, mostly because they
+# report on grandchildren at the position of the parent, together with
+# the fields they cover.  They run before the generated field checks.
+_SPECIAL_DIFFS = {
+    "FunctionDef": (
+        _funcdef_diff,
+        ("name", "args", "body", "decorator_list", "returns"),
+    ),
+    "AsyncFunctionDef": (
+        _funcdef_diff,
+        ("name", "args", "body", "decorator_list", "returns"),
+    ),
+    "ClassDef": (_classdef_diff, ("name", "bases", "body", "decorator_list")),
+    "Lambda": (_lambda_diff, ("args",)),
+    "With": (_with_diff, ("items", "body")),
+    "AsyncWith": (_with_diff, ("items", "body")),
+    "Call": (_call_diff, ("args", "keywords")),
+    "Compare": (_compare_diff, ("ops", "comparators")),
+    "Subscript": (_subscript_diff, ("slice",)),
+    "Import": (_import_diff, ("names",)),
+    "ImportFrom": (_import_diff, ("module", "names")),
+    "ListComp": (_gen_diff, ("generators",)),
+    "GeneratorExp": (_gen_diff, ("generators",)),
+    "SetComp": (_gen_diff, ("generators",)),
+    "DictComp": (_gen_diff, ("generators",)),
+}
 
-def _try_diff(node_name, node1, node2):
-    if len(node1.body) != len(node2.body):
-        raise DiffFound("length of ast.%s.body differ" % node_name)
-    if len(node1.handlers) != len(node2.handlers):
-        raise DiffFound("length of ast.%s.handlers differ" % node_name)
-    if len(node1.orelse) != len(node2.orelse):
-        raise DiffFound("length of ast.%s.orelse differ" % node_name)
-    if len(node1.finalbody) != len(node2.finalbody):
-        raise DiffFound("length of ast.%s.finalbody differ" % node_name)
+# with ignore_local_names, the argument names are compared through the
+# canonical names of the arg nodes instead
+_LOCAL_SPECIAL_DIFFS = dict(
+    _SPECIAL_DIFFS,
+    FunctionDef=(_local_funcdef_diff, _SPECIAL_DIFFS["FunctionDef"][1]),
+    AsyncFunctionDef=(_local_funcdef_diff, _SPECIAL_DIFFS["AsyncFunctionDef"][1]),
+    Lambda=(_local_lambda_diff, _SPECIAL_DIFFS["Lambda"][1]),
+)
 
+# names that may be local bindings, left to the walk with ignore_local_names
+_LOCAL_NAME_FIELDS = {
+    "Name": "id",
+    "arg": "arg",
+    "ExceptHandler": "name",
+    "MatchAs": "name",
+    "MatchStar": "name",
+    "MatchMapping": "rest",
+}
 
-def ast_diff(tree1, tree2):
-    for node1, node2 in zip_longest(ast.walk(tree1), ast.walk(tree2)):
+# Fields not compared by the generated checks: diff of len(ast.Module.body)
+# is reported as a type difference with None by the walk, since 'Module'
+# object has no attribute 'lineno', the others are already reported at
+# the position of the parent by _SPECIAL_DIFFS.
+_UNCHECKED_FIELDS = {
+    ("Module", "body"),
+    ("alias", "name"),
+    ("alias", "asname"),
+    ("arguments", "posonlyargs"),
+    ("arguments", "args"),
+    ("arguments", "vararg"),
+    ("arguments", "kwonlyargs"),
+    ("arguments", "kw_defaults"),
+    ("arguments", "kwarg"),
+    ("arguments", "defaults"),
+    ("withitem", "optional_vars"),
+    ("comprehension", "ifs"),
+}
+
+# Fields telling how the source was spelled rather than what it does:
+# the u prefix of strings, dropped by formatters, and type comments.
+# Neither compared nor kept by flatten.
+_SPELLING_FIELDS = {("Constant", "kind")} | {
+    (name, "type_comment")
+    for name in [
+        "FunctionDef",
+        "AsyncFunctionDef",
+        "Assign",
+        "For",
+        "AsyncFor",
+        "With",
+        "AsyncWith",
+        "arg",
+    ]
+}
+
+# scalar fields reported without their values
+_VALUELESS_FIELDS = {
+    ("FormattedValue", "conversion"),
+    ("ExceptHandler", "name"),
+    ("MatchAs", "name"),
+    ("MatchStar", "name"),
+    ("MatchSingleton", "value"),
+}
+
+# lists of child nodes that may hold None
+_NULLABLE_ITEMS = {("Dict", "keys")}
+
+_SCALAR_TYPES = {"identifier", "string", "constant", "int", "object", "bytes"}
+
+_SCALAR = """\
+    if node1.{f} != node2.{f}:
+        return Difference("{kind}", "{cls}", "{f}", node1.{f}, node2.{f})
+"""
+_OPTIONAL = """\
+    if (node1.{f} is None) != (node2.{f} is None):
+        return Difference("field", "{cls}", "{f}", node1.{f}, node2.{f})
+"""
+_SINGLETON = """\
+    if type(node1.{f}) is not type(node2.{f}):
+        return Difference(
+            "value", "{cls}", "{f}", type(node1.{f}).__name__, type(node2.{f}).__name__
+        )
+"""
+_LIST = """\
+    if len(node1.{f}) != len(node2.{f}):
+        return Difference("length", "{cls}", "{f}", len(node1.{f}), len(node2.{f}))
+"""
+_SINGLETON_LIST = """\
+    if list(map(type, node1.{f})) != list(map(type, node2.{f})):
+        return Difference("field", "{cls}", "{f}", node1.{f}, node2.{f})
+"""
+_NULLABLE_LIST = """\
+    if [v is None for v in node1.{f}] != [v is None for v in node2.{f}]:
+        return Difference("field", "{cls}", "{f}", node1.{f}, node2.{f})
+"""
+_DYNAMIC = """\
+    diff = _dynamic_diff("{cls}", "{f}", node1.{f}, node2.{f})
+    if diff is not None:
+        return diff
+"""
+
+
+# The node classes of Python 3.8 have no docstrings, their ASDL
+# signatures are spelled out here instead.
+_SIGNATURES = {
+    "Module": "stmt* body, type_ignore* type_ignores",
+    "Interactive": "stmt* body",
+    "Expression": "expr body",
+    "FunctionType": "expr* argtypes, expr returns",
+    "FunctionDef": "identifier name, arguments args, stmt* body, "
+    "expr* decorator_list, expr? returns, string? type_comment",
+    "AsyncFunctionDef": "identifier name, arguments args, stmt* body, "
+    "expr* decorator_list, expr? returns, string? type_comment",
+    "ClassDef": "identifier name, expr* bases, keyword* keywords, stmt* body, "
+    "expr* decorator_list",
+    "Return": "expr? value",
+    "Delete": "expr* targets",
+    "Assign": "expr* targets, expr value, string? type_comment",
+    "AugAssign": "expr target, operator op, expr value",
+    "AnnAssign": "expr target, expr annotation, expr? value, int simple",
+    "For": "expr target, expr iter, stmt* body, stmt* orelse, string? type_comment",
+    "AsyncFor": "expr target, expr iter, stmt* body, stmt* orelse, "
+    "string? type_comment",
+    "While": "expr test, stmt* body, stmt* orelse",
+    "If": "expr test, stmt* body, stmt* orelse",
+    "With": "withitem* items, stmt* body, string? type_comment",
+    "AsyncWith": "withitem* items, stmt* body, string? type_comment",
+    "Raise": "expr? exc, expr? cause",
+    "Try": "stmt* body, excepthandler* handlers, stmt* orelse, stmt* finalbody",
+    "Assert": "expr test, expr? msg",
+    "Import": "alias* names",
+    "ImportFrom": "identifier? module, alias* names, int? level",
+    "Global": "identifier* names",
+    "Nonlocal": "identifier* names",
+    "Expr": "expr value",
+    "BoolOp": "boolop op, expr* values",
+    "NamedExpr": "expr target, expr value",
+    "BinOp": "expr left, operator op, expr right",
+    "UnaryOp": "unaryop op, expr operand",
+    "Lambda": "arguments args, expr body",
+    "IfExp": "expr test, expr body, expr orelse",
+    "Dict": "expr* keys, expr* values",
+    "Set": "expr* elts",
+    "ListComp": "expr elt, comprehension* generators",
+    "SetComp": "expr elt, comprehension* generators",
+    "DictComp": "expr key, expr value, comprehension* generators",
+    "GeneratorExp": "expr elt, comprehension* generators",
+    "Await": "expr value",
+    "Yield": "expr? value",
+    "YieldFrom": "expr value",
+    "Compare": "expr left, cmpop* ops, expr* comparators",
+    "Call": "expr func, expr* args, keyword* keywords",
+    "FormattedValue": "expr value, int? conversion, expr? format_spec",
+    "JoinedStr": "expr* values",
+    "Constant": "constant value, string? kind",
+    "Attribute": "expr value, identifier attr, expr_context ctx",
+    "Subscript": "expr value, slice slice, expr_context ctx",
+    "Starred": "expr value, expr_context ctx",
+    "Name": "identifier id, expr_context ctx",
+    "List": "expr* elts, expr_context ctx",
+    "Tuple": "expr* elts, expr_context ctx",
+    "Slice": "expr? lower, expr? upper, expr? step",
+    "ExtSlice": "slice* dims",
+    "Index": "expr value",
+    "comprehension": "expr target, expr iter, expr* ifs, int is_async",
+    "ExceptHandler": "expr? type, identifier? name, stmt* body",
+    "arguments": "arg* posonlyargs, arg* args, arg? vararg, arg* kwonlyargs, "
+    "expr* kw_defaults, arg? kwarg, expr* defaults",
+    "arg": "identifier arg, expr? annotation, string? type_comment",
+    "keyword": "identifier? arg, expr value",
+    "alias": "identifier name, identifier? asname",
+    "withitem": "expr context_expr, expr? optional_vars",
+    "TypeIgnore": "int lineno, string tag",
+}
+
+
+def _field_types(cls):
+    # the docstrings of the node classes hold their ASDL signature, like
+    # "FunctionDef(identifier name, arguments args, stmt* body, ...)"
+    match = re.match(r"(\w+)\((.*)\)$", (cls.__doc__ or "").split("\n")[0].strip())
+    if match is not None and match.group(1) == cls.__name__:
+        declarations = match.group(2)
+    elif vars(ast).get(cls.__name__) is cls and cls.__name__ in _SIGNATURES:
+        # vars() since getattr() warns for deprecated classes like ast.Num
+        declarations = _SIGNATURES[cls.__name__]
+    else:
+        return {}
+    types = {}
+    for declaration in declarations.split(","):
+        type_name, _, field = declaration.strip().rpartition(" ")
+        types[field] = type_name
+    return types
+
+
+def _is_singleton_type(type_name):
+    # operators and expression contexts only come in fieldless flavors
+    base = getattr(ast, type_name, None)
+    if not (isinstance(base, type) and issubclass(base, ast.AST)):
+        return False
+    subclasses = base.__subclasses__()
+    return bool(subclasses) and not any(c._fields for c in subclasses)
+
+
+def _comparator_source(cls, ignore_local_names=False, ignore_fields=frozenset()):
+    name = cls.__name__
+    lines = ["def _diff_%s(node1, node2):\n" % name]
+    specials = _LOCAL_SPECIAL_DIFFS if ignore_local_names else _SPECIAL_DIFFS
+    covered = ()
+    if name in specials:
+        func, covered = specials[name]
+        lines.append(
+            "    diff = %s(%r, node1, node2)\n"
+            "    if diff is not None:\n"
+            "        return diff\n" % (func.__name__, name)
+        )
+    types = _field_types(cls)
+    for field in cls._fields:
+        if field in covered or (name, field) in _UNCHECKED_FIELDS:
+            continue
+        if (name, field) in _SPELLING_FIELDS:
+            continue
+        if ignore_local_names and _LOCAL_NAME_FIELDS.get(name) == field:
+            continue
+        if (name, field) in ignore_fields:
+            continue
+        type_name = types.get(field)
+        if type_name is None:
+            template = _DYNAMIC
+        elif type_name.endswith("*"):
+            item_type = type_name[:-1]
+            if item_type in _SCALAR_TYPES:
+                template = _SCALAR.replace('"{kind}"', '"field"')
+            elif _is_singleton_type(item_type):
+                template = _LIST + _SINGLETON_LIST
+            elif (name, field) in _NULLABLE_ITEMS:
+                template = _LIST + _NULLABLE_LIST
+            else:
+                template = _LIST
+        elif type_name.rstrip("?") in _SCALAR_TYPES:
+            template = _SCALAR
+        elif type_name.endswith("?"):
+            template = _OPTIONAL
+        elif _is_singleton_type(type_name):
+            template = _SINGLETON
+        else:
+            # a required child, compared when the walk gets to it
+            continue
+        kind = "field" if (name, field) in _VALUELESS_FIELDS else "value"
+        lines.append(template.format(f=field, cls=name, kind=kind))
+    lines.append("    return None\n")
+    return "".join(lines)
+
+
+def _make_comparators(classes, ignore_local_names=False, ignore_fields=frozenset()):
+    source = "\n\n".join(
+        _comparator_source(cls, ignore_local_names, ignore_fields) for cls in classes
+    )
+    namespace = dict(globals())
+    exec(compile(source, "<ast_diff comparators>", "exec"), namespace)
+    return {cls: namespace["_diff_%s" % cls.__name__] for cls in classes}
+
+
+def _node_classes(base=ast.AST):
+    for cls in base.__subclasses__():
+        yield cls
+        yield from _node_classes(cls)
+
+
+@functools.lru_cache(maxsize=None)
+def _comparator_set(ignore_local_names=False, ignore_fields=frozenset()):
+    # one specialized comparator per node class of the running interpreter,
+    # classes showing up later (subclasses defined by users) get theirs on
+    # first use
+    return _make_comparators(list(_node_classes()), ignore_local_names, ignore_fields)
+
+
+def _make_node_diff(
+    ignore_local_names=False, names1=None, names2=None, ignore_fields=frozenset()
+):
+    comparators = _comparator_set(ignore_local_names, ignore_fields)
+
+    def node_diff(node1, node2):
+        cls = type(node1)
+        if cls is not type(node2):
+            return Difference("type", None, None, cls.__name__, type(node2).__name__)
         try:
-            if type(node1) is not type(node2):
-                raise DiffFound(
-                    "different type %s %s"
-                    % (type(node1).__name__, type(node2).__name__)
-                )
-            elif isinstance(node1, ast.Module):
-                # diff of len(ast.Module.body) will be handle later
-                # since 'Module' object has no attribute 'lineno'
-                pass
-            elif isinstance(node1, ast.Expr):
-                pass
-            elif isinstance(node1, ast.NamedExpr):
-                pass
-            elif isinstance(node1, ast.Assign):
-                pass
-            elif isinstance(node1, ast.AugAssign):
-                if node1.op != node2.op:
-                    raise DiffFound(
-                        "ast.AugAssign.op differ %s %s"
-                        % (type(node1.op).__name__, type(node2.op).__name__)
-                    )
-            elif isinstance(node1, ast.AnnAssign):
-                pass
-            elif isinstance(node1, ast.Pass):
-                pass
-            elif isinstance(node1, ast.Call):
-                if len(node1.args) != len(node2.args):
-                    raise DiffFound("length of ast.Call.args differ")
-                elif len(node1.keywords) != len(node2.keywords):
-                    raise DiffFound("length of ast.Call.keywords differ")
-                elif any(
-                    k1.arg != k2.arg for k1, k2 in zip(node1.keywords, node2.keywords)
-                ):
-                    raise DiffFound("ast.Call.keywords differ")
-            elif isinstance(node1, ast.Starred):
-                pass
-            elif isinstance(node1, ast.If):
-                if len(node1.body) != len(node2.body):
-                    raise DiffFound("length of ast.If.body differ")
-                elif len(node1.orelse) != len(node2.orelse):
-                    raise DiffFound("length of ast.If.orelse differ")
-            elif isinstance(node1, ast.IfExp):
-                pass
-            elif isinstance(node1, ast.Continue):
-                pass
-            elif isinstance(node1, ast.Break):
-                pass
-            elif isinstance(node1, ast.Raise):
-                if (node1.exc is None) != (node2.exc is None):
-                    raise DiffFound("ast.Raise.exc differ")
-                if (node1.cause is None) != (node2.cause is None):
-                    raise DiffFound("ast.Raise.cause differ")
-            elif isinstance(node1, ast.Return):
-                if (node1.value is None) != (node2.value is None):
-                    raise DiffFound("ast.Return.value differ")
-            elif isinstance(node1, ast.Yield):
-                if (node1.value is None) != (node2.value is None):
-                    raise DiffFound("ast.Yield.value differ")
-            elif isinstance(node1, ast.YieldFrom):
-                pass
-            elif isinstance(node1, ast.BoolOp):
-                if node1.op != node2.op:
-                    raise DiffFound(
-                        "ast.BoolOp.op differ %s %s"
-                        % (type(node1.op).__name__, type(node2.op).__name__)
-                    )
-            elif isinstance(node1, ast.Compare):
-                if len(node1.comparators) != len(node2.comparators):
-                    raise DiffFound("length of ast.Compare.comparators differ")
-                elif node1.ops != node2.ops:
-                    raise DiffFound("ast.Compare.ops differ")
-            elif isinstance(node1, ast.Name):
-                if node1.id != node2.id:
-                    raise DiffFound("ast.Name.id differ %s %s" % (node1.id, node2.id))
-            elif isinstance(node1, ast.Global):
-                if node1.names != node2.names:
-                    raise DiffFound("ast.Global.names differ")
-            elif isinstance(node1, ast.Nonlocal):
-                if node1.names != node2.names:
-                    raise DiffFound("ast.Nonlocal.names differ")
-            elif isinstance(node1, ast.Constant):
-                if node1.value != node2.value:
-                    raise DiffFound(
-                        "ast.Constant.value differ %s %s" % (node1.value, node2.value)
-                    )
-            elif isinstance(node1, ast.JoinedStr):
-                if len(node1.values) != len(node2.values):
-                    raise DiffFound("length of ast.JoinedStr.values differ")
-            elif isinstance(node1, ast.FormattedValue):
-                if node1.conversion != node2.conversion:
-                    raise DiffFound("ast.FormattedValue.conversion differ")
-                if (node1.format_spec is None) != (node2.format_spec is None):
-                    raise DiffFound("ast.FormattedValue.format_spec differ")
-            elif isinstance(node1, ast.keyword):
-                pass
-            elif isinstance(node1, ast.List):
-                if len(node1.elts) != len(node2.elts):
-                    raise DiffFound("length of ast.List.elts differ")
-            elif isinstance(node1, ast.Set):
-                if len(node1.elts) != len(node2.elts):
-                    raise DiffFound("length of ast.Set.elts differ")
-            elif isinstance(node1, ast.Tuple):
-                if len(node1.elts) != len(node2.elts):
-                    raise DiffFound("length of ast.Tuple.elts differ")
-            elif isinstance(node1, ast.While):
-                if len(node1.body) != len(node2.body):
-                    raise DiffFound("length of ast.While.body differ")
-                elif len(node1.orelse) != len(node2.orelse):
-                    raise DiffFound("length of ast.While.orelse differ")
-            elif isinstance(node1, ast.For):
-                _for_diff("For", node1, node2)
-            elif isinstance(node1, ast.AsyncFor):
-                _for_diff("AsyncFor", node1, node2)
-            elif isinstance(node1, ast.With):
-                _with_diff("With", node1, node2)
-            elif isinstance(node1, ast.AsyncWith):
-                _with_diff("AsyncWith", node1, node2)
-            elif isinstance(node1, ast.Lambda):
-                args1 = node1.args
-                args2 = node2.args
-                if len(args1.args) != len(args2.args):
-                    raise DiffFound("length of ast.Lambda.args.args differ")
-                if len(args1.defaults) != len(args2.defaults):
-                    raise DiffFound("length of ast.Lambda.args.defaults differ")
-                if len(args1.posonlyargs) != len(args2.posonlyargs):
-                    raise DiffFound("length of ast.Lambda.args.posonlyargs differ")
-                for i, (poa1, poa2) in enumerate(
-                    zip(args1.posonlyargs, args2.posonlyargs)
-                ):
-                    if poa1.arg != poa2.arg:
-                        raise DiffFound(
-                            "ast.Lambda.args.posonlyargs[%d].arg differ %s %s"
-                            % (i, poa1.arg, poa2.arg)
-                        )
-                if len(args1.kwonlyargs) != len(args2.kwonlyargs):
-                    raise DiffFound("length of ast.Lambda.args.kwonlyargs differ")
-                for i, (koa1, koa2) in enumerate(
-                    zip(args1.kwonlyargs, args2.kwonlyargs)
+            comparator = comparators[cls]
+        except KeyError:
+            comparator = comparators[cls] = _make_comparators(
+                [cls], ignore_local_names, ignore_fields
+            )[cls]
+        diff = comparator(node1, node2)
+        if diff is None and names1 is not None:
+            field = _LOCAL_NAME_FIELDS.get(cls.__name__)
+            if field is not None:
+                value1 = getattr(node1, field)
+                value2 = getattr(node2, field)
+                local1 = names1.get(id(node1))
+                local2 = names2.get(id(node2))
+                if local1 is None and local2 is None:
+                    if value1 != value2:
+                        return Difference("value", cls.__name__, field, value1, value2)
+                elif local1 != local2:
+                    return Difference("binding", cls.__name__, field, value1, value2)
+        return diff
+
+    return node_diff
+
+
+_node_diff = _make_node_diff()
+
+
+class _Scope:
+    __slots__ = ("kind", "parent", "depth", "bindings", "declared")
+
+    def __init__(self, kind, parent):
+        self.kind = kind
+        self.parent = parent
+        # names resolve to enclosing scopes only, which the depth tells
+        # apart without depending on the scopes elsewhere in the tree
+        self.depth = 0 if parent is None else parent.depth + 1
+        # name -> canonical name, None for names that are kept as they are
+        self.bindings = {}
+        # name -> "global" or "nonlocal"
+        self.declared = {}
+
+    def bind(self, name):
+        if name in self.declared or name in self.bindings:
+            return
+        if self.kind == "module" or self.kind == "class":
+            self.bindings[name] = None
+        else:
+            self.bindings[name] = "%d:%d" % (self.depth, len(self.bindings))
+
+    def resolve(self, name):
+        scope = self
+        while scope is not None:
+            declared = scope.declared.get(name)
+            if declared == "global":
+                return None
+            if declared is None and name in scope.bindings:
+                return scope.bindings[name]
+            # free variable, class bodies are not visible from nested scopes
+            scope = scope.parent
+            while scope is not None and scope.kind == "class":
+                scope = scope.parent
+        return None
+
+
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+
+
+def _local_names(tree):
+    """Map id() of the Name, arg and ExceptHandler nodes naming function
+    local bindings to canonical names.
+
+    Locals are numbered per scope in the order they are first bound in,
+    so the names match for trees that only differ by renamed locals.
+    Arguments, assignment targets, comprehension variables, exception
+    names and match captures count as local bindings.  Keyword-only
+    arguments keep their names since callers have to spell them out.
+    Imports and nested functions and classes bind their names too,
+    though those names are compared as they are.
+    """
+    occurrences = []
+    todo = [(tree, _Scope("module", None))]
+    while todo:
+        node, scope = todo.pop()
+        outer = []
+        inner = []
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            if not isinstance(node, ast.Lambda):
+                scope.bind(node.name)
+            function = _Scope("function", scope)
+            args = node.args
+            positional = args.posonlyargs + args.args + [args.vararg, args.kwarg]
+            for arg in positional + args.kwonlyargs:
+                if arg is None:
+                    continue
+                if arg in args.kwonlyargs:
+                    function.bindings[arg.arg] = None
+                else:
+                    function.bind(arg.arg)
+                occurrences.append((arg, arg.arg, function))
+                if arg.annotation is not None:
+                    outer.append(arg.annotation)
+            outer.extend(args.defaults)
+            outer.extend(d for d in args.kw_defaults if d is not None)
+            if isinstance(node, ast.Lambda):
+                inner.append(node.body)
+            else:
+                outer.extend(node.decorator_list)
+                if node.returns is not None:
+                    outer.append(node.returns)
+                inner.extend(node.body)
+        elif isinstance(node, ast.ClassDef):
+            scope.bind(node.name)
+            function = _Scope("class", scope)
+            outer.extend(node.decorator_list + node.bases + node.keywords)
+            inner.extend(node.body)
+        elif isinstance(node, _COMPREHENSIONS):
+            function = _Scope("comprehension", scope)
+            # the first iterable is evaluated in the enclosing scope
+            outer.append(node.generators[0].iter)
+            for i, generator in enumerate(node.generators):
+                inner.append(generator.target)
+                if i:
+                    inner.append(generator.iter)
+                inner.extend(generator.ifs)
+            if isinstance(node, ast.DictComp):
+                inner.extend([node.key, node.value])
+            else:
+                inner.append(node.elt)
+        else:
+            if isinstance(node, (ast.Global, ast.Nonlocal)):
+                declared = "global" if isinstance(node, ast.Global) else "nonlocal"
+                for name in node.names:
+                    scope.declared[name] = declared
+            elif isinstance(node, ast.Name):
+                if not isinstance(node.ctx, ast.Load):
+                    scope.bind(node.id)
+                occurrences.append((node, node.id, scope))
+            elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+                scope.bind(node.name)
+                occurrences.append((node, node.name, scope))
+            elif type(node).__name__ in _LOCAL_NAME_FIELDS:
+                # match captures
+                name = getattr(node, _LOCAL_NAME_FIELDS[type(node).__name__])
+                if name is not None:
+                    scope.bind(name)
+                    occurrences.append((node, name, scope))
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    if alias.name != "*":
+                        scope.bind(alias.asname or alias.name.partition(".")[0])
+            elif isinstance(node, ast.NamedExpr):
+                # binds in the enclosing function even inside comprehensions
+                target = scope
+                while target.kind == "comprehension":
+                    target = target.parent
+                target.bind(node.target.id)
+                occurrences.append((node.target, node.target.id, target))
+                todo.append((node.value, scope))
+                continue
+            children = list(ast.iter_child_nodes(node))
+            todo.extend((child, scope) for child in reversed(children))
+            continue
+        todo.extend((child, function) for child in reversed(inner))
+        todo.extend((child, scope) for child in reversed(outer))
+    names = {}
+    for node, name, scope in occurrences:
+        canonical = scope.resolve(name)
+        if canonical is not None:
+            names[id(node)] = canonical
+    return names
+
+
+def _node_differ(tree1, tree2, ignore_local_names=False):
+    if not ignore_local_names:
+        return _node_diff
+    return _make_node_diff(True, _local_names(tree1), _local_names(tree2))
+
+
+@functools.lru_cache(maxsize=None)
+def _field_kinds(cls):
+    # "n" single child, "l" list of children, "s" scalar, "t" list of
+    # scalars and "?" when the signature does not tell
+    types = _field_types(cls)
+    kinds = []
+    for field in cls._fields:
+        type_name = types.get(field)
+        if type_name is None:
+            kinds.append("?")
+        elif type_name.endswith("*"):
+            kinds.append("t" if type_name[:-1] in _SCALAR_TYPES else "l")
+        elif type_name.rstrip("?") in _SCALAR_TYPES:
+            kinds.append("s")
+        else:
+            kinds.append("n")
+    return "".join(kinds)
+
+
+def flatten(tree, positions=False):
+    """Return the nodes of tree in preorder as a list of tuples.
+
+    Each node becomes (class name, field values...) where child fields
+    hold the number of children (1 for a single child) and the children
+    follow in preorder, None items of child lists show up as None
+    entries.  Positions are left out and so are Constant.kind and type
+    comments, which show up as None, so two trees are equal for
+    ast_diff exactly when their flattened forms are equal.  With
+    positions, a parallel list of (lineno, col_offset, end_lineno,
+    end_col_offset) tuples is returned as well.
+    """
+    entries = []
+    locations = []
+    todo = [tree]
+    while todo:
+        node = todo.pop()
+        if node is None:
+            entries.append(None)
+            locations.append(None)
+            continue
+        cls = type(node)
+        entry = [cls.__name__]
+        children = []
+        for field, kind in zip(cls._fields, _field_kinds(cls)):
+            value = getattr(node, field, None)
+            if kind == "?":
+                if isinstance(value, ast.AST):
+                    kind = "n"
+                elif isinstance(value, list) and not all(
+                    isinstance(item, str) for item in value
                 ):
-                    if koa1.arg != koa2.arg:
-                        raise DiffFound(
-                            "ast.Lambda.args.kwonlyargs[%d].arg differ %s %s"
-                            % (i, koa1.arg, koa2.arg)
-                        )
-                for kd1, kd2 in zip(args1.kw_defaults, args2.kw_defaults):
-                    if (kd1 is None) != (kd2 is None):
-                        raise DiffFound("ast.Lambda.args.kw_defaults differ")
-                if (args1.vararg is None) != (args2.vararg is None):
-                    raise DiffFound("ast.Lambda.args.vararg differ")
-                if (args1.kwarg is None) != (args2.kwarg is None):
-                    raise DiffFound("ast.Lambda.args.kwarg differ")
-            elif isinstance(node1, ast.FunctionDef):
-                _funcdef_diff("FunctionDef", node1, node2)
-            elif isinstance(node1, ast.AsyncFunctionDef):
-                _funcdef_diff("AsyncFunctionDef", node1, node2)
-            elif isinstance(node1, ast.arguments):
-                pass
-            elif isinstance(node1, ast.arg):
-                if node1.arg != node2.arg:
-                    raise DiffFound("ast.arg.arg differ %s %s" % (node1.arg, node2.arg))
-                if (node1.annotation is None) != (node2.annotation is None):
-                    raise DiffFound("ast.arg.annotation differ")
-            elif isinstance(node1, ast.UnaryOp):
-                if node1.op != node2.op:
-                    raise DiffFound(
-                        "ast.UnaryOp.op differ %s %s"
-                        % (type(node1.op).__name__, type(node2.op).__name__)
-                    )
-            elif isinstance(node1, ast.BinOp):
-                if node1.op != node2.op:
-                    raise DiffFound(
-                        "ast.BinOp.op differ %s %s"
-                        % (type(node1.op).__name__, type(node2.op).__name__)
-                    )
-            elif isinstance(node1, ast.Delete):
-                pass
-            elif isinstance(node1, ast.Subscript):
-                slice1 = node1.slice
-                slice2 = node2.slice
-                if type(slice1) is not type(slice2):
-                    raise DiffFound(
-                        "type of ast.Subscript.slice differ %s %s"
-                        % (type(slice1).__name__, type(slice2).__name__)
-                    )
-                if isinstance(slice1, ast.Slice):
-                    if (slice1.lower is None) != (slice2.lower is None):
-                        raise DiffFound("ast.Subscript.slice.lower differ")
-                    if (slice1.upper is None) != (slice2.upper is None):
-                        raise DiffFound("ast.Subscript.slice.upper differ")
-                    if (slice1.step is None) != (slice2.step is None):
-                        raise DiffFound("ast.Subscript.slice.step differ")
-            elif isinstance(node1, ast.Index):
-                pass
-            elif isinstance(node1, ast.Slice):
-                pass
-            elif isinstance(node1, ast.Import):
-                if len(node1.names) != len(node2.names):
-                    raise DiffFound("length of ast.Import.names differ")
-                for name1, name2 in zip(node1.names, node2.names):
-                    if name1.name != name2.name:
-                        raise DiffFound(
-                            "ast.alias.name differ %s %s" % (name1.name, name2.name)
-                        )
-                    if name1.asname != name2.asname:
-                        raise DiffFound(
-                            "ast.alias.asname differ %s %s"
-                            % (name1.asname, name2.asname)
-                        )
-            elif isinstance(node1, ast.ImportFrom):
-                if node1.module != node2.module:
-                    raise DiffFound(
-                        "ast.ImportFrom.module differ %s %s"
-                        % (node1.module, node2.module)
-                    )
-                if len(node1.names) != len(node2.names):
-                    raise DiffFound("length of ast.ImportFrom.names differ")
-                for name1, name2 in zip(node1.names, node2.names):
-                    if name1.name != name2.name:
-                        raise DiffFound(
-                            "ast.alias.name differ %s %s" % (name1.name, name2.name)
-                        )
-                    if name1.asname != name2.asname:
-                        raise DiffFound(
-                            "ast.alias.asname differ %s %s"
-                            % (name1.asname, name2.asname)
-                        )
-            elif isinstance(node1, ast.alias):
-                pass
-            elif isinstance(node1, ast.Attribute):
-                if node1.attr != node2.attr:
-                    raise DiffFound(
-                        "ast.Attribute.attr differ %s %s" % (node1.attr, node2.attr)
-                    )
-            elif isinstance(node1, ast.Dict):
-                if len(node1.keys) != len(node2.keys):
-                    raise DiffFound("length of ast.Dict.keys differ")
-            elif isinstance(node1, ast.ListComp):
-                _gen_diff("ListComp", node1, node2)
-            elif isinstance(node1, ast.GeneratorExp):
-                _gen_diff("GeneratorExp", node1, node2)
-            elif isinstance(node1, ast.SetComp):
-                _gen_diff("SetComp", node1, node2)
-            elif isinstance(node1, ast.DictComp):
-                _gen_diff("DictComp", node1, node2)
-            elif isinstance(node1, ast.comprehension):
-                pass
-            elif isinstance(node1, ast.ClassDef):
-                if len(node1.decorator_list) != len(node2.decorator_list):
-                    raise DiffFound("length of ast.ClassDef.decorator_list differ")
-                if node1.name != node2.name:
-                    raise DiffFound(
-                        "ast.ClassDef.name differ %s %s" % (node1.name, node2.name)
-                    )
-                if len(node1.bases) != len(node2.bases):
-                    raise DiffFound("length of ast.ClassDef.bases differ")
-                if len(node1.body) != len(node2.body):
-                    raise DiffFound("length of ast.ClassDef.body differ")
-            elif isinstance(node1, ast.Try):
-                _try_diff("Try", node1, node2)
-            elif py311 and isinstance(node1, ast.TryStar):
-                _try_diff("TryStar", node1, node2)
-            elif isinstance(node1, ast.ExceptHandler):
-                if (node1.type is None) != (node2.type is None):
-                    raise DiffFound("ast.ExceptHandler.type differ")
-                if node1.name != node2.name:
-                    raise DiffFound("ast.ExceptHandler.name differ")
-                if len(node1.body) != len(node2.body):
-                    raise DiffFound("length of ast.ExceptHandler.body differ")
-            elif isinstance(node1, ast.Assert):
-                pass
-            elif isinstance(node1, ast.withitem):
-                pass
-            elif isinstance(node1, ast.Await):
-                pass
-            elif py310 and isinstance(node1, ast.Match):
-                if len(node1.cases) != len(node2.cases):
-                    raise DiffFound("length of ast.Match.cases differ")
-            elif py310 and isinstance(node1, ast.match_case):
-                pass
-            elif py310 and isinstance(node1, ast.MatchAs):
-                if node1.name != node2.name:
-                    raise DiffFound("ast.MatchAs.name differ")
-            elif py310 and isinstance(node1, ast.MatchValue):
-                pass
-            elif py310 and isinstance(node1, ast.MatchOr):
-                pass
-            elif py310 and isinstance(node1, ast.MatchSingleton):
-                if node1.value != node2.value:
-                    raise DiffFound("ast.MatchSingleton.value differ")
-            elif py310 and isinstance(node1, ast.MatchSequence):
-                pass
-            elif py310 and isinstance(node1, ast.MatchStar):
-                if node1.name != node2.name:
-                    raise DiffFound("ast.MatchStar.name differ")
-            elif py310 and isinstance(node1, ast.MatchMapping):
-                pass
-            elif py310 and isinstance(node1, ast.MatchClass):
-                pass
+                    kind = "l"
+                else:
+                    kind = "t" if isinstance(value, list) else "s"
+            if (cls.__name__, field) in _SPELLING_FIELDS:
+                entry.append(None)
+            elif kind == "s" or value is None:
+                entry.append(value)
+            elif kind == "n":
+                entry.append(1)
+                children.append(value)
+            elif kind == "l":
+                entry.append(len(value))
+                children.extend(value)
             else:
-                if node1 != node2:
-                    raise DiffFound("DEBUG: %s %s" % (node1, dir(node1)))
-        except DiffFound as e:
-            if node1 is None:
-                return None, (node2.lineno, node2.col_offset), e.args[0]
-            if node2 is None:
-                return (node1.lineno, node1.col_offset), None, e.args[0]
-            return (
-                (node1.lineno, node1.col_offset),
-                (node2.lineno, node2.col_offset),
-                e.args[0],
+                entry.append(tuple(value))
+        entries.append(tuple(entry))
+        if positions:
+            lineno = getattr(node, "lineno", None)
+            locations.append(
+                None
+                if lineno is None
+                else (
+                    lineno,
+                    node.col_offset,
+                    getattr(node, "end_lineno", None),
+                    getattr(node, "end_col_offset", None),
+                )
             )
-        except Exception as e:
-            return (
-                (node1.lineno, node1.col_offset),
-                (node2.lineno, node2.col_offset),
-                str(e),
+        todo.extend(reversed(children))
+    if positions:
+        return entries, locations
+    return entries
+
+
+# sources cannot hold NUL bytes, so no source starts like a dump
+BINARY_MAGIC = b"\x00AST"
+BINARY_VERSION = 1
+_COMPRESSIONS = [None, "zlib", "lzma"]
+
+
+def _is_dump(source):
+    return source[:4] == BINARY_MAGIC
+
+
+def dump_binary(tree, positions=False, compression=None):
+    """Serialize tree into a compact, versioned byte string.
+
+    The payload is the flattened form of the tree together with the
+    field layout of every node class used, written with marshal, which
+    stores repeated identifiers once.  compression may be None, "zlib"
+    or "lzma".
+
+    Like the trees, the marshal format changes between Python versions:
+    load dumps with the version that wrote them.
+    """
+    if positions:
+        entries, locations = flatten(tree, positions=True)
+    else:
+        entries = flatten(tree)
+        locations = None
+    layouts = {}
+    for entry in entries:
+        if entry is not None and entry[0] not in layouts:
+            cls = getattr(ast, entry[0])
+            layouts[entry[0]] = (cls._fields, _field_kinds(cls))
+    payload = marshal.dumps((layouts, entries, locations))
+    if compression == "zlib":
+        payload = zlib.compress(payload)
+    elif compression == "lzma":
+        import lzma
+
+        payload = lzma.compress(payload)
+    elif compression is not None:
+        raise ValueError("unknown compression %r" % (compression,))
+    flags = _COMPRESSIONS.index(compression) << 1 | bool(positions)
+    return BINARY_MAGIC + bytes([BINARY_VERSION, flags]) + payload
+
+
+def _load_payload(buf):
+    if not _is_dump(buf):
+        raise ValueError("not an ast_diff binary dump")
+    version, flags = buf[4], buf[5]
+    if version != BINARY_VERSION:
+        raise ValueError("unsupported binary dump version %d" % version)
+    payload = buf[6:]
+    compression = _COMPRESSIONS[flags >> 1]
+    if compression == "zlib":
+        payload = zlib.decompress(payload)
+    elif compression == "lzma":
+        import lzma
+
+        payload = lzma.decompress(payload)
+    return marshal.loads(payload)
+
+
+def load_binary(buf, flat=False, positions=False):
+    """Load a tree written by dump_binary.
+
+    With flat, return the flattened form (and the positions, with
+    positions) without building any ast nodes.  marshal is not secure
+    against maliciously constructed data: never load dumps from
+    untrusted sources.
+    """
+    layouts, entries, locations = _load_payload(buf)
+    if positions and locations is None:
+        raise ValueError("binary dump has no positions")
+    if flat:
+        return (entries, locations) if positions else entries
+    # children follow their parent in preorder, so building the nodes
+    # back to front leaves the first child of each node on top of stack
+    stack = []
+    for i in range(len(entries) - 1, -1, -1):
+        entry = entries[i]
+        if entry is None:
+            stack.append(None)
+            continue
+        fields, kinds = layouts[entry[0]]
+        # all fields at once, a node built without them and filled in
+        # afterwards is deprecated since Python 3.13
+        values = {}
+        for field, kind, value in zip(fields, kinds, entry[1:]):
+            if value is None:
+                pass
+            elif kind == "n":
+                value = stack.pop()
+            elif kind == "l":
+                value = [stack.pop() for _ in range(value)]
+            elif kind == "t" or (kind == "?" and isinstance(value, tuple)):
+                value = list(value)
+            values[field] = value
+        if locations is not None and locations[i] is not None:
+            lineno, col_offset, end_lineno, end_col_offset = locations[i]
+            values.update(
+                lineno=lineno,
+                col_offset=col_offset,
+                end_lineno=end_lineno,
+                end_col_offset=end_col_offset,
             )
-    return None
+        stack.append(getattr(ast, entry[0])(**values))
+    return stack.pop()
 
 
-def ast_parse_file(fname):
-    with open(fname) as f:
-        return ast.parse(f.read())
+# None and [] are still shown for these with show_empty off
+_SHOWN_EMPTY = tuple(
+    getattr(ast, name) for name in ["Constant", "MatchSingleton"] if hasattr(ast, name)
+)
 
 
-def main(fname1, fname2):
-    ast1 = ast_parse_file(fname1)
-    ast2 = ast_parse_file(fname2)
-    result = ast_diff(ast1, ast2)
-    if result is not None:
-        print(result)
-        if py39:
-            print(
-                "\n".join(
-                    difflib.unified_diff(
-                        ast.dump(ast1, indent=1).splitlines(),
-                        ast.dump(ast2, indent=1).splitlines(),
-                        fromfile=fname1,
-                        tofile=fname2,
-                        lineterm="",
-                    )
+def _dump_args(node, annotate_fields, include_attributes, show_empty):
+    # (label, value) pairs of the arguments ast.dump shows for node, label
+    # is None for positional ones
+    cls = type(node)
+    args = []
+    omitted = []
+    keywords = annotate_fields
+    for name in node._fields:
+        try:
+            value = getattr(node, name)
+        except AttributeError:
+            keywords = True
+            continue
+        if value is None and getattr(cls, name, ...) is None:
+            keywords = True
+            continue
+        if (
+            not show_empty
+            and (value is None or value == [])
+            and not isinstance(node, _SHOWN_EMPTY)
+        ):
+            # only shown when needed to keep the positions of later ones
+            omitted.append(value)
+            continue
+        if not keywords:
+            args.extend((None, value) for value in omitted)
+            omitted = []
+        args.append((name if keywords else None, value))
+    if include_attributes:
+        for name in node._attributes:
+            try:
+                value = getattr(node, name)
+            except AttributeError:
+                continue
+            if value is None and getattr(cls, name, ...) is None:
+                continue
+            args.append((name, value))
+    return args
+
+
+def _dump_simple(value, options):
+    if isinstance(value, ast.AST):
+        return not _dump_args(value, *options)
+    if isinstance(value, list):
+        return not value
+    return True
+
+
+def _dump_inline(label, value):
+    # formats values _dump_simple() is true for
+    if isinstance(value, ast.AST):
+        text = type(value).__name__ + "()"
+    elif isinstance(value, list):
+        text = "[]"
+    else:
+        text = repr(value)
+    return text if label is None else "%s=%s" % (label, text)
+
+
+def iter_dump(
+    node, annotate_fields=True, include_attributes=False, *, indent=1, show_empty=None
+):
+    """Yield the lines of ast.dump(node, indent=indent) one at a time.
+
+    The tree is walked with an explicit stack, so deeply nested trees
+    neither hit the recursion limit nor end up in one huge string.
+    show_empty defaults to what ast.dump does on the running version.
+    """
+    if not isinstance(node, ast.AST):
+        raise TypeError("expected AST, got %r" % node.__class__.__name__)
+    if not isinstance(indent, str):
+        indent = " " * indent
+    if show_empty is None:
+        show_empty = not py313
+    options = (annotate_fields, include_attributes, show_empty)
+    line = []
+    # str items are text, int items start a line indented that many
+    # levels and (value, level) items are still to be formatted
+    todo = [(node, 0)]
+    while todo:
+        item = todo.pop()
+        if isinstance(item, str):
+            line.append(item)
+            continue
+        if isinstance(item, int):
+            yield "".join(line)
+            line = [indent * item]
+            continue
+        value, level = item
+        level += 1
+        if isinstance(value, ast.AST):
+            args = _dump_args(value, *options)
+            name = type(value).__name__
+            if len(args) <= 3 and all(_dump_simple(v, options) for _, v in args):
+                line.append(
+                    "%s(%s)"
+                    % (name, ", ".join(_dump_inline(label, v) for label, v in args))
                 )
-            )
-        return 1
-    assert ast.dump(ast1) == ast.dump(ast2)
-    return 0
+                continue
+            line.append(name + "(")
+            items = []
+            for label, v in args:
+                items.extend([",", level])
+                if label is not None:
+                    items.append(label + "=")
+                items.append((v, level))
+            items.append(")")
+            todo.extend(reversed(items[1:]))
+        elif isinstance(value, list) and value:
+            line.append("[")
+            items = []
+            for v in value:
+                items.extend([",", level, (v, level)])
+            items.append("]")
+            todo.extend(reversed(items[1:]))
+        else:
+            line.append(_dump_inline(None, value))
+    yield "".join(line)
+
+
+def _bisect_lines(a, alo, ahi, b, blo, bhi, max_cost, budget=None):
+    # middle snake of Myers' linear space algorithm: a point (x, y) on
+    # a shortest edit path of a[alo:ahi] and b[blo:bhi], or None when it
+    # costs more than max_cost edits
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min((n + m + 1) // 2, max_cost)
+    offset = max_d
+    v1 = [-1] * (2 * max_d + 2)
+    v2 = [-1] * (2 * max_d + 2)
+    v1[offset + 1] = 0
+    v2[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        if budget is not None:
+            budget.check()
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < len(v2) and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return x1, y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < len(v1) and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= n - x2:
+                        return x1, offset + x1 - k1_offset
+    return None
+
+
+def _line_opcodes(a, b, max_cost=DIFF_MAX_COST, budget=None):
+    # same as SequenceMatcher(None, a, b).get_opcodes(), but from Myers'
+    # algorithm in linear space instead of difflib's heuristics
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+    segments = []
+    todo = [(0, len(a), 0, len(b))]
+    while todo:
+        if budget is not None:
+            budget.check()
+        alo, ahi, blo, bhi = todo.pop()
+        start = alo
+        bstart = blo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            segments.append((True, start, alo, bstart, blo))
+        suffix = 0
+        while alo < ahi - suffix and blo < bhi - suffix:
+            if a[ahi - suffix - 1] != b[bhi - suffix - 1]:
+                break
+            suffix += 1
+        ahi -= suffix
+        bhi -= suffix
+        if suffix:
+            # popped right after the halves pushed below
+            todo.append((ahi, ahi + suffix, bhi, bhi + suffix))
+        if alo == ahi and blo == bhi:
+            continue
+        split = None
+        if alo < ahi and blo < bhi:
+            split = _bisect_lines(a, alo, ahi, b, blo, bhi, max_cost, budget)
+        if split is None:
+            segments.append((False, alo, ahi, blo, bhi))
+            continue
+        x, y = split
+        todo.append((alo + x, ahi, blo + y, bhi))
+        todo.append((alo, alo + x, blo, blo + y))
+    opcodes = []
+    for equal, i1, i2, j1, j2 in segments:
+        if opcodes and opcodes[-1][0] == equal:
+            i1 = opcodes[-1][1]
+            j1 = opcodes[-1][3]
+            opcodes.pop()
+        opcodes.append((equal, i1, i2, j1, j2))
+    tags = {(True, False): "delete", (False, True): "insert"}
+    return [
+        (
+            "equal" if equal else tags.get((i1 < i2, j1 < j2), "replace"),
+            i1,
+            i2,
+            j1,
+            j2,
+        )
+        for equal, i1, i2, j1, j2 in opcodes
+    ]
+
+
+def _grouped_opcodes(codes, n):
+    # SequenceMatcher.get_grouped_opcodes() for the given opcodes
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _unified_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return "%d" % (start + 1)
+    return "%d,%d" % (start + 1 if length else start, length)
+
+
+def unified_diff(
+    a,
+    b,
+    fromfile="",
+    tofile="",
+    fromfiledate="",
+    tofiledate="",
+    n=3,
+    lineterm="\n",
+    max_cost=DIFF_MAX_COST,
+    budget=None,
+):
+    """difflib.unified_diff() on Myers' algorithm.
+
+    Common leading and trailing lines are skipped first, so for dumps
+    of mostly equal trees the work starts at the first differing line.
+    Memory is linear in the number of lines and regions costing more
+    than max_cost edits are shown as replaced as a whole instead of
+    being searched for a shortest edit.  The search checks the deadline
+    of budget.
+    """
+    started = False
+    for group in _grouped_opcodes(_line_opcodes(a, b, max_cost, budget), n):
+        if not started:
+            started = True
+            fromdate = "\t" + fromfiledate if fromfiledate else ""
+            todate = "\t" + tofiledate if tofiledate else ""
+            yield "--- %s%s%s" % (fromfile, fromdate, lineterm)
+            yield "+++ %s%s%s" % (tofile, todate, lineterm)
+        first = group[0]
+        last = group[-1]
+        yield "@@ -%s +%s @@%s" % (
+            _unified_range(first[1], last[2]),
+            _unified_range(first[3], last[4]),
+            lineterm,
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield " " + line
+                continue
+            for line in a[i1:i2]:
+                yield "-" + line
+            for line in b[j1:j2]:
+                yield "+" + line
+
+
+@functools.lru_cache(maxsize=None)
+def _named_field_kinds(name):
+    return _field_kinds(getattr(ast, name))
+
+
+def _child_count(entry):
+    if entry is None:
+        return 0
+    count = 0
+    for kind, value in zip(_named_field_kinds(entry[0]), entry[1:]):
+        if value is not None:
+            if kind == "n":
+                count += 1
+            elif kind == "l":
+                count += value
+    return count
+
+
+def subtree_hashes(entries):
+    """Return (hashes, sizes) for every subtree of a flattened tree.
+
+    hashes[i] is a 16 byte digest of the subtree rooted at entries[i]
+    and sizes[i] its number of nodes, so that the subtree spans
+    entries[i:i + sizes[i]].  The digests are stable across processes
+    and, like tree_fingerprint, equal for subtrees ast_diff finds equal.
+    """
+    n = len(entries)
+    hashes = [None] * n
+    sizes = [1] * n
+    stack = []
+    for i in range(n - 1, -1, -1):
+        entry = entries[i]
+        h = hashlib.blake2b(
+            repr(_canonical_entry(entry)).encode("utf-8"), digest_size=16
+        )
+        size = 1
+        for _ in range(_child_count(entry)):
+            j = stack.pop()
+            h.update(hashes[j])
+            size += sizes[j]
+        hashes[i] = h.digest()
+        sizes[i] = size
+        stack.append(i)
+    return hashes, sizes
+
+
+def _stable_pairs(pairs):
+    # longest run of pairs that kept their relative order (longest
+    # increasing subsequence of the new indices), in O(n log n)
+    tails = []
+    tail_pairs = []
+    previous = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_pairs.append(k)
+        else:
+            tails[pos] = j
+            tail_pairs[pos] = k
+        previous[k] = tail_pairs[pos - 1] if pos else None
+    stable = set()
+    k = tail_pairs[-1] if tail_pairs else None
+    while k is not None:
+        stable.add(k)
+        k = previous[k]
+    return stable
+
+
+def _mark(flags, start, size):
+    flags[start : start + size] = b"\1" * size
+
+
+def _edits(entries, locations, sizes, covered, matched):
+    # statements outside matched subtrees that do not contain any either
+    contains = [0] * (len(entries) + 1)
+    for i in range(len(entries) - 1, -1, -1):
+        contains[i] = contains[i + 1] + matched[i]
+    stmts = _statement_names()
+    return [
+        (locations[i][:2], entries[i][0])
+        for i in range(len(entries))
+        if not covered[i]
+        and entries[i] is not None
+        and entries[i][0] in stmts
+        and contains[i] == contains[i + sizes[i]]
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _statement_names():
+    return frozenset(cls.__name__ for cls in _node_classes(ast.stmt))
+
+
+def find_moves(tree1, tree2, min_size=MOVE_MIN_SIZE):
+    """Tell moved code apart from edited code.
+
+    Subtrees of at least min_size nodes are matched by hash, largest
+    first.  Matched subtrees that kept their relative order are left
+    alone, the others are reported as moves.  Statements on either side
+    neither matched nor containing a match are the actual edits.
+
+    Return (moves, removed, added): moves holds (pos1, pos2, node type)
+    tuples, removed and added (pos, node type) tuples of statements.
+    """
+    entries1, locations1 = flatten(tree1, positions=True)
+    entries2, locations2 = flatten(tree2, positions=True)
+    hashes1, sizes1 = subtree_hashes(entries1)
+    hashes2, sizes2 = subtree_hashes(entries2)
+    index = {}
+    for j, h in enumerate(hashes2):
+        if sizes2[j] >= min_size:
+            index.setdefault(h, deque()).append(j)
+    covered1 = bytearray(len(entries1))
+    covered2 = bytearray(len(entries2))
+    matched1 = bytearray(len(entries1))
+    matched2 = bytearray(len(entries2))
+    pairs = []
+    i = 0
+    while i < len(entries1):
+        candidates = index.get(hashes1[i]) if sizes1[i] >= min_size else None
+        while candidates and covered2[candidates[0]]:
+            candidates.popleft()
+        if not candidates:
+            i += 1
+            continue
+        j = candidates.popleft()
+        pairs.append((i, j))
+        matched1[i] = matched2[j] = 1
+        _mark(covered1, i, sizes1[i])
+        _mark(covered2, j, sizes2[j])
+        i += sizes1[i]
+    stable = _stable_pairs(pairs)
+    moves = [
+        (locations1[i][:2], locations2[j][:2], entries1[i][0])
+        for k, (i, j) in enumerate(pairs)
+        if k not in stable and locations1[i] is not None
+    ]
+    removed = _edits(entries1, locations1, sizes1, covered1, matched1)
+    added = _edits(entries2, locations2, sizes2, covered2, matched2)
+    return moves, removed, added
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x):
+    # splitmix64 finalizer
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK64
+    return x ^ (x >> 31)
+
+
+def minhash(tree, size=MINHASH_SIZE):
+    """Return a MinHash sketch of the multiset of subtrees of tree.
+
+    Repeated subtrees count once per occurrence.  The sketch is built
+    with one permutation hashing in a single pass over the subtree
+    hashes: every hash lands in one of size buckets, which keep their
+    minimum, and empty buckets borrow from the next one.  The share of
+    equal values of two sketches estimates the Jaccard similarity.
+    """
+    mins = [None] * size
+    seen = Counter()
+    for h in subtree_hashes(flatten(tree))[0]:
+        value = int.from_bytes(h[:8], "little")
+        count = seen[h]
+        seen[h] = count + 1
+        if count:
+            value = _mix64(value + count * 0x9E3779B97F4A7C15 & _MASK64)
+        bucket = value % size
+        if mins[bucket] is None or value < mins[bucket]:
+            mins[bucket] = value
+    if all(value is None for value in mins):
+        return tuple(mins)
+    for i in range(size):
+        # densification: rotate values in from the next filled bucket
+        j = i
+        while mins[j % size] is None:
+            j += 1
+        if j != i:
+            mins[i] = _mix64(mins[j % size] + j - i)
+    return tuple(mins)
+
+
+def similarity(sketch1, sketch2):
+    return sum(a == b for a, b in zip(sketch1, sketch2)) / len(sketch1)
+
+
+def pair_renames(sketches1, sketches2, threshold=RENAME_THRESHOLD, bands=LSH_BANDS):
+    """Match removed files with added files of similar content.
+
+    sketches1 and sketches2 map names to minhash() sketches.  Files
+    sharing a band of their sketches are candidates, so only similar
+    files are ever compared and the work grows about linearly with the
+    number of files.  Candidates are taken best first, each file at
+    most once.  Return [(name1, name2, similarity)].
+    """
+    buckets = {}
+    for side, sketches in [(0, sketches1), (1, sketches2)]:
+        for name, sketch in sketches.items():
+            rows = len(sketch) // bands
+            for band in range(bands):
+                key = band, sketch[band * rows : (band + 1) * rows]
+                buckets.setdefault(key, ([], []))[side].append(name)
+    candidates = set()
+    for names1, names2 in buckets.values():
+        candidates.update((name1, name2) for name1 in names1 for name2 in names2)
+    scored = []
+    for name1, name2 in candidates:
+        score = similarity(sketches1[name1], sketches2[name2])
+        if score >= threshold:
+            scored.append((-score, name1, name2))
+    scored.sort()
+    taken1 = set()
+    taken2 = set()
+    pairs = []
+    for score, name1, name2 in scored:
+        if name1 not in taken1 and name2 not in taken2:
+            taken1.add(name1)
+            taken2.add(name2)
+            pairs.append((name1, name2, -score))
+    return pairs
+
+
+def _position(node):
+    lineno = getattr(node, "lineno", None)
+    if lineno is None:
+        return None
+    return lineno, node.col_offset
+
+
+def _end_position(node):
+    end_lineno = getattr(node, "end_lineno", None)
+    if end_lineno is None:
+        return None
+    return end_lineno, node.end_col_offset
+
+
+def _unordered_groups(names):
+    # {node type: [fields]} of the fields compared regardless of order,
+    # the keys and values of dicts go together
+    groups = {}
+    for qualname in names:
+        name, _, field = qualname.partition(".")
+        cls = getattr(ast, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, ast.AST)):
+            raise ValueError("unknown node type in %r" % qualname)
+        if field not in cls._fields:
+            raise ValueError("ast.%s has no field %r" % (name, field))
+        if _field_kinds(cls)[cls._fields.index(field)] != "l":
+            raise ValueError("ast.%s.%s is not a list of nodes" % (name, field))
+        fields = ("keys", "values") if name == "Dict" else (field,)
+        if fields not in groups.setdefault(name, []):
+            groups[name].append(fields)
+    return groups
+
+
+def _element_key(element):
+    return tuple(None if node is None else tree_fingerprint(node) for node in element)
+
+
+def _element_node(element):
+    return next(node for node in element if node is not None)
+
+
+def _align_unordered(node1, node2, groups):
+    """Return copies of node1 and node2 with the elements of the fields
+    in groups reordered to line up, and the "unmatched" Differences.
+
+    Elements are matched through the multisets of their subtree
+    fingerprints.  The matched ones come first in the order of node1,
+    followed by the others in their own order, so that those are still
+    compared one by one when both sides have as many.  Otherwise each
+    of them is unmatched.
+    """
+    node_type = type(node1).__name__
+    copy1 = copy.copy(node1)
+    copy2 = copy.copy(node2)
+    unmatched = []
+    for fields in groups:
+        elements1 = list(zip(*(getattr(node1, field) for field in fields)))
+        elements2 = list(zip(*(getattr(node2, field) for field in fields)))
+        keys2 = {}
+        for element in elements2:
+            keys2.setdefault(_element_key(element), []).append(element)
+        for elements in keys2.values():
+            elements.reverse()
+        matched1 = []
+        matched2 = []
+        surplus1 = []
+        for element in elements1:
+            partners = keys2.get(_element_key(element))
+            if partners:
+                matched1.append(element)
+                matched2.append(partners.pop())
+            else:
+                surplus1.append(element)
+        taken = {id(element) for element in matched2}
+        surplus2 = [element for element in elements2 if id(element) not in taken]
+        if len(surplus1) != len(surplus2):
+            for element in surplus1:
+                diff = Difference(
+                    "unmatched",
+                    node_type,
+                    fields[0],
+                    type(_element_node(element)).__name__,
+                    None,
+                )
+                diff.pos1 = _position(_element_node(element))
+                diff.end1 = _end_position(_element_node(element))
+                unmatched.append(diff)
+            for element in surplus2:
+                diff = Difference(
+                    "unmatched",
+                    node_type,
+                    fields[0],
+                    None,
+                    type(_element_node(element)).__name__,
+                )
+                diff.pos2 = _position(_element_node(element))
+                diff.end2 = _end_position(_element_node(element))
+                unmatched.append(diff)
+        for i, field in enumerate(fields):
+            setattr(copy1, field, [element[i] for element in matched1 + surplus1])
+            setattr(copy2, field, [element[i] for element in matched2 + surplus2])
+    return copy1, copy2, unmatched
+
+
+def iter_differences(
+    tree1, tree2, ignore_local_names=False, budget=None, unordered_fields=()
+):
+    """Yield a Difference for every differing pair of nodes.
+
+    Both trees are walked in the order of ast.walk.  Children of a pair
+    are only compared when both nodes have the same number of them,
+    leaving out the field a difference of the pair was reported on, so
+    one structural difference does not drag along a cascade of
+    misaligned ones.  With ignore_local_names, trees that only differ by
+    the names of function locals compare equal.  With a Budget, the
+    walk ends with an "inconclusive" Difference once it is used up.
+
+    unordered_fields holds "Class.field" names of lists, such as those
+    of UNORDERED_FIELDS, compared as multisets: reordering their
+    elements is not a difference.
+    """
+    return _iter_differences(
+        tree1,
+        tree2,
+        _node_differ(tree1, tree2, ignore_local_names),
+        budget=budget,
+        unordered=_unordered_groups(unordered_fields),
+    )
+
+
+def _child_nodes(node, ignore_fields):
+    # ast.iter_child_nodes leaving out ignored fields
+    name = type(node).__name__
+    for field, value in ast.iter_fields(node):
+        if (name, field) in ignore_fields:
+            continue
+        if isinstance(value, ast.AST):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, ast.AST):
+                    yield item
+
+
+def _walk(tree, ignore_fields):
+    if not ignore_fields:
+        return ast.walk(tree)
+    return _walk_ignoring(tree, ignore_fields)
+
+
+def _walk_ignoring(tree, ignore_fields):
+    todo = deque([tree])
+    while todo:
+        node = todo.popleft()
+        todo.extend(_child_nodes(node, ignore_fields))
+        yield node
+
+
+def _iter_differences(
+    tree1, tree2, node_diff, ignore_fields=frozenset(), budget=None, unordered=None
+):
+    todo = deque([(tree1, tree2)])
+    while todo:
+        node1, node2 = todo.popleft()
+        if budget is not None:
+            try:
+                budget.charge()
+            except _BudgetExceeded as e:
+                diff = Difference(
+                    "inconclusive", type(node1).__name__, old=str(e), new=budget.nodes
+                )
+                diff.pos1 = _position(node1)
+                diff.pos2 = _position(node2)
+                yield diff
+                return
+        unmatched = ()
+        if unordered and type(node1) is type(node2):
+            groups = unordered.get(type(node1).__name__)
+            if groups:
+                node1, node2, unmatched = _align_unordered(node1, node2, groups)
+        diff = node_diff(node1, node2)
+        skipped = ignore_fields
+        if (
+            diff is None
+            and type(node1) is ast.Module
+            and len(node1.body) != len(node2.body)
+        ):
+            # left to the walk by the generated checks, a structural
+            # difference like the length of any other body here
+            diff = Difference(
+                "length", "Module", "body", len(node1.body), len(node2.body)
+            )
+        if diff is not None:
+            diff.pos1 = _position(node1)
+            diff.pos2 = _position(node2)
+            diff.end1 = _end_position(node1)
+            diff.end2 = _end_position(node2)
+            yield diff
+            if diff.field is not None:
+                # reported already, operators would come up once more
+                skipped = ignore_fields | {(type(node1).__name__, diff.field)}
+        yield from unmatched
+        children1 = [] if node1 is None else list(_child_nodes(node1, skipped))
+        children2 = [] if node2 is None else list(_child_nodes(node2, skipped))
+        if diff is None or len(children1) == len(children2):
+            todo.extend(zip_longest(children1, children2))
+
+
+def summarize(
+    tree1,
+    tree2,
+    counter=None,
+    ignore_local_names=False,
+    budget=None,
+    unordered_fields=(),
+):
+    """Count the differences between two trees by Difference.label.
+
+    The differences are counted as they are found and dropped right away,
+    so the memory used does not grow with the number of differences.
+    """
+    if counter is None:
+        counter = Counter()
+    for diff in iter_differences(
+        tree1, tree2, ignore_local_names, budget, unordered_fields
+    ):
+        counter[diff.label] += 1
+    return counter
+
+
+def _compare(node1, node2, node_diff=_node_diff):
+    diff = node_diff(node1, node2)
+    if diff is None:
+        return None
+    diff.pos1 = _position(node1)
+    diff.pos2 = _position(node2)
+    return diff.as_tuple()
+
+
+def _first_difference(nodes1, nodes2, node_diff=_node_diff, budget=None):
+    if budget is None:
+        for node1, node2 in zip_longest(nodes1, nodes2):
+            result = _compare(node1, node2, node_diff)
+            if result is not None:
+                return result
+        return None
+    for node1, node2 in zip_longest(nodes1, nodes2):
+        try:
+            budget.charge()
+        except _BudgetExceeded as e:
+            return Inconclusive(
+                _position(node1), _position(node2), str(e), budget.nodes
+            )
+        result = _compare(node1, node2, node_diff)
+        if result is not None:
+            return result
+    return None
+
+
+def _line_index(source):
+    if source is None or isinstance(source, LineIndex):
+        return source
+    if _is_dump(source):
+        return None
+    return LineIndex(source)
+
+
+def ast_diff(
+    tree1,
+    tree2,
+    ignore_local_names=False,
+    budget=None,
+    sources=None,
+    unordered_fields=(),
+):
+    """Return (pos1, pos2, message) of the first difference in the order
+    of ast.walk, or None for equal trees.
+
+    With a Budget, the comparison returns an Inconclusive result with
+    the positions it got to once the budget is used up.  With sources,
+    the (source1, source2) the trees were parsed from, the result is
+    Located.  Pass a LineIndex instead of a source to share it between
+    calls on the same file.  unordered_fields is as for
+    iter_differences.
+    """
+    if sources is not None or unordered_fields:
+        for diff in iter_differences(
+            tree1, tree2, ignore_local_names, budget, unordered_fields
+        ):
+            if sources is None or diff.kind == "inconclusive":
+                return diff.as_tuple()
+            return diff.locate(*map(_line_index, sources))
+        return None
+    return _first_difference(
+        ast.walk(tree1),
+        ast.walk(tree2),
+        _node_differ(tree1, tree2, ignore_local_names),
+        budget,
+    )
+
+
+def _walk_depth(nodes, depth):
+    # same order as ast.walk, but also yields the depth of each node
+    todo = deque((depth, node) for node in nodes)
+    while todo:
+        depth, node = todo.popleft()
+        todo.extend((depth + 1, child) for child in ast.iter_child_nodes(node))
+        yield depth, node
+
+
+def _diff_chunk(chunk):
+    body1, body2, ignore_local_names = chunk
+    # local scopes never span top-level statements, so the chunks can be
+    # canonicalized on their own
+    node_diff = _node_differ(
+        ast.Module(body=body1, type_ignores=[]),
+        ast.Module(body=body2, type_ignores=[]),
+        ignore_local_names,
+    )
+    for (depth1, node1), (depth2, node2) in zip_longest(
+        _walk_depth(body1, 1), _walk_depth(body2, 1), fillvalue=(None, None)
+    ):
+        result = _compare(node1, node2, node_diff)
+        if result is not None:
+            return depth1 if depth1 is not None else depth2, result
+    return None
+
+
+def _gil_disabled():
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def _parallel_map(func, tasks, jobs=None, initializer=None, initargs=()):
+    # [func(task) for task in tasks] on jobs workers, threads on
+    # free-threaded builds and processes otherwise
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    if _gil_disabled():
+        executor = ThreadPoolExecutor(jobs, initializer=initializer, initargs=initargs)
+    else:
+        executor = ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs)
+    with executor:
+        return list(
+            executor.map(func, tasks, chunksize=max(1, len(tasks) // (jobs * 4)))
+        )
+
+
+def _statement_start(node):
+    # decorators come before the line of a definition
+    decorators = getattr(node, "decorator_list", ())
+    return min([node.lineno] + [decorator.lineno for decorator in decorators])
+
+
+def _chunk_bounds(body1, body2, chunk_size):
+    # (start, stop) of the chunks of both bodies, cut where the statement
+    # starts on a line of its own on both sides so that the lines of the
+    # chunks can be parsed on their own
+    bounds = []
+    start = 0
+    stop = chunk_size
+    while stop < len(body1):
+        if all(
+            body[stop - 1].end_lineno < _statement_start(body[stop])
+            for body in (body1, body2)
+        ):
+            bounds.append((start, stop))
+            start = stop
+            stop += chunk_size
+        else:
+            stop += 1
+    bounds.append((start, len(body1)))
+    return bounds
+
+
+def _source_chunk(lines, body, start, stop):
+    # (first line number, source) of body[start:stop]
+    first = _statement_start(body[start])
+    return first, b"".join(lines[first - 1 : body[stop - 1].end_lineno])
+
+
+def _parse_chunk(first, source, encoding):
+    # padded with newlines for the nodes to get the line numbers of the
+    # whole file: a file only has a few chunks per worker, and scanning
+    # the blank lines costs less than walking every node again
+    return ast.parse("\n" * (first - 1) + source.decode(encoding)).body
+
+
+def _diff_source_chunk(chunk):
+    # source lines are much cheaper to send to a process than the nodes,
+    # which take longer to unpickle than to parse
+    (first1, source1), (first2, source2), encodings, ignore_local_names = chunk
+    return _diff_chunk(
+        (
+            _parse_chunk(first1, source1, encodings[0]),
+            _parse_chunk(first2, source2, encodings[1]),
+            ignore_local_names,
+        )
+    )
+
+
+def _source_encoding(source):
+    return tokenize.detect_encoding(io.BytesIO(source).readline)[0]
+
+
+def ast_diff_parallel(
+    tree1, tree2, jobs=None, chunk_size=None, ignore_local_names=False, sources=None
+):
+    """ast_diff() comparing chunks of Module.body on jobs workers.
+
+    Threads are used on free-threaded builds.  Otherwise the chunks go
+    to worker processes as the lines of the (source1, source2) bytes the
+    trees were parsed from, since nodes cost more to pickle than to
+    compare: without sources, the chunks are compared in this process.
+    """
+    if (
+        not isinstance(tree1, ast.Module)
+        or not isinstance(tree2, ast.Module)
+        or len(tree1.body) != len(tree2.body)
+        or tree1.type_ignores
+        or tree2.type_ignores
+    ):
+        # chunks would not line up, the serial walk reports it soon enough
+        return ast_diff(tree1, tree2, ignore_local_names)
+    jobs = jobs or os.cpu_count() or 1
+    body1 = tree1.body
+    body2 = tree2.body
+    if chunk_size is None:
+        chunk_size = max(PARALLEL_MIN_CHUNK, -(-len(body1) // (jobs * 4)))
+    if sources is not None:
+        sources = [
+            source.encode("utf-8") if isinstance(source, str) else source
+            for source in sources
+        ]
+        if any(_is_dump(source) for source in sources):
+            sources = None
+    if jobs > 1 and not _gil_disabled() and sources is not None:
+        bounds = _chunk_bounds(body1, body2, chunk_size)
+        if len(bounds) > 1:
+            lines1, lines2 = (source.splitlines(keepends=True) for source in sources)
+            encodings = tuple(map(_source_encoding, sources))
+            chunks = []
+            for start, stop in bounds:
+                chunk1 = _source_chunk(lines1, body1, start, stop)
+                chunk2 = _source_chunk(lines2, body2, start, stop)
+                # the same lines at the same place parse the same
+                if chunk1 != chunk2 or encodings[0] != encodings[1]:
+                    chunks.append((chunk1, chunk2, encodings, ignore_local_names))
+            # trees hold no reference cycles, collecting garbage in the
+            # workers would only walk the many nodes they parse and those
+            # forked workers inherit from this process
+            return _shallowest(
+                _parallel_map(_diff_source_chunk, chunks, jobs, initializer=gc.disable)
+            )
+    chunks = [
+        (body1[i : i + chunk_size], body2[i : i + chunk_size], ignore_local_names)
+        for i in range(0, len(body1), chunk_size)
+    ]
+    # nodes only go to threads
+    results = _parallel_map(_diff_chunk, chunks, jobs if _gil_disabled() else 1)
+    return _shallowest(results)
+
+
+def _shallowest(results):
+    # ast.walk is breadth first, so the shallowest difference wins and
+    # ties are broken by source order
+    found = [result for result in results if result is not None]
+    if not found:
+        return None
+    return min(found, key=lambda result: result[0])[1]
+
+
+# lines at column 0 that cannot start a top-level statement: indented,
+# blank or comment lines, closing brackets and continued compound
+# statements
+_NOT_STATEMENT = re.compile(rb"[ \t\f\r\n#)\]}]|(?:else|elif|except|finally)\b")
+
+
+def _iter_chunks(f, chunk_size):
+    # (first line number, lines) of about chunk_size bytes, cut before
+    # lines that may start a top-level statement
+    lines = []
+    size = 0
+    first = 1
+    for line in f:
+        if size >= chunk_size and not _NOT_STATEMENT.match(line):
+            yield first, lines
+            first += len(lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    yield first, lines
+
+
+def _parse_at(text, first):
+    # parse text as the lines of a file from line first on.  Blank lines
+    # in front cost the parser less than ast.increment_lineno costs
+    # walking the nodes, until there are about 16 of them per character
+    # of text; past that the padding would make parsing a whole file
+    # one chunk at a time quadratic
+    offset = first - 1
+    if offset <= 16 * len(text):
+        return ast.parse("\n" * offset + text)
+    try:
+        tree = ast.parse(text)
+    except SyntaxError as e:
+        if e.lineno is not None:
+            e.lineno += offset
+        raise
+    return ast.increment_lineno(tree, offset)
+
+
+def iter_statements(fname, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the top-level statements of a file without parsing all of
+    it at once.
+
+    The source is parsed about chunk_size bytes at a time, so only one
+    chunk is in memory at a time.  Chunks are cut before lines starting
+    at column 0, and a chunk that does not parse on its own was not cut
+    at a statement boundary: it is parsed again together with the next
+    ones once it has doubled in size.  The nodes have the line numbers
+    of the whole file.
+    """
+    with open(fname, "rb") as f:
+        encoding, _ = tokenize.detect_encoding(f.readline)
+        f.seek(0)
+        start = 1
+        pending = []
+        size = 0
+        retry_size = 0
+        for first, lines in _iter_chunks(f, chunk_size):
+            pending.extend(lines)
+            size += sum(map(len, lines))
+            if size < retry_size:
+                continue
+            text = b"".join(pending).decode(encoding)
+            try:
+                tree = _parse_at(text, start)
+            except SyntaxError:
+                retry_size = 2 * size
+                continue
+            del text
+            yield from tree.body
+            start = first + len(lines)
+            pending = []
+            size = retry_size = 0
+        if pending:
+            # the rest after a chunk that did not parse, or its error
+            yield from _parse_at(b"".join(pending).decode(encoding), start).body
+
+
+def ast_diff_stream(
+    fname1, fname2, ignore_local_names=False, chunk_size=STREAM_CHUNK_SIZE
+):
+    """ast_diff of two files parsed by iter_statements.
+
+    The top-level statements are compared pair by pair and dropped, so
+    memory is bounded by the chunks parsed rather than by the files.
+    The result is that of ast_diff when both files have as many
+    top-level statements, otherwise one statement without a counterpart
+    may be reported where ast_diff would report the walk going astray.
+    """
+    best = None
+    for statement1, statement2 in zip_longest(
+        iter_statements(fname1, chunk_size), iter_statements(fname2, chunk_size)
+    ):
+        result = _diff_chunk(
+            (
+                [] if statement1 is None else [statement1],
+                [] if statement2 is None else [statement2],
+                ignore_local_names,
+            )
+        )
+        # the shallowest difference wins as in ast_diff_parallel, and
+        # nothing comes before one between top-level statements
+        if result is not None and (best is None or result[0] < best[0]):
+            best = result
+            if best[0] == 1:
+                break
+    return None if best is None else best[1]
+
+
+def _canonical_value(value):
+    # 1, True, 1.0 and 1+0j compare equal, so they get the same bytes
+    if type(value) in (bool, int, float, complex):
+        if isinstance(value, complex):
+            if value.imag:
+                return value
+            value = value.real
+        if isinstance(value, float) and not value.is_integer():
+            return value
+        return int(value)
+    return value
+
+
+def _canonical_entry(entry):
+    if entry is None or entry[0] != "Constant":
+        return entry
+    return tuple(_canonical_value(value) for value in entry)
+
+
+def tree_fingerprint(tree):
+    """Return a 16 byte digest equal for trees ast_diff finds equal."""
+    entries = [_canonical_entry(entry) for entry in flatten(tree)]
+    return hashlib.blake2b(marshal.dumps(entries), digest_size=16).digest()
+
+
+# digest of a source -> its tree_fingerprint, or None for sources seen
+# once and not fingerprinted yet
+_fingerprints = OrderedDict()
+_fingerprints_lock = threading.Lock()
+
+
+def _source_digest(source):
+    if isinstance(source, str):
+        return hashlib.sha256(b"s" + source.encode("utf-8", "surrogatepass")).digest()
+    return hashlib.sha256(b"b" + source).digest()
+
+
+def _cached_fingerprint(digest, remember=False):
+    with _fingerprints_lock:
+        if digest in _fingerprints:
+            _fingerprints.move_to_end(digest)
+            return True, _fingerprints[digest]
+        if remember:
+            _remember_fingerprint(digest, None)
+    return False, None
+
+
+def _remember_fingerprint(digest, fingerprint):
+    # called with _fingerprints_lock held
+    _fingerprints[digest] = fingerprint
+    _fingerprints.move_to_end(digest)
+    while len(_fingerprints) > FINGERPRINT_CACHE_SIZE:
+        _fingerprints.popitem(last=False)
+
+
+def _source_fingerprint(source):
+    digest = _source_digest(source)
+    fingerprint = _cached_fingerprint(digest)[1]
+    if fingerprint is None:
+        fingerprint = tree_fingerprint(_parse_source(source))
+        with _fingerprints_lock:
+            _remember_fingerprint(digest, fingerprint)
+    return fingerprint
+
+
+def _equal_strategy(a, b):
+    if isinstance(a, ast.AST) or isinstance(b, ast.AST):
+        return "walk"
+    if _is_dump(a) and _is_dump(b):
+        return "flat"
+    # a source seen again is worth fingerprinting when it is long enough,
+    # a fingerprint found in the cache saves parsing that side
+    found = []
+    for source in (a, b):
+        large = len(source) >= FINGERPRINT_MIN_SIZE
+        seen, fingerprint = _cached_fingerprint(_source_digest(source), large)
+        found.append(fingerprint is not None or (seen and large))
+    return "fingerprint" if any(found) else "walk"
+
+
+def _equal_input(value):
+    if isinstance(value, os.PathLike):
+        return _read_source(value)
+    return value
+
+
+def ast_equal(a, b, strategy=None):
+    """Return whether ast_diff(a, b) finds no difference.
+
+    a and b are trees, sources as str or bytes, binary dumps or
+    os.PathLike paths of files holding either.  The cheapest way to
+    answer is picked from the inputs and the fingerprint cache:
+
+    - the same object or the same source is equal without parsing,
+    - two binary dumps are compared in their flattened form ("flat"),
+    - sources with a cached fingerprint on either side, or long enough
+      and seen before, are compared by fingerprint ("fingerprint"),
+      parsing only the side not cached yet and caching it,
+    - anything else is parsed and walked as by ast_diff ("walk").
+
+    strategy forces one of "flat", "fingerprint" or "walk", which all
+    give the same answer.
+    """
+    if a is b:
+        return True
+    a = _equal_input(a)
+    b = _equal_input(b)
+    if not isinstance(a, ast.AST) and type(a) is type(b) and a == b:
+        return True
+    if strategy is None:
+        strategy = _equal_strategy(a, b)
+    if strategy == "flat":
+        return _flat_input(a) == _flat_input(b)
+    if strategy == "fingerprint":
+        return _fingerprint_input(a) == _fingerprint_input(b)
+    if strategy != "walk":
+        raise ValueError("unknown strategy %r" % (strategy,))
+    if not isinstance(a, ast.AST):
+        a = _parse_source(a)
+    if not isinstance(b, ast.AST):
+        b = _parse_source(b)
+    return ast_diff(a, b) is None
+
+
+def _flat_input(value):
+    if isinstance(value, ast.AST):
+        return flatten(value)
+    if _is_dump(value):
+        return load_binary(value, flat=True)
+    return flatten(_parse_source(value))
+
+
+def _fingerprint_input(value):
+    if isinstance(value, ast.AST):
+        return tree_fingerprint(value)
+    return _source_fingerprint(value)
+
+
+def _ignored_fields(names):
+    ignored = set()
+    for qualname in names:
+        name, _, field = qualname.partition(".")
+        cls = getattr(ast, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, ast.AST)):
+            raise ValueError("unknown node type in %r" % qualname)
+        if field not in cls._fields:
+            raise ValueError("ast.%s has no field %r" % (name, field))
+        if field in _SPECIAL_DIFFS.get(name, (None, ()))[1] or (
+            (name, field) in _UNCHECKED_FIELDS
+        ):
+            # the hand-written checks compare these together with others
+            raise ValueError("ast.%s.%s cannot be ignored" % (name, field))
+        ignored.add((name, field))
+    return frozenset(ignored)
+
+
+class Differ:
+    """ast_diff with a fixed set of options compiled once.
+
+    ignore_fields holds "Class.field" names (e.g. "arg.annotation") that
+    are neither compared nor walked into, except for fields compared by
+    the hand-written checks such as those of function definitions.
+    ignore_local_names and unordered_fields are as for ast_diff and
+    max_differences limits the number of records differences() returns.
+
+    The options end up in specialized comparators generated once per
+    set of options and shared by all instances using it, so nothing is
+    checked per node at diff time.  Instances can be shared between
+    threads; calls, different and seconds count the diffs done so far.
+    """
+
+    def __init__(
+        self,
+        ignore_fields=(),
+        ignore_local_names=False,
+        max_differences=None,
+        unordered_fields=(),
+    ):
+        self.ignore_fields = _ignored_fields(ignore_fields)
+        self.ignore_local_names = ignore_local_names
+        self.unordered = _unordered_groups(unordered_fields)
+        self.max_differences = max_differences
+        self._node_diff = _make_node_diff(ignore_fields=self.ignore_fields)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.different = 0
+        self.seconds = 0.0
+
+    def _differ(self, tree1, tree2):
+        if not self.ignore_local_names:
+            return self._node_diff
+        return _make_node_diff(
+            True, _local_names(tree1), _local_names(tree2), self.ignore_fields
+        )
+
+    def _count(self, start, different):
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.different += different
+            self.seconds += seconds
+
+    def diff(self, tree1, tree2):
+        """Return the first difference as ast_diff does, or None."""
+        start = time.perf_counter()
+        if self.unordered:
+            diff = next(self._differences(tree1, tree2), None)
+            result = None if diff is None else diff.as_tuple()
+        else:
+            result = _first_difference(
+                _walk(tree1, self.ignore_fields),
+                _walk(tree2, self.ignore_fields),
+                self._differ(tree1, tree2),
+            )
+        self._count(start, result is not None)
+        return result
+
+    def diff_sources(self, source1, source2):
+        """diff() of two sources, str or bytes, or binary dumps."""
+        return self.diff(_parse_source(source1), _parse_source(source2))
+
+    def diff_files(self, fname1, fname2):
+        return self.diff_sources(_read_source(fname1), _read_source(fname2))
+
+    def differences(self, tree1, tree2):
+        """Return the Difference records of iter_differences, at most
+        max_differences of them."""
+        start = time.perf_counter()
+        differences = list(
+            islice(self._differences(tree1, tree2), self.max_differences)
+        )
+        self._count(start, bool(differences))
+        return differences
+
+    def _differences(self, tree1, tree2):
+        return _iter_differences(
+            tree1,
+            tree2,
+            self._differ(tree1, tree2),
+            self.ignore_fields,
+            unordered=self.unordered,
+        )
+
+    @property
+    def counters(self):
+        """A consistent snapshot of the counters."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "different": self.different,
+                "seconds": self.seconds,
+            }
+
+
+class Reference:
+    """A tree indexed once for comparing it with many candidates.
+
+    The nodes are kept in ast.walk order along with the flattened form
+    and its subtree hashes, so diff() only walks the candidate.
+    Candidates given as binary dumps that are equal to the reference
+    are recognized from their flattened form without building nodes.
+    """
+
+    def __init__(self, tree, _index=None):
+        self.tree = tree
+        if _index is None:
+            entries = flatten(tree)
+            hashes, sizes = subtree_hashes(entries)
+        else:
+            entries, hashes, sizes = _index
+        self.entries = entries
+        self.hashes = hashes
+        self.sizes = sizes
+        self.nodes = list(ast.walk(tree))
+        self._names = None
+
+    @classmethod
+    def from_source(cls, source):
+        return cls(_parse_source(source))
+
+    @property
+    def digest(self):
+        """Hash of the whole tree, equal for trees ast_diff finds equal."""
+        return self.hashes[0]
+
+    def diff(self, candidate, ignore_local_names=False):
+        """Return what ast_diff(reference, candidate) returns.
+
+        candidate is a tree or its source, possibly a binary dump.
+        """
+        if not isinstance(candidate, ast.AST):
+            if _is_dump(candidate):
+                if load_binary(candidate, flat=True) == self.entries:
+                    return None
+                candidate = load_binary(candidate)
+            else:
+                candidate = ast.parse(candidate)
+        node_diff = _node_diff
+        if ignore_local_names:
+            if self._names is None:
+                self._names = _local_names(self.tree)
+            node_diff = _make_node_diff(True, self._names, _local_names(candidate))
+        return _first_difference(self.nodes, ast.walk(candidate), node_diff)
+
+    def dumps(self):
+        """Serialize the reference and its index for another process."""
+        return marshal.dumps(
+            (dump_binary(self.tree, positions=True), self.hashes, self.sizes)
+        )
+
+    @classmethod
+    def loads(cls, buf):
+        dump, hashes, sizes = marshal.loads(buf)
+        return cls(load_binary(dump), (load_binary(dump, flat=True), hashes, sizes))
+
+    def diff_many(self, candidates, jobs=None, ignore_local_names=False):
+        """Return the diff() result for each of a sequence of sources.
+
+        Identical sources are only compared once.  On jobs worker
+        processes the reference reaches each worker once through shared
+        memory instead of being pickled along with every candidate.
+        """
+        unique = {}
+        for source in candidates:
+            if isinstance(source, str):
+                source = source.encode("utf-8")
+            unique.setdefault(source, None)
+        sources = list(unique)
+        jobs = jobs or os.cpu_count() or 1
+        if jobs == 1 or len(sources) <= 1 or _gil_disabled():
+            # threads share the reference as it is
+            results = _parallel_map(
+                lambda source: self.diff(source, ignore_local_names), sources, jobs
+            )
+        else:
+            from multiprocessing import shared_memory
+
+            buf = self.dumps()
+            shm = shared_memory.SharedMemory(create=True, size=len(buf))
+            try:
+                shm.buf[: len(buf)] = buf
+                results = _parallel_map(
+                    _diff_with_reference,
+                    [(source, ignore_local_names) for source in sources],
+                    jobs,
+                    initializer=_attach_reference,
+                    initargs=(shm.name, len(buf)),
+                )
+            finally:
+                shm.close()
+                shm.unlink()
+        unique = dict(zip(sources, results))
+        return [
+            unique[source.encode("utf-8") if isinstance(source, str) else source]
+            for source in candidates
+        ]
+
+
+# the Reference of a diff_many worker process
+_worker_reference = None
+
+
+def _attach_reference(name, size):
+    global _worker_reference
+    from multiprocessing import shared_memory
+
+    # the parent owns the segment and unlinks it once the pool is done
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        _worker_reference = Reference.loads(bytes(shm.buf[:size]))
+    finally:
+        shm.close()
+
+
+def _diff_with_reference(task):
+    source, ignore_local_names = task
+    return _worker_reference.diff(source, ignore_local_names)
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _first_ending_after(body, line):
+    # statements of a body are in source order, so their end lines are
+    # sorted and bisectable
+    lo = 0
+    hi = len(body)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if body[mid].end_lineno < line:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _prune_body(body, ranges):
+    kept = []
+    seen = set()
+    for start, end in ranges:
+        for i in range(_first_ending_after(body, start), len(body)):
+            if _statement_start(body[i]) > end:
+                break
+            if i not in seen:
+                seen.add(i)
+                kept.append(i)
+    return [_prune(body[i], ranges) for i in sorted(kept)]
+
+
+def _prune(node, ranges):
+    pruned = None
+    for field, value in ast.iter_fields(node):
+        if not isinstance(value, list) or not value:
+            continue
+        if isinstance(value[0], (ast.stmt, ast.excepthandler)):
+            value = _prune_body(value, ranges)
+        elif isinstance(value[0], getattr(ast, "match_case", ())):
+            value = [_prune(case, ranges) for case in value]
+        else:
+            continue
+        if pruned is None:
+            pruned = copy.copy(node)
+        setattr(pruned, field, value)
+    return node if pruned is None else pruned
+
+
+def restrict_to_ranges(tree, ranges):
+    """Return a copy of tree keeping only statements overlapping ranges.
+
+    ranges are inclusive (first, last) line pairs.  Statement lists are
+    searched with bisect and statements outside of the ranges are left
+    out without visiting them, so the cost depends on the number of
+    statements kept rather than on the size of the tree.  Nodes that
+    are kept are shallow copies sharing their other children with tree.
+    """
+    return _prune(tree, _merge_ranges(ranges))
+
+
+_HUNK_HEADER = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def _hunk_range(start, count):
+    start = int(start)
+    count = 1 if count is None else int(count)
+    return (start, start + count - 1) if count else None
+
+
+def parse_patch(lines):
+    """Return {path: (ranges1, ranges2)} for the hunks of a unified diff.
+
+    Paths are taken from the "+++" lines with git's "b/" prefix removed,
+    or from the "---" line for deleted files.  Ranges are inclusive line
+    pairs of the old and new side, pure insertions and deletions have no
+    range on the side they are missing from.
+    """
+    patch = {}
+    old_path = None
+    ranges = None
+    for line in lines:
+        if line.startswith("--- "):
+            old_path = line[4:].split("\t")[0].strip()
+        elif line.startswith("+++ ") and old_path is not None:
+            path = line[4:].split("\t")[0].strip()
+            if path == "/dev/null":
+                path = old_path
+            if path.startswith(("a/", "b/")):
+                path = path[2:]
+            ranges = patch.setdefault(path, ([], []))
+            old_path = None
+        elif ranges is not None:
+            m = _HUNK_HEADER.match(line)
+            if m:
+                for side, (start, count) in zip(ranges, [m.group(1, 2), m.group(3, 4)]):
+                    hunk = _hunk_range(start, count)
+                    if hunk is not None:
+                        side.append(hunk)
+    return patch
+
+
+def parse_ranges(spec):
+    """Parse "10-20,30" into [(10, 20), (30, 30)]."""
+    ranges = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+class ResultCache:
+    """LRU cache of ast_diff results keyed on the digests of both sources.
+
+    With directory given, results are also kept there as small json files
+    so that they survive across processes.  Keys include the Python
+    version, whose trees and messages differ, so that a directory can be
+    shared between versions.
+    """
+
+    def __init__(self, maxsize=1024, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(source1, source2, options=()):
+        h = hashlib.sha256(b"%d\0%d.%d\0" % ((CACHE_VERSION,) + sys.version_info[:2]))
+        for source in (source1, source2):
+            if isinstance(source, str):
+                source = source.encode("utf-8")
+            h.update(hashlib.sha256(source).digest())
+        h.update(repr(tuple(options)).encode("utf-8"))
+        return h.hexdigest()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def lookup(self, key):
+        """Return (found, result) where result is None for equal trees."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+        if self.directory is not None:
+            try:
+                with open(self._path(key)) as f:
+                    result = json.load(f)["result"]
+            except (OSError, ValueError, KeyError):
+                pass
+            else:
+                if result is not None:
+                    pos1, pos2, message = result
+                    result = (
+                        None if pos1 is None else tuple(pos1),
+                        None if pos2 is None else tuple(pos2),
+                        message,
+                    )
+                self._remember(key, result)
+                with self._lock:
+                    self.hits += 1
+                return True, result
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def store(self, key, result):
+        self._remember(key, result)
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"result": result}, f)
+            os.replace(tmp, path)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class Journal:
+    """Results of the file pairs a batch run has finished, one json line
+    each, so that an interrupted run can resume.
+
+    Entries are keyed on both paths, the digests of both files and the
+    options of the run: resuming skips the pairs done with the same
+    content and redoes those that changed.  An entry holds the exit
+    status of the pair, the output it printed and the counts it added
+    to a summary, all the final report needs.
+
+    A pair is also noted as started before it is compared, so that a
+    pair which took the process down is known on resume and not tried
+    over and over.
+    """
+
+    def __init__(self, fname, resume=False):
+        self.fname = fname
+        self.entries = {}
+        self._started = set()
+        torn = False
+        if resume and os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a run killed while writing it
+                        continue
+                    if "started" in entry:
+                        self._started.add(entry["started"])
+                    else:
+                        self.entries[entry["key"]] = entry
+        self._file = open(fname, "a" if resume else "w")
+        if torn:
+            self._file.write("\n")
+
+    @staticmethod
+    def key(fname1, fname2, options):
+        digests = [
+            None if fname is None else hashlib.sha256(_read_source(fname)).hexdigest()
+            for fname in (fname1, fname2)
+        ]
+        return json.dumps([fname1, fname2] + digests + [options], sort_keys=True)
+
+    def lookup(self, key):
+        return self.entries.get(key)
+
+    def unfinished(self, key):
+        """Tell whether an earlier run started the pair and never
+        recorded its result."""
+        return key in self._started and key not in self.entries
+
+    def start(self, key):
+        self._file.write(json.dumps({"started": key}) + "\n")
+        # no fsync, a lost entry only means trying the pair once more
+        self._file.flush()
+
+    def record(self, key, status, output, counts=()):
+        entry = {"key": key, "status": status, "output": output, "counts": counts}
+        self.entries[key] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        # a preempted machine should not lose the pairs reported done
+        os.fsync(self._file.fileno())
+        return entry
+
+    def close(self):
+        self._file.close()
+
+
+class _Tee(io.StringIO):
+    """Keep what is written while passing it through to stream."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def write(self, s):
+        self.stream.write(s)
+        return super().write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def ast_parse_file(fname):
+    with open(fname) as f:
+        return ast.parse(f.read())
+
+
+def _read_source(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+def _parse_source(source):
+    # baselines may be stored as binary dumps
+    if _is_dump(source):
+        return load_binary(source)
+    return ast.parse(source)
+
+
+def _iter_files(root, suffixes=(".py",)):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(suffixes):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def _iter_pairs(path1, path2, suffixes=(".py",)):
+    # a pair of directories is compared file by file, None marks the side
+    # a file is missing from
+    if not (os.path.isdir(path1) and os.path.isdir(path2)):
+        yield path1, path2
+        return
+    files1 = dict(_iter_files(path1, suffixes))
+    files2 = dict(_iter_files(path2, suffixes))
+    for relpath in sorted(files1.keys() | files2.keys()):
+        yield files1.get(relpath), files2.get(relpath)
+
+
+def _file_sketch(fname):
+    try:
+        return minhash(_parse_source(_read_source(fname)))
+    except (SyntaxError, ValueError):
+        return None
+
+
+def _pair_renamed(pairs, threshold=RENAME_THRESHOLD):
+    # turn removed and added python files of similar content into pairs,
+    # each in the place of the added one; return the new list of pairs
+    # and {pair: similarity}
+    sketches1 = {}
+    sketches2 = {}
+    for fname1, fname2 in pairs:
+        fname = fname1 or fname2
+        if (fname1 is None or fname2 is None) and fname.endswith(".py"):
+            sketch = _file_sketch(fname)
+            if sketch is not None:
+                (sketches1 if fname2 is None else sketches2)[fname] = sketch
+    renamed = {}
+    partners = {}
+    for fname1, fname2, score in pair_renames(sketches1, sketches2, threshold):
+        renamed[fname1, fname2] = score
+        partners[fname2] = fname1
+    moved = set(partners.values())
+    result = []
+    for fname1, fname2 in pairs:
+        if fname2 is None and fname1 in moved:
+            continue
+        if fname1 is None and fname2 in partners:
+            fname1 = partners[fname2]
+        result.append((fname1, fname2))
+    return result, renamed
+
+
+def _print_rename(fname1, fname2, score, output_format="text", counter=None):
+    if counter is not None:
+        counter["renamed file"] += 1
+    elif output_format == "jsonl":
+        _write_json(
+            {
+                "type": "rename",
+                "file1": fname1,
+                "file2": fname2,
+                "similarity": score,
+            }
+        )
+    else:
+        print("renamed %s %s (%d%% similar)" % (fname1, fname2, score * 100))
+
+
+def _print_error(fname1, fname2, message, output_format="text", counter=None):
+    if counter is not None:
+        counter["error file"] += 1
+    elif output_format == "jsonl":
+        _write_json(
+            {
+                "type": "pair",
+                "file1": fname1,
+                "file2": fname2,
+                "status": "error",
+                "message": message,
+            }
+        )
+    else:
+        print("%s %s: %s" % (fname1, fname2, message))
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, ast.AST):
+        # the type and position of a node, dumping whole subtrees would
+        # make records of any size
+        node = {"node_type": type(value).__name__}
+        for attr in ("lineno", "col_offset"):
+            if hasattr(value, attr):
+                node[attr] = getattr(value, attr)
+        return node
+    if isinstance(value, list):
+        items = [_json_value(item) for item in value[:JSON_MAX_ITEMS]]
+        if len(value) > JSON_MAX_ITEMS:
+            items.append("%d more" % (len(value) - JSON_MAX_ITEMS))
+        return items
+    return repr(value)
+
+
+def _write_json(record):
+    sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+
+
+def _difference_record(fname1, fname2, diff, indexes=None):
+    record = {
+        "type": "difference",
+        "file1": fname1,
+        "file2": fname2,
+        "kind": diff.kind,
+        "node_type": diff.node_type,
+        "field": diff.field,
+        "old": _json_value(diff.old),
+        "new": _json_value(diff.new),
+        "pos1": diff.pos1,
+        "pos2": diff.pos2,
+        "message": diff.message,
+    }
+    if indexes is not None:
+        located = diff.locate(*indexes)
+        for name in [
+            "end1",
+            "end2",
+            "column1",
+            "end_column1",
+            "column2",
+            "end_column2",
+            "excerpt1",
+            "excerpt2",
+        ]:
+            record[name] = getattr(located, name)
+    return record
+
+
+def _cache_options(ignore_local_names, ranges=None, unordered_fields=()):
+    options = ("ignore_local_names",) if ignore_local_names else ()
+    if unordered_fields:
+        options += ("unordered", tuple(sorted(unordered_fields)))
+    if ranges is not None:
+        options += ("ranges", tuple(tuple(side) for side in ranges))
+    return options
+
+
+def _parse_pair(source1, source2, ranges=None, budget=None):
+    if budget is None:
+        ast1 = _parse_source(source1)
+        ast2 = _parse_source(source2)
+    else:
+        # parsing cannot be stopped half way, but deeply nested sources
+        # give up with one of these instead of taking a worker down
+        try:
+            budget.check()
+            ast1 = _parse_source(source1)
+            budget.check()
+            ast2 = _parse_source(source2)
+            budget.check()
+        except (RecursionError, MemoryError) as e:
+            raise _BudgetExceeded("parse failed: %s" % type(e).__name__)
+    if ranges is not None:
+        ast1 = restrict_to_ranges(ast1, ranges[0])
+        ast2 = restrict_to_ranges(ast2, ranges[1])
+    return ast1, ast2
+
+
+def _make_budget(max_nodes=None, timeout=None):
+    if max_nodes is None and timeout is None:
+        return None
+    return Budget(max_nodes, timeout)
+
+
+def _render_lines(lines, budget=None):
+    # rendering only counts against the deadline of the budget, and
+    # stops at its max_render characters
+    if budget is None:
+        yield from lines
+        return
+    size = 0
+    for line in lines:
+        budget.check()
+        size += len(line) + 1
+        if budget.max_render is not None and size > budget.max_render:
+            raise _BudgetExceeded("dump longer than %d characters" % budget.max_render)
+        yield line
+
+
+def _main_jsonl(
+    fname1,
+    fname2,
+    cache=None,
+    ignore_local_names=False,
+    ranges=None,
+    stats=None,
+    budget=None,
+    locations=False,
+    unordered_fields=(),
+):
+    if fname1 is None or fname2 is None:
+        status = "added" if fname1 is None else "removed"
+        _write_json(
+            {"type": "pair", "file1": fname1, "file2": fname2, "status": status}
+        )
+        return 1
+    with _phase(stats, "read"):
+        source1 = _read_source(fname1)
+        source2 = _read_source(fname2)
+    found = False
+    if cache is not None:
+        key = cache.key(
+            source1,
+            source2,
+            _cache_options(ignore_local_names, ranges, unordered_fields),
+        )
+        found, result = cache.lookup(key)
+    count = 0
+    reason = None
+    indexes = None
+    if not found or result is not None:
+        first = None
+        try:
+            with _phase(stats, "parse"):
+                ast1, ast2 = _parse_pair(source1, source2, ranges, budget)
+        except _BudgetExceeded as e:
+            reason = str(e)
+        else:
+            with _phase(stats, "diff"):
+                for diff in iter_differences(
+                    ast1, ast2, ignore_local_names, budget, unordered_fields
+                ):
+                    if locations and indexes is None:
+                        # one index per file, for all its differences
+                        indexes = _line_index(source1), _line_index(source2)
+                    _write_json(_difference_record(fname1, fname2, diff, indexes))
+                    if diff.kind == "inconclusive":
+                        reason = diff.old
+                        break
+                    if first is None:
+                        first = diff.as_tuple()
+                    count += 1
+        if cache is not None and not found and reason is None:
+            cache.store(key, first)
+    record = {
+        "type": "pair",
+        "file1": fname1,
+        "file2": fname2,
+        "status": "different" if count else "equal",
+        "differences": count,
+    }
+    if reason is not None:
+        record["status"] = "inconclusive"
+        record["reason"] = reason
+    _write_json(record)
+    return 1 if count or reason is not None else 0
+
+
+def _summarize_pair(
+    fname1,
+    fname2,
+    counter,
+    cache=None,
+    ignore_local_names=False,
+    ranges=None,
+    stats=None,
+    budget=None,
+    unordered_fields=(),
+):
+    if fname1 is None or fname2 is None:
+        counter["added file" if fname1 is None else "removed file"] += 1
+        return 1
+    with _phase(stats, "read"):
+        source1 = _read_source(fname1)
+        source2 = _read_source(fname2)
+    found = False
+    if cache is not None:
+        key = cache.key(
+            source1,
+            source2,
+            _cache_options(ignore_local_names, ranges, unordered_fields),
+        )
+        found, result = cache.lookup(key)
+        if found and result is None:
+            return 0
+    total = sum(counter.values())
+    try:
+        with _phase(stats, "parse"):
+            ast1, ast2 = _parse_pair(source1, source2, ranges, budget)
+    except _BudgetExceeded:
+        counter["inconclusive"] += 1
+        return 1
+    with _phase(stats, "diff"):
+        summarize(ast1, ast2, counter, ignore_local_names, budget, unordered_fields)
+    if sum(counter.values()) != total:
+        return 1
+    if cache is not None and not found:
+        # the first difference of unequal pairs is not known here
+        cache.store(key, None)
+    return 0
+
+
+def _print_summary(counter, output_format="text"):
+    if output_format == "jsonl":
+        _write_json({"type": "summary", "counts": dict(counter.most_common())})
+        return
+    for label, count in counter.most_common():
+        print("%d %s" % (count, label))
+
+
+def main(
+    fname1,
+    fname2,
+    jobs=None,
+    cache=None,
+    output_format="text",
+    ignore_local_names=False,
+    ranges=None,
+    stats=None,
+    max_nodes=None,
+    timeout=None,
+    locations=False,
+    unordered_fields=(),
+):
+    # every pair gets a budget of its own
+    budget = _make_budget(max_nodes, timeout)
+    if output_format == "jsonl":
+        return _main_jsonl(
+            fname1,
+            fname2,
+            cache=cache,
+            ignore_local_names=ignore_local_names,
+            ranges=ranges,
+            stats=stats,
+            budget=budget,
+            locations=locations,
+            unordered_fields=unordered_fields,
+        )
+    if fname1 is None:
+        print("added %s" % fname2)
+        return 1
+    if fname2 is None:
+        print("removed %s" % fname1)
+        return 1
+    with _phase(stats, "read"):
+        source1 = _read_source(fname1)
+        source2 = _read_source(fname2)
+    ast1 = ast2 = None
+    found = False
+    if cache is not None:
+        key = cache.key(
+            source1,
+            source2,
+            _cache_options(ignore_local_names, ranges, unordered_fields),
+        )
+        found, result = cache.lookup(key)
+    if not found:
+        try:
+            with _phase(stats, "parse"):
+                ast1, ast2 = _parse_pair(source1, source2, ranges, budget)
+        except _BudgetExceeded as e:
+            result = Inconclusive(None, None, str(e), budget.nodes)
+        else:
+            with _phase(stats, "diff"):
+                if jobs is None:
+                    result = ast_diff(
+                        ast1,
+                        ast2,
+                        ignore_local_names,
+                        budget,
+                        unordered_fields=unordered_fields,
+                    )
+                else:
+                    result = ast_diff_parallel(
+                        ast1,
+                        ast2,
+                        jobs=jobs,
+                        ignore_local_names=ignore_local_names,
+                        # restricted trees no longer match their sources
+                        sources=(source1, source2) if ranges is None else None,
+                    )
+        if cache is not None and not isinstance(result, Inconclusive):
+            cache.store(key, result)
+    if isinstance(result, Inconclusive):
+        print(result)
+        return 1
+    if result is not None:
+        print(result)
+        try:
+            if ast1 is None:
+                with _phase(stats, "parse"):
+                    ast1, ast2 = _parse_pair(source1, source2, ranges, budget)
+            with _phase(stats, "dump"):
+                lines1 = list(_render_lines(iter_dump(ast1), budget))
+                lines2 = list(_render_lines(iter_dump(ast2), budget))
+            with _phase(stats, "unified_diff"):
+                lines = list(
+                    _render_lines(
+                        unified_diff(
+                            lines1,
+                            lines2,
+                            fromfile=fname1,
+                            tofile=fname2,
+                            lineterm="",
+                            budget=budget,
+                        ),
+                        budget,
+                    )
+                )
+        except _BudgetExceeded as e:
+            print("dump diff skipped: %s" % e)
+        else:
+            print("\n".join(lines))
+        return 1
+    if (
+        ast1 is not None
+        and not (ignore_local_names or unordered_fields)
+        and budget is None
+    ):
+        with _phase(stats, "assert"):
+            # cross-check of the comparators against the flattened form
+            assert ast_equal(ast1, ast2, strategy="flat")
+    return 0
+
+
+def _moves_pair(
+    fname1, fname2, min_size=MOVE_MIN_SIZE, output_format="text", stats=None
+):
+    if fname1 is None or fname2 is None:
+        return main(fname1, fname2, output_format=output_format)
+    with _phase(stats, "read"):
+        source1 = _read_source(fname1)
+        source2 = _read_source(fname2)
+    with _phase(stats, "parse"):
+        ast1 = _parse_source(source1)
+        ast2 = _parse_source(source2)
+    with _phase(stats, "diff"):
+        moves, removed, added = find_moves(ast1, ast2, min_size=min_size)
+    for pos1, pos2, node_type in moves:
+        if output_format == "jsonl":
+            _write_json(
+                {
+                    "type": "move",
+                    "file1": fname1,
+                    "file2": fname2,
+                    "node_type": node_type,
+                    "pos1": pos1,
+                    "pos2": pos2,
+                }
+            )
+        else:
+            print(
+                "moved %s:%d:%d %s:%d:%d %s"
+                % ((fname1,) + pos1 + (fname2,) + pos2 + (node_type,))
+            )
+    for status, fname, edits in [
+        ("removed", fname1, removed),
+        ("added", fname2, added),
+    ]:
+        for pos, node_type in edits:
+            if output_format == "jsonl":
+                _write_json(
+                    {
+                        "type": status,
+                        "file": fname,
+                        "node_type": node_type,
+                        "pos": pos,
+                    }
+                )
+            else:
+                print("%s %s:%d:%d %s" % ((status, fname) + pos + (node_type,)))
+    return 1 if moves or removed or added else 0
+
+
+def _stream_pair(fname1, fname2, ignore_local_names=False, stats=None):
+    if fname1 is None or fname2 is None:
+        return main(fname1, fname2)
+    with _phase(stats, "diff"):
+        result = ast_diff_stream(fname1, fname2, ignore_local_names)
+    if result is None:
+        return 0
+    # no dump diff, that would take both whole trees
+    print(result)
+    return 1
+
+
+def _patch_ranges(patch, fname1, fname2, single):
+    for fname in (fname2, fname1):
+        if fname is None:
+            continue
+        fname = fname.replace(os.sep, "/")
+        for path, ranges in patch.items():
+            if fname == path or fname.endswith("/" + path):
+                return ranges
+    if single and len(patch) == 1:
+        # comparing two files, possibly temporary copies, with a patch of
+        # one file
+        return next(iter(patch.values()))
+    return None
+
+
+class PhaseStats:
+    """Wall time and peak memory of the phases of comparing file pairs.
+
+    Memory is traced with tracemalloc, started here unless already
+    running, which slows everything down noticeably.  peak is the
+    highest traced memory during a phase above what was allocated when
+    it started.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.pairs = []
+        self._phases = None
+        self._started = memory and not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+
+    def start_pair(self, fname1, fname2):
+        self._phases = {}
+        self.pairs.append({"file1": fname1, "file2": fname2, "phases": self._phases})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self._phases is None:
+            self.start_pair(None, None)
+        if self.memory:
+            base = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self._phases.setdefault(name, {"seconds": 0.0, "peak": None})
+            entry["seconds"] += time.perf_counter() - start
+            if self.memory:
+                peak = max(tracemalloc.get_traced_memory()[1] - base, 0)
+                entry["peak"] = max(entry["peak"] or 0, peak)
+
+    def totals(self):
+        totals = {}
+        for pair in self.pairs:
+            for name, entry in pair["phases"].items():
+                total = totals.setdefault(name, {"seconds": 0.0, "peak": None})
+                total["seconds"] += entry["seconds"]
+                if entry["peak"] is not None:
+                    total["peak"] = max(total["peak"] or 0, entry["peak"])
+        return totals
+
+    def stop(self):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+
+def _phase(stats, name):
+    return contextlib.nullcontext() if stats is None else stats.phase(name)
+
+
+def _print_phases(title, phases):
+    print(title, file=sys.stderr)
+    for name, entry in phases.items():
+        if entry["peak"] is None:
+            peak = ""
+        else:
+            peak = "  peak %10.1f KiB" % (entry["peak"] / 1024)
+        print("  %-12s %9.3fs%s" % (name, entry["seconds"], peak), file=sys.stderr)
+
+
+def _print_stats(cache):
+    if cache is not None:
+        print(
+            "cache: %d hits, %d misses, hit rate %.1f%%"
+            % (cache.hits, cache.misses, cache.hit_rate * 100),
+            file=sys.stderr,
+        )
+
+
+def _write_trace(fname, stats, cache):
+    trace = {"pairs": stats.pairs, "totals": stats.totals()}
+    if cache is not None:
+        trace["cache"] = {"hits": cache.hits, "misses": cache.misses}
+    with open(fname, "w") as f:
+        json.dump(trace, f, indent=1)
+
+
+def _dump_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="astdiff dump",
+        description="store the ast of SOURCE in a binary dump usable as file1",
+        epilog="dumps are only readable by the Python version that wrote them "
+        "and must not be loaded from untrusted sources",
+    )
+    parser.add_argument("source")
+    parser.add_argument("output")
+    parser.add_argument("--positions", action="store_true")
+    parser.add_argument("--compression", choices=["zlib", "lzma"])
+    args = parser.parse_args(argv)
+    buf = dump_binary(
+        ast.parse(_read_source(args.source)),
+        positions=args.positions,
+        compression=args.compression,
+    )
+    with open(args.output, "wb") as f:
+        f.write(buf)
+    return 0
+
+
+def cli(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["index"]:
+        from ast_diff.index import index_cli
+
+        return index_cli(argv[1:])
+    if argv[:1] == ["dump"]:
+        return _dump_cli(argv[1:])
+    if argv[:1] == ["clones"]:
+        from ast_diff.clones import clones_cli
+
+        return clones_cli(argv[1:])
+    parser = argparse.ArgumentParser(prog="astdiff")
+    parser.add_argument("file1", help="file or directory")
+    parser.add_argument("file2", help="file or directory")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="compare chunks of the module body on JOBS workers",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="reuse results of earlier comparisons stored in CACHE_DIR",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print cache statistics and the time and peak memory of each "
+        "phase to stderr",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write the time and peak memory of each phase to FILE as json",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="jsonl writes one json object per difference and per file pair",
+    )
+    parser.add_argument(
+        "--locations",
+        action="store_true",
+        help="add the end positions, character columns and source excerpts "
+        "of both nodes to the jsonl difference records",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="only print how often each kind of difference occurs",
+    )
+    parser.add_argument(
+        "--moves",
+        action="store_true",
+        help="report moved code separately from edited statements",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=MOVE_MIN_SIZE,
+        help="smallest subtree in nodes reported as moved (default %(default)s)",
+    )
+    parser.add_argument(
+        "--ignore-local-names",
+        action="store_true",
+        help="treat code differing only by renamed function locals as equal",
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="compare imported names, set elements, dict items and class "
+        "decorators regardless of order",
+    )
+    parser.add_argument(
+        "--unordered-fields",
+        metavar="FIELDS",
+        help="compare the list fields FIELDS, e.g. Set.elts,List.elts, "
+        "regardless of order instead",
+    )
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        metavar="N",
+        help="give up on a pair as inconclusive after comparing N nodes",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up on a pair as inconclusive after SECONDS, counting the "
+        "time spent parsing and rendering",
+    )
+    parser.add_argument(
+        "--renames",
+        action="store_true",
+        help="pair removed and added files of similar content in directories",
+    )
+    parser.add_argument(
+        "--rename-threshold",
+        type=float,
+        default=RENAME_THRESHOLD,
+        metavar="SHARE",
+        help="least estimated share of common subtrees of renamed files "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="parse and compare giant files a chunk of top-level statements "
+        "at a time, only printing the first difference",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="FILE",
+        help="record the result of every finished file pair in FILE",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="reuse the results in the --journal of an earlier run for the "
+        "pairs whose files did not change, pairs that run started and never "
+        "finished are reported as errors",
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--ranges",
+        metavar="LINES",
+        help="only compare statements overlapping LINES, e.g. 10-20,30, "
+        "OLD:NEW for different lines on each side",
+    )
+    group.add_argument(
+        "--patch",
+        metavar="FILE",
+        help="only compare statements overlapping the hunks of the unified "
+        "diff in FILE, - for stdin; files not in the patch are skipped",
+    )
+    args = parser.parse_args(argv)
+    if args.moves and (args.ranges or args.patch):
+        parser.error("--moves compares whole files")
+    if args.locations and (args.format != "jsonl" or args.summary or args.moves):
+        parser.error("--locations only applies to the jsonl difference records")
+    budgeted = args.max_nodes is not None or args.timeout is not None
+    if budgeted and (args.moves or args.jobs is not None):
+        parser.error("--max-nodes and --timeout do not apply to --moves and -j")
+    unordered_fields = ()
+    if args.unordered_fields:
+        unordered_fields = tuple(args.unordered_fields.split(","))
+    elif args.unordered:
+        unordered_fields = UNORDERED_FIELDS
+    if unordered_fields:
+        if args.moves or args.jobs is not None:
+            parser.error("--unordered does not apply to --moves and -j")
+        try:
+            _unordered_groups(unordered_fields)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.stream and (
+        args.summary
+        or args.moves
+        or args.format == "jsonl"
+        or args.ranges
+        or args.patch
+        or args.jobs is not None
+        or budgeted
+        or unordered_fields
+    ):
+        parser.error("--stream only compares whole files for the first difference")
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    patch = None
+    ranges = None
+    if args.patch == "-":
+        patch = parse_patch(sys.stdin)
+    elif args.patch:
+        with open(args.patch) as f:
+            patch = parse_patch(f)
+    elif args.ranges:
+        spec1, _, spec2 = args.ranges.partition(":")
+        ranges = (parse_ranges(spec1), parse_ranges(spec2 or spec1))
+    single = not (os.path.isdir(args.file1) and os.path.isdir(args.file2))
+    cache = ResultCache(directory=args.cache_dir)
+    stats = PhaseStats() if args.stats or args.trace else None
+    counter = Counter()
+    status = 0
+    suffixes = (".py",) if args.moves else (".py", ".ipynb")
+    pairs = list(_iter_pairs(args.file1, args.file2, suffixes))
+    renamed = {}
+    if args.renames:
+        pairs, renamed = _pair_renamed(pairs, args.rename_threshold)
+    journal = None
+    keys = {}
+    if args.journal:
+        journal = Journal(args.journal, resume=args.resume)
+        options = {
+            name: getattr(args, name)
+            for name in [
+                "format",
+                "summary",
+                "moves",
+                "stream",
+                "min_size",
+                "ignore_local_names",
+                "max_nodes",
+                "timeout",
+                "locations",
+            ]
+        }
+        options["unordered"] = list(unordered_fields)
+        for fname1, fname2 in pairs:
+            if patch is not None:
+                ranges = _patch_ranges(patch, fname1, fname2, single)
+            options["ranges"] = ranges
+            keys[fname1, fname2] = Journal.key(fname1, fname2, options)
+    # notebooks are compared cell by cell, the cells of all of them in one
+    # batch up front
+    notebooks = [
+        (fname1, fname2)
+        for fname1, fname2 in pairs
+        if fname1 is not None
+        and fname2 is not None
+        and fname1.endswith(".ipynb")
+        and fname2.endswith(".ipynb")
+        and not (journal and journal.lookup(keys[fname1, fname2]))
+    ]
+    if notebooks:
+        from ast_diff.notebook import diff_notebooks, notebook_pair
+
+        if args.moves or ranges is not None or patch is not None:
+            parser.error("notebooks are compared as a whole, cell by cell")
+        notebooks = diff_notebooks(
+            notebooks,
+            jobs=args.jobs,
+            differences=args.summary or args.format == "jsonl",
+            ignore_local_names=args.ignore_local_names,
+            limits=(args.max_nodes, args.timeout) if budgeted else None,
+            unordered_fields=unordered_fields,
+        )
+
+    def compare(fname1, fname2, ranges):
+        if (fname1, fname2) in renamed:
+            _print_rename(
+                fname1,
+                fname2,
+                renamed[fname1, fname2],
+                args.format,
+                counter if args.summary else None,
+            )
+            return 1 | checked_pair(fname1, fname2, ranges)
+        return checked_pair(fname1, fname2, ranges)
+
+    def checked_pair(fname1, fname2, ranges):
+        try:
+            return compare_pair(fname1, fname2, ranges)
+        except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+            # one file that does not parse does not fail the whole run
+            _print_error(
+                fname1,
+                fname2,
+                "%s: %s" % (type(e).__name__, e),
+                args.format,
+                counter if args.summary else None,
+            )
+            return 1
+
+    def compare_pair(fname1, fname2, ranges):
+        if (fname1, fname2) in notebooks:
+            return notebook_pair(
+                fname1,
+                fname2,
+                notebooks[fname1, fname2],
+                args.format,
+                counter if args.summary else None,
+            )
+        if stats is not None:
+            stats.start_pair(fname1, fname2)
+        if args.moves:
+            pair_status = _moves_pair(
+                fname1, fname2, args.min_size, args.format, stats=stats
+            )
+        elif args.stream:
+            pair_status = _stream_pair(
+                fname1, fname2, args.ignore_local_names, stats=stats
+            )
+        elif args.summary:
+            pair_status = _summarize_pair(
+                fname1,
+                fname2,
+                counter,
+                cache=cache,
+                ignore_local_names=args.ignore_local_names,
+                ranges=ranges,
+                stats=stats,
+                budget=_make_budget(args.max_nodes, args.timeout),
+                unordered_fields=unordered_fields,
+            )
+        else:
+            pair_status = main(
+                fname1,
+                fname2,
+                jobs=args.jobs,
+                cache=cache,
+                output_format=args.format,
+                ignore_local_names=args.ignore_local_names,
+                ranges=ranges,
+                stats=stats,
+                max_nodes=args.max_nodes,
+                timeout=args.timeout,
+                locations=args.locations,
+                unordered_fields=unordered_fields,
+            )
+        if args.stats:
+            _print_phases("%s %s" % (fname1, fname2), stats.pairs[-1]["phases"])
+        return pair_status
+
+    for fname1, fname2 in pairs:
+        if patch is not None:
+            ranges = _patch_ranges(patch, fname1, fname2, single)
+            if ranges is None:
+                continue
+        if journal is None:
+            status |= compare(fname1, fname2, ranges)
+            continue
+        key = keys[fname1, fname2]
+        entry = journal.lookup(key)
+        if entry is None:
+            # the output of the pair goes to the journal as well, still
+            # printed as it comes
+            before = Counter(counter)
+            out = _Tee(sys.stdout)
+            with contextlib.redirect_stdout(out):
+                if journal.unfinished(key):
+                    # the pair took an earlier run down, it would again
+                    _print_error(
+                        fname1,
+                        fname2,
+                        "did not finish in an earlier run",
+                        args.format,
+                        counter if args.summary else None,
+                    )
+                    pair_status = 1
+                else:
+                    journal.start(key)
+                    pair_status = compare(fname1, fname2, ranges)
+            entry = journal.record(
+                key, pair_status, out.getvalue(), dict(counter - before)
+            )
+        else:
+            counter.update(entry["counts"])
+            sys.stdout.write(entry["output"])
+        status |= entry["status"]
+    if journal is not None:
+        journal.close()
+    if args.summary:
+        _print_summary(counter, args.format)
+    if stats is not None:
+        stats.stop()
+    if args.stats:
+        if len(stats.pairs) > 1:
+            _print_phases("total of %d pairs" % len(stats.pairs), stats.totals())
+        _print_stats(cache)
+    if args.trace:
+        _write_trace(args.trace, stats, cache)
+    return status
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("usage: %s file1 file2" % sys.argv[0])
-        sys.exit(-1)
-    fname1 = sys.argv[1]
-    fname2 = sys.argv[2]
-    sys.exit(main(fname1, fname2))
+    sys.exit(cli())
@@ -0,0 +1,323 @@
+import argparse
+import ast
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from ast_diff import (
+    _iter_files,
+    _parallel_map,
+    _read_source,
+    _statement_names,
+    _write_json,
+    flatten,
+    subtree_hashes,
+)
+
+# smallest statement, in nodes, worth reporting as a clone
+MIN_SIZE = 30
+INDEX_VERSION = 1
+INDEX_DIR = ".astdiff-clones"
+
+# subtree hash, file id, index of the root in the flattened file, size
+# in nodes, lineno, col_offset and end_lineno of the root
+RECORD = struct.Struct("<16s6I")
+
+
+def normalize_identifiers(tree):
+    """Replace the names of variables, arguments, functions and classes
+    by "_" in place, so that code only differing by them hashes equal.
+
+    Attribute names are kept, they tell which API the code uses.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            node.id = "_"
+        elif isinstance(node, ast.arg):
+            node.arg = "_"
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            node.name = "_"
+    return tree
+
+
+def hash_file(task):
+    """Return (nodes, records) of the statements of at least min_size
+    nodes in a file, records packed as RECORD with file id 0."""
+    path, min_size, normalize = task
+    tree = ast.parse(_read_source(path))
+    if normalize:
+        normalize_identifiers(tree)
+    entries, locations = flatten(tree, positions=True)
+    hashes, sizes = subtree_hashes(entries)
+    stmts = _statement_names()
+    records = bytearray()
+    for i, entry in enumerate(entries):
+        if sizes[i] >= min_size and entry[0] in stmts:
+            lineno, col_offset, end_lineno = locations[i][:3]
+            records += RECORD.pack(
+                hashes[i], 0, i, sizes[i], lineno, col_offset, end_lineno or lineno
+            )
+    return len(entries), bytes(records)
+
+
+def _with_file_id(records, file_id):
+    # the file id is the first field after the hash
+    file_id = file_id.to_bytes(4, "little")
+    return [
+        records[offset : offset + 16] + file_id + records[offset + 20 : offset + 40]
+        for offset in range(0, len(records), RECORD.size)
+    ]
+
+
+def _file_id(record):
+    return int.from_bytes(record[16:20], "little")
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _digest(path):
+    return hashlib.sha256(_read_source(path)).hexdigest()
+
+
+class CloneIndex:
+    """Hashes of the statement subtrees of many files, kept in a
+    directory between runs.
+
+    index.bin holds RECORD entries sorted by hash, so that identical
+    subtrees are adjacent, and is read through mmap.  manifest.json
+    tells the file of every file id along with its size, mtime and
+    digest: update() only hashes files that are new or changed, the
+    records of the others are copied over from the previous index.
+    """
+
+    def __init__(self, directory=INDEX_DIR, min_size=MIN_SIZE, normalize=False):
+        self.directory = directory
+        self.min_size = min_size
+        self.normalize = normalize
+        self.files = {}
+        try:
+            with open(os.path.join(directory, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("options") == self._options():
+            self.files = manifest["files"]
+
+    def _options(self):
+        return {
+            "version": INDEX_VERSION,
+            "min_size": self.min_size,
+            "normalize": self.normalize,
+        }
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, "index.bin")
+
+    def _unchanged(self, path, info):
+        if info is None:
+            return False
+        if list(_stat(path)) == [info["mtime_ns"], info["size"]]:
+            return True
+        # touched, but possibly not changed
+        return _digest(path) == info["digest"]
+
+    def update(self, paths, jobs=None):
+        """Index the files of paths, dropping files no longer in them.
+
+        Return the number of files hashed again.
+        """
+        kept = {}
+        todo = []
+        for path in paths:
+            info = self.files.get(path)
+            if self._unchanged(path, info):
+                kept[path] = info
+            else:
+                todo.append(path)
+        if not todo and len(kept) == len(self.files):
+            return 0
+        results = self._hash(todo, jobs)
+        files = {}
+        old = {info["id"] for info in kept.values()}
+        next_id = 0
+        for path, info in kept.items():
+            mtime_ns, size = _stat(path)
+            files[path] = dict(info, mtime_ns=mtime_ns, size=size)
+            next_id = max(next_id, info["id"] + 1)
+        # packed records sort by hash first, like their tuples
+        records = [record for record in self._iter_packed() if _file_id(record) in old]
+        for path, result in zip(todo, results):
+            if result is None:
+                continue
+            nodes, packed = result
+            mtime_ns, size = _stat(path)
+            files[path] = {
+                "id": next_id,
+                "mtime_ns": mtime_ns,
+                "size": size,
+                "digest": _digest(path),
+                "nodes": nodes,
+            }
+            records.extend(_with_file_id(packed, next_id))
+            next_id += 1
+        records.sort()
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(records)
+        del records
+        os.replace(tmp, self._index_path)
+        tmp = os.path.join(self.directory, "manifest.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"options": self._options(), "files": files}, f)
+        os.replace(tmp, os.path.join(self.directory, "manifest.json"))
+        self.files = files
+        return len(todo)
+
+    def _hash(self, paths, jobs):
+        tasks = [(path, self.min_size, self.normalize) for path in paths]
+        return _parallel_map(_hash_or_skip, tasks, jobs)
+
+    def _iter_packed(self):
+        try:
+            f = open(self._index_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for offset in range(0, size, RECORD.size):
+                    yield buf[offset : offset + RECORD.size]
+
+    def iter_records(self):
+        """Yield the records of the index as tuples, sorted by hash."""
+        for record in self._iter_packed():
+            yield RECORD.unpack(record)
+
+    def groups(self):
+        """Return [(size, [record])] of the subtrees found more than once,
+        largest first.
+
+        Occurrences inside a larger reported clone are left out, so that
+        a duplicated function is not reported once more for each of its
+        statements.
+        """
+        groups = []
+        run = []
+        for record in self.iter_records():
+            if run and record[0] != run[0][0]:
+                if len(run) > 1:
+                    groups.append(run)
+                run = []
+            run.append(record)
+        if len(run) > 1:
+            groups.append(run)
+        groups.sort(key=lambda run: (-run[0][3], run[0][0]))
+        paths = {info["id"]: path for path, info in self.files.items()}
+        covered = {}
+        result = []
+        for run in groups:
+            uncovered = []
+            for record in run:
+                file_id, start, size = record[1:4]
+                if file_id not in covered:
+                    covered[file_id] = bytearray(self.files[paths[file_id]]["nodes"])
+                if not covered[file_id][start]:
+                    uncovered.append(record)
+            if len(uncovered) < 2:
+                continue
+            for record in uncovered:
+                file_id, start, size = record[1:4]
+                covered[file_id][start : start + size] = b"\x01" * size
+            result.append((run[0][3], uncovered))
+        return result
+
+
+def _hash_or_skip(task):
+    try:
+        return hash_file(task)
+    except (SyntaxError, ValueError) as e:
+        print("%s: skipped: %s" % (task[0], e), file=sys.stderr)
+        return None
+
+
+def _iter_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for _, fname in _iter_files(path):
+                yield fname
+        else:
+            yield path
+
+
+def clones_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="astdiff clones",
+        description="report statements duplicated across PATHS",
+    )
+    parser.add_argument(
+        "paths", nargs="+", metavar="PATHS", help="files or directories"
+    )
+    parser.add_argument(
+        "--index",
+        default=INDEX_DIR,
+        metavar="DIR",
+        help="keep the index in DIR to only hash changed files on the next "
+        "run (default %(default)s)",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=MIN_SIZE,
+        help="smallest statement in nodes reported (default %(default)s)",
+    )
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="treat code only differing by the names of variables, "
+        "arguments, functions and classes as identical",
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="hash files on JOBS workers")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text")
+    args = parser.parse_args(argv)
+    index = CloneIndex(args.index, min_size=args.min_size, normalize=args.normalize)
+    paths = list(dict.fromkeys(_iter_paths(args.paths)))
+    hashed = index.update(paths, jobs=args.jobs)
+    print("hashed %d of %d files" % (hashed, len(paths)), file=sys.stderr)
+    paths = {info["id"]: path for path, info in index.files.items()}
+    groups = index.groups()
+    for size, records in groups:
+        locations = [
+            (paths[file_id], lineno, col_offset, end_lineno)
+            for _, file_id, _, _, lineno, col_offset, end_lineno in records
+        ]
+        if args.format == "jsonl":
+            _write_json(
+                {
+                    "type": "clone",
+                    "size": size,
+                    "locations": [
+                        {
+                            "file": path,
+                            "lineno": lineno,
+                            "col_offset": col_offset,
+                            "end_lineno": end_lineno,
+                        }
+                        for path, lineno, col_offset, end_lineno in locations
+                    ],
+                }
+            )
+            continue
+        print("%d copies of %d nodes" % (len(locations), size))
+        for path, lineno, _, end_lineno in locations:
+            print("  %s:%d-%d" % (path, lineno, end_lineno))
+    return 1 if groups else 0
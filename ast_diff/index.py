@@ -0,0 +1,208 @@
+import argparse
+import ast
+import os
+import sqlite3
+import sys
+
+from ast_diff import _iter_files, ast_diff, tree_fingerprint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    root TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS definitions (
+    snapshot TEXT NOT NULL,
+    path TEXT NOT NULL,
+    qualname TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    lineno INTEGER NOT NULL,
+    fingerprint BLOB NOT NULL,
+    PRIMARY KEY (snapshot, path, qualname)
+);
+"""
+
+# changed and removed definitions come from the left join, added ones are
+# the rows of the new snapshot without a partner in the old one
+DIFF_QUERY = """
+SELECT a.path, a.qualname, CASE WHEN b.path IS NULL THEN 'removed'
+                                ELSE 'changed' END
+FROM definitions AS a
+LEFT JOIN definitions AS b
+    ON b.snapshot = :new AND b.path = a.path AND b.qualname = a.qualname
+WHERE a.snapshot = :old AND (b.path IS NULL OR b.fingerprint != a.fingerprint)
+UNION ALL
+SELECT b.path, b.qualname, 'added'
+FROM definitions AS b
+WHERE b.snapshot = :new AND NOT EXISTS (
+    SELECT 1 FROM definitions AS a
+    WHERE a.snapshot = :old AND a.path = b.path AND a.qualname = b.qualname
+)
+ORDER BY 1, 2
+"""
+
+
+def _bound_names(node):
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [alias.asname or alias.name for alias in node.names]
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+        targets = [node.target]
+    else:
+        return []
+    return [
+        target.id
+        for top in targets
+        for target in ast.walk(top)
+        if isinstance(target, ast.Name)
+    ]
+
+
+def _statement_name(node):
+    # named after what it binds or else its content, not its index, so
+    # that inserting a statement does not rename the following ones
+    names = _bound_names(node)
+    if names:
+        return "<statement %s>" % ", ".join(names)
+    return "<statement %s>" % fingerprint(node).hex()[:12]
+
+
+def iter_definitions(tree):
+    """Yield (qualname, kind, node) for every function, class and
+    module-level statement of tree.
+
+    Other module-level statements are named after the names they bind,
+    like "<statement os>" for "import os", or else a digest of their
+    content.  Redefinitions get a "#n" suffix.
+    """
+    seen = set()
+    todo = [("", tree.body)]
+    while todo:
+        prefix, body = todo.pop()
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                kind = "function"
+                qualname = prefix + node.name
+            elif isinstance(node, ast.ClassDef):
+                kind = "class"
+                qualname = prefix + node.name
+            elif not prefix:
+                kind = "statement"
+                qualname = _statement_name(node)
+            else:
+                continue
+            name = qualname
+            n = 1
+            while name in seen:
+                n += 1
+                name = "%s#%d" % (qualname, n)
+            seen.add(name)
+            yield name, kind, node
+            if kind != "statement":
+                todo.append((name + ".", node.body))
+
+
+def fingerprint(node):
+    # equal for nodes ast_diff finds equal, and without recursion
+    return tree_fingerprint(node)
+
+
+def _iter_rows(snapshot, root):
+    for relpath, path in _iter_files(root):
+        try:
+            with open(path, "rb") as f:
+                tree = ast.parse(f.read())
+            rows = [
+                (snapshot, relpath, qualname, kind, node.lineno, fingerprint(node))
+                for qualname, kind, node in iter_definitions(tree)
+            ]
+        except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+            # one file too deep to handle does not fail the snapshot
+            print(
+                "%s: skipped: %s" % (path, str(e) or type(e).__name__), file=sys.stderr
+            )
+            continue
+        yield from rows
+
+
+def connect(db):
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def index_snapshot(conn, snapshot, root):
+    with conn:
+        conn.execute("DELETE FROM definitions WHERE snapshot = ?", (snapshot,))
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?)",
+            (snapshot, os.path.abspath(root)),
+        )
+        conn.executemany(
+            "INSERT INTO definitions VALUES (?, ?, ?, ?, ?, ?)",
+            _iter_rows(snapshot, root),
+        )
+
+
+def diff_snapshots(conn, old, new):
+    """Return (path, qualname, status) for the definitions that differ."""
+    return conn.execute(DIFF_QUERY, {"old": old, "new": new}).fetchall()
+
+
+def _find_definition(conn, snapshot, path, qualname, trees):
+    if (snapshot, path) not in trees:
+        (root,) = conn.execute(
+            "SELECT root FROM snapshots WHERE name = ?", (snapshot,)
+        ).fetchone()
+        with open(os.path.join(root, path), "rb") as f:
+            trees[snapshot, path] = {
+                name: node for name, _, node in iter_definitions(ast.parse(f.read()))
+            }
+    return trees[snapshot, path].get(qualname)
+
+
+def definition_diff(conn, old, new, path, qualname, trees=None):
+    """Run ast_diff on one definition of two indexed snapshots.
+
+    The snapshot sources are read again from their roots, so this only
+    works as long as they are still on disk.
+    """
+    if trees is None:
+        trees = {}
+    return ast_diff(
+        _find_definition(conn, old, path, qualname, trees),
+        _find_definition(conn, new, path, qualname, trees),
+    )
+
+
+def index_cli(argv):
+    parser = argparse.ArgumentParser(prog="astdiff index")
+    parser.add_argument("--db", required=True, help="sqlite database")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--snapshot", nargs=2, metavar=("NAME", "ROOT"), help="index ROOT as NAME"
+    )
+    group.add_argument(
+        "--diff", nargs=2, metavar=("OLD", "NEW"), help="compare two snapshots"
+    )
+    parser.add_argument(
+        "--detail", action="store_true", help="show ast_diff of changed definitions"
+    )
+    args = parser.parse_args(argv)
+    conn = connect(args.db)
+    try:
+        if args.snapshot:
+            index_snapshot(conn, *args.snapshot)
+            return 0
+        old, new = args.diff
+        rows = diff_snapshots(conn, old, new)
+        trees = {}
+        for path, qualname, status in rows:
+            print("%s %s:%s" % (status, path, qualname))
+            if args.detail and status == "changed":
+                result = definition_diff(conn, old, new, path, qualname, trees)
+                print("  %s" % (result,))
+        return 1 if rows else 0
+    finally:
+        conn.close()
@@ -0,0 +1,272 @@
+import ast
+import hashlib
+import json
+import re
+from itertools import zip_longest
+
+from ast_diff import (
+    Budget,
+    Inconclusive,
+    _difference_record,
+    _parallel_map,
+    _write_json,
+    ast_diff,
+    iter_differences,
+    iter_dump,
+    unified_diff,
+)
+
+# line magics, shell escapes and assignments from them, e.g. "%time f()",
+# "!ls" or "files = !ls"
+MAGIC = re.compile(r"^(\s*)(?:[%!]|\w+\s*=\s*[%!])")
+
+
+def _scan(line, depth, quote):
+    # (depth, quote, continued) after line: the bracket depth, the quotes
+    # of the string left open and whether the line ends with a backslash
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if quote is not None:
+            if c == "\\":
+                i += 2
+            elif line.startswith(quote, i):
+                i += len(quote)
+                quote = None
+            else:
+                i += 1
+            continue
+        if c == "#":
+            return depth, None, False
+        if c in "'\"":
+            quote = line[i : i + 3] if line[i : i + 3] in ("'''", '"""') else c
+            i += len(quote)
+            continue
+        if c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth = max(depth - 1, 0)
+        i += 1
+    continued = line.rstrip("\r\n").endswith("\\")
+    if quote is not None and len(quote) == 1 and not continued:
+        # unterminated string, left to the parser to report
+        quote = None
+    return depth, quote, continued
+
+
+def cell_source(cell):
+    """Return the python source of a code cell without IPython magics.
+
+    Magic lines become "pass" at their indentation so that line numbers
+    and blocks stay intact, cells run by a cell magic such as %%bash are
+    not python and come out empty.  Only lines starting a statement can
+    be magics, not those continuing one or inside a string.
+    """
+    source = cell.get("source", "")
+    if isinstance(source, list):
+        source = "".join(source)
+    if source.lstrip().startswith("%%"):
+        return ""
+    lines = source.splitlines(True)
+    depth = 0
+    quote = None
+    continued = False
+    for i, line in enumerate(lines):
+        if not (depth or quote or continued):
+            m = MAGIC.match(line)
+            if m:
+                lines[i] = m.group(1) + "pass\n"
+                continue
+        depth, quote, continued = _scan(line, depth, quote)
+    return "".join(lines)
+
+
+def read_cells(fname):
+    """Return [(id, source)] of the code cells of a notebook.
+
+    id is None for notebooks older than nbformat 4.5.
+    """
+    with open(fname, "rb") as f:
+        notebook = json.load(f)
+    return [
+        (cell.get("id"), cell_source(cell))
+        for cell in notebook.get("cells", [])
+        if cell.get("cell_type") == "code"
+    ]
+
+
+def pair_cells(cells1, cells2):
+    """Pair code cells by id when both notebooks have them, by index
+    otherwise.
+
+    Return [(key, source1, source2)] where a source is None for a cell
+    missing from that side, cells of the second notebook only come last.
+    """
+    if all(id is not None for id, _ in cells1 + cells2):
+        sources2 = dict(cells2)
+        pairs = [(id, source, sources2.get(id)) for id, source in cells1]
+        ids1 = {id for id, _ in cells1}
+        pairs.extend((id, None, source) for id, source in cells2 if id not in ids1)
+        return pairs
+    return [
+        (i, cell1 and cell1[1], cell2 and cell2[1])
+        for i, (cell1, cell2) in enumerate(zip_longest(cells1, cells2))
+    ]
+
+
+def _digest(source):
+    return hashlib.sha256(source.encode("utf-8")).digest()
+
+
+def _diff_cells(task):
+    source1, source2, differences, ignore_local_names, limits, unordered = task
+    # a budget per cell, started in the worker
+    budget = None if limits is None else Budget(*limits)
+    try:
+        tree1 = ast.parse(source1)
+        tree2 = ast.parse(source2)
+    except (SyntaxError, RecursionError, MemoryError) as e:
+        if budget is None and not isinstance(e, SyntaxError):
+            raise
+        return "error", "%s: %s" % (type(e).__name__, e)
+    if differences:
+        return "differences", list(
+            iter_differences(tree1, tree2, ignore_local_names, budget, unordered)
+        )
+    return "result", ast_diff(
+        tree1, tree2, ignore_local_names, budget, unordered_fields=unordered
+    )
+
+
+def diff_notebooks(
+    pairs,
+    jobs=None,
+    differences=False,
+    ignore_local_names=False,
+    limits=None,
+    unordered_fields=(),
+):
+    """Compare the code cells of many pairs of notebooks in one batch.
+
+    Return {(fname1, fname2): [(key, status, value)]} for the cells that
+    are not identical.  status is "added" or "removed" for cells missing
+    from one side, with value None, "error" for cells that do not parse,
+    with the error message, and otherwise "result" with the ast_diff
+    result or, with differences, "differences" with the list of
+    Difference records of iter_differences.
+
+    Cells are compared by content hash first and each pair of distinct
+    sources is parsed only once however many notebooks it occurs in.
+    With jobs, the cells of all notebooks share one pool of workers.
+    limits, (max_nodes, timeout), gives each pair of cells a Budget and
+    unordered_fields is as for ast_diff.
+    """
+    cells = {}
+    tasks = {}
+    for fname1, fname2 in pairs:
+        paired = pair_cells(read_cells(fname1), read_cells(fname2))
+        cells[fname1, fname2] = paired
+        for _, source1, source2 in paired:
+            if source1 is None or source2 is None:
+                continue
+            key = _digest(source1), _digest(source2)
+            if key[0] != key[1] and key not in tasks:
+                tasks[key] = (
+                    source1,
+                    source2,
+                    differences,
+                    ignore_local_names,
+                    limits,
+                    unordered_fields,
+                )
+    keys = list(tasks)
+    results = _parallel_map(_diff_cells, [tasks[key] for key in keys], jobs or 1)
+    results = dict(zip(keys, results))
+    report = {}
+    for pair, paired in cells.items():
+        report[pair] = entries = []
+        for key, source1, source2 in paired:
+            if source1 is None or source2 is None:
+                entries.append((key, "added" if source1 is None else "removed", None))
+                continue
+            digests = _digest(source1), _digest(source2)
+            if digests[0] == digests[1]:
+                continue
+            status, value = results[digests]
+            if value is None or value == []:
+                continue
+            entries.append((key, status, value))
+    return report
+
+
+def _print_cell_dumps(fname1, fname2, key):
+    sources = {
+        k: (source1, source2)
+        for k, source1, source2 in pair_cells(read_cells(fname1), read_cells(fname2))
+    }
+    source1, source2 = sources[key]
+    print(
+        "\n".join(
+            unified_diff(
+                list(iter_dump(ast.parse(source1))),
+                list(iter_dump(ast.parse(source2))),
+                fromfile="%s cell %s" % (fname1, key),
+                tofile="%s cell %s" % (fname2, key),
+                lineterm="",
+            )
+        )
+    )
+
+
+def notebook_pair(fname1, fname2, entries, output_format="text", counter=None):
+    """Report the entries diff_notebooks() returned for a pair.
+
+    With counter, differences are only counted as in summarize().
+    """
+    count = 0
+    for key, status, value in entries:
+        if status == "differences":
+            count += len(value)
+        else:
+            count += 1
+        if counter is not None:
+            if status == "differences":
+                counter.update(diff.label for diff in value)
+            else:
+                counter["%s cell" % status] += 1
+        elif output_format == "jsonl":
+            if status == "differences":
+                for diff in value:
+                    record = _difference_record(fname1, fname2, diff)
+                    record["cell"] = key
+                    _write_json(record)
+            else:
+                record = {
+                    "type": "cell",
+                    "file1": fname1,
+                    "file2": fname2,
+                    "cell": key,
+                    "status": status,
+                }
+                if status == "error":
+                    record["message"] = value
+                _write_json(record)
+        elif status == "added":
+            print("added %s cell %s" % (fname2, key))
+        elif status == "removed":
+            print("removed %s cell %s" % (fname1, key))
+        else:
+            print("%s %s cell %s: %s" % (fname1, fname2, key, value))
+            if status == "result" and not isinstance(value, Inconclusive):
+                _print_cell_dumps(fname1, fname2, key)
+    if counter is None and output_format == "jsonl":
+        _write_json(
+            {
+                "type": "pair",
+                "file1": fname1,
+                "file2": fname2,
+                "status": "different" if count else "equal",
+                "differences": count,
+            }
+        )
+    return 1 if count else 0
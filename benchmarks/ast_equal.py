@@ -0,0 +1,88 @@
+"""Time each ast_equal strategy on the kinds of input it is picked for.
+
+    python benchmarks/ast_equal.py [SOURCE]
+
+SOURCE defaults to ast_diff itself, repeated to get a larger module.
+Every strategy is forced on every kind of input, next to what ast_equal
+picks on its own, so the choice can be checked against the timings.
+"""
+
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import ast_diff  # noqa: E402
+
+STRATEGIES = [None, "flat", "fingerprint", "walk"]
+
+
+def best_of(func, setup, repeat=5):
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def forget():
+    ast_diff._fingerprints.clear()
+
+
+def prime(a, b):
+    # as after comparing the same sources twice before
+    def setup():
+        forget()
+        ast_diff.ast_equal(a, b)
+        ast_diff.ast_equal(a, b)
+
+    return setup
+
+
+def main(argv):
+    if argv:
+        with open(argv[0], "rb") as f:
+            source = f.read()
+    else:
+        with open(ast_diff.__file__, "rb") as f:
+            source = f.read() * 4
+    # a reformatted copy parses to the same tree from different bytes
+    reformatted = source.replace(b"\n\n\n", b"\n\n")
+    tree1 = ast.parse(source)
+    tree2 = ast.parse(reformatted)
+    dump1 = ast_diff.dump_binary(tree1, positions=True)
+    dump2 = ast_diff.dump_binary(tree2, positions=True)
+    cases = [
+        ("same source", source, bytes(source), forget),
+        ("first sight", source, reformatted, forget),
+        ("seen before", source, reformatted, prime(source, reformatted)),
+        ("binary dumps", dump1, dump2, forget),
+        ("trees", tree1, tree2, forget),
+    ]
+    print("%d bytes, best of 5" % len(source))
+    print("%-14s %-12s" % ("input", "picked") + "".join("%12s" % s for s in STRATEGIES))
+    for name, a, b, setup in cases:
+        setup()
+        if not isinstance(a, ast.AST) and a == b:
+            strategy = "identity"
+        else:
+            strategy = ast_diff._equal_strategy(a, b)
+        row = []
+        for forced in STRATEGIES:
+            setup()
+            assert ast_diff.ast_equal(a, b, strategy=forced)
+            row.append(
+                best_of(lambda: ast_diff.ast_equal(a, b, strategy=forced), setup)
+            )
+        print(
+            "%-14s %-12s" % (name, strategy)
+            + "".join("%11.4fs" % seconds for seconds in row)
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
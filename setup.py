@@ -8,7 +8,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     entry_points={
         "console_scripts": [
-            "astdiff = ast_diff:main",
+            "astdiff = ast_diff:cli",
         ],
     },
     test_suite="test_ast_diff",
@@ -1,5 +1,13 @@
 import ast
+import contextlib
+import io
+import json
+import os
+import pickle
+import tempfile
 import unittest
+import warnings
+from collections import Counter
 
 import ast_diff
 
@@ -1287,6 +1295,20 @@ class TestAstDiff(unittest.TestCase):
             "match a:\n    case A(b):\n        pass",
             ((2, 11), (2, 11), "ast.MatchAs.name differ"),
         )
+        # captures are locals, and shadow those of enclosing functions
+        code = (
+            "def f(y):\n    def g():\n        match a:\n"
+            "            case %s:\n                return y\n"
+        )
+        for pattern in ["y", "[*y]", "{**y}"]:
+            tree1 = ast.parse(code % pattern)
+            tree2 = ast.parse((code % pattern.replace("y", "z")).replace("y", "z"))
+            self.assertIsNone(ast_diff.ast_diff(tree1, tree2, ignore_local_names=True))
+            tree2 = ast.parse(code.replace("y", "z") % pattern)
+            self.assertEqual(
+                ast_diff.ast_diff(tree1, tree2, ignore_local_names=True),
+                ((5, 23), (5, 23), "ast.Name.id refer to different bindings y z"),
+            )
 
     @unittest.skipUnless(
         ast_diff.py310, "parenthesized context manager is added in Python 3.10"
@@ -1316,6 +1338,986 @@ class TestAstDiff(unittest.TestCase):
             ((1, 19), (1, 19), "ast.Name.id differ _ d"),
         )
 
+    def test_generated_fields(self):
+        self._test_same("u'a'", "'a'")
+        self._test_differ(
+            "a and b",
+            "a and b and c",
+            ((1, 0), (1, 0), "length of ast.BoolOp.values differ"),
+        )
+        self._test_differ("{**a}", "{b: a}", ((1, 0), (1, 0), "ast.Dict.keys differ"))
+        self._test_differ(
+            "from . import a",
+            "from .. import a",
+            ((1, 0), (1, 0), "ast.ImportFrom.level differ 1 2"),
+        )
+
+    def test_field_types(self):
+        with open(ast_diff.__file__) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            types = ast_diff._field_types(type(node))
+            self.assertEqual(sorted(types), sorted(node._fields), type(node))
+
+    def test_iter_differences(self):
+        diffs = list(
+            ast_diff.iter_differences(
+                ast.parse("a = 1\nf(x)\nif t:\n    pass"),
+                ast.parse("b = 1\nf(y, z)\nif t:\n    pass\n    pass"),
+            )
+        )
+        self.assertEqual(
+            [(d.kind, d.node_type, d.field, d.old, d.new) for d in diffs],
+            [
+                ("length", "If", "body", 1, 2),
+                ("value", "Name", "id", "a", "b"),
+                ("length", "Call", "args", 1, 2),
+            ],
+        )
+        self.assertEqual(
+            diffs[1].as_tuple(), ((1, 0), (1, 0), "ast.Name.id differ a b")
+        )
+        diffs = list(ast_diff.iter_differences(ast.parse("a + b"), ast.parse("a - b")))
+        self.assertEqual([d.label for d in diffs], ["ast.BinOp.op"])
+        code = "def f():\n    return 1\n" * 3
+        diffs = list(
+            ast_diff.iter_differences(ast.parse(code), ast.parse("import os\n" + code))
+        )
+        self.assertEqual(
+            [d.as_tuple() for d in diffs],
+            [(None, None, "length of ast.Module.body differ")],
+        )
+
+    def test_summarize(self):
+        self.assertEqual(
+            ast_diff.summarize(
+                ast.parse("a = b\nf(a)\nf(c)\nimport m"),
+                ast.parse("x = y\nf(x, 1)\nf(c, 2)\nimport n"),
+            ),
+            {
+                "ast.Name.id": 2,
+                "length of ast.Call.args": 2,
+                "ast.alias.name": 1,
+            },
+        )
+
+    def test_binary(self):
+        code = (
+            "import os\n"
+            "@dec\n"
+            "def f(a, *, b=None, c, **kw):\n"
+            "    global g\n"
+            "    return {**kw, 'a': a, 1: b'x', 2: 1.5j, 3: ...}[a:b, c]\n"
+        )
+        tree = ast.parse(code)
+        for compression in [None, "zlib", "lzma"]:
+            buf = ast_diff.dump_binary(tree, positions=True, compression=compression)
+            self.assertEqual(
+                ast.dump(ast_diff.load_binary(buf), include_attributes=True),
+                ast.dump(tree, include_attributes=True),
+            )
+            self.assertEqual(
+                ast_diff.load_binary(buf, flat=True, positions=True),
+                ast_diff.flatten(tree, positions=True),
+            )
+        buf = ast_diff.dump_binary(tree)
+        with warnings.catch_warnings():
+            # nodes missing fields are deprecated since Python 3.13
+            warnings.simplefilter("error", DeprecationWarning)
+            self.assertEqual(ast.dump(ast_diff.load_binary(buf)), ast.dump(tree))
+        with self.assertRaises(ValueError):
+            ast_diff.load_binary(buf, flat=True, positions=True)
+        with self.assertRaises(ValueError):
+            ast_diff.load_binary(b"junk")
+        self.assertFalse(ast_diff.ast_equal(b"ASTBUILDER = 1\n", b"ASTBUILDER = 2\n"))
+
+    @unittest.skipUnless(ast_diff.py39, "ast.dump() indent is added in Python 3.9")
+    def test_iter_dump(self):
+        tree = ast.parse(
+            "def f(a, *, b=None):\n    return [x async for x in g(a) if x]\n"
+        )
+        options = [
+            {},
+            {"annotate_fields": False, "indent": "  "},
+            {"include_attributes": True, "indent": 0},
+        ]
+        if ast_diff.py313:
+            options.append({"show_empty": True})
+        for kwargs in options:
+            self.assertEqual(
+                list(ast_diff.iter_dump(tree, **kwargs)),
+                ast.dump(tree, **dict({"indent": 1}, **kwargs)).splitlines(),
+            )
+        tree = ast.Expression(body=ast.Name(id="a", ctx=ast.Load()))
+        for _ in range(10000):
+            tree.body = ast.UnaryOp(op=ast.USub(), operand=tree.body)
+        lines = list(ast_diff.iter_dump(tree))
+        self.assertEqual(len(lines), 20002)
+        self.assertEqual(
+            lines[-1], " " * 10001 + "operand=Name(id='a', ctx=Load())" + ")" * 10001
+        )
+
+    def test_unified_diff(self):
+        import difflib
+
+        a = "a b c d e f g h i j k".split()
+        for b in [
+            a,
+            "a b c X e f g h i j k".split(),
+            "X a b c d e f g h i Y j k".split(),
+            "a b d e f g h j k Z".split(),
+            [],
+        ]:
+            for n in [0, 1, 3]:
+                self.assertEqual(
+                    list(ast_diff.unified_diff(a, b, "x", "y", n=n)),
+                    list(difflib.unified_diff(a, b, "x", "y", n=n)),
+                )
+        # too costly to search, replaced as a whole
+        self.assertEqual(
+            list(ast_diff.unified_diff(list("abcd"), list("xbyd"), max_cost=1)),
+            ["--- \n", "+++ \n", "@@ -1,4 +1,4 @@\n"]
+            + ["-a", "-b", "-c", "+x", "+b", "+y", " d"],
+        )
+
+    def test_flatten(self):
+        self.assertEqual(
+            ast_diff.flatten(ast.parse("f(a)")),
+            [
+                ("Module", 1, 0),
+                ("Expr", 1),
+                ("Call", 1, 1, 0),
+                ("Name", "f", 1),
+                ("Load",),
+                ("Name", "a", 1),
+                ("Load",),
+            ],
+        )
+        self.assertEqual(
+            ast_diff.flatten(ast.parse("a = 1")), ast_diff.flatten(ast.parse("a=1"))
+        )
+
+    def test_find_moves(self):
+        code1 = (
+            "def f():\n    x = g(1, 2)\n    return x\n\n"
+            "def h():\n    y = g(3, 4)\n    return y\n\n"
+            "z = 1\n"
+        )
+        code2 = (
+            "z = 2\n\n"
+            "def h():\n    y = g(3, 4)\n    return y\n\n"
+            "def f():\n    x = g(1, 2)\n    return x\n"
+        )
+        self.assertEqual(
+            ast_diff.find_moves(ast.parse(code1), ast.parse(code2)),
+            (
+                [((1, 0), (7, 0), "FunctionDef")],
+                [((9, 0), "Assign")],
+                [((1, 0), "Assign")],
+            ),
+        )
+        self.assertEqual(
+            ast_diff.find_moves(ast.parse(code1), ast.parse(code1)), ([], [], [])
+        )
+
+    def test_ignore_local_names(self):
+        def check(code1, code2, expected):
+            tree1 = ast.parse(code1)
+            tree2 = ast.parse(code2)
+            self.assertIsNotNone(ast_diff.ast_diff(tree1, tree2))
+            result = ast_diff.ast_diff(tree1, tree2, ignore_local_names=True)
+            self.assertEqual(result, expected)
+            self.assertEqual(
+                ast_diff.ast_diff_parallel(
+                    tree1, tree2, jobs=1, chunk_size=1, ignore_local_names=True
+                ),
+                expected,
+            )
+
+        check(
+            "def f(a, /, *b, **c):\n    d = a + 1\n    return d, b, c",
+            "def f(x, /, *y, **z):\n    w = x + 1\n    return w, y, z",
+            None,
+        )
+        check(
+            "def f():\n    a = 1\n    def g():\n        return a\n",
+            "def f():\n    b = 1\n    def g():\n        return b\n",
+            None,
+        )
+        check("[i for i in x]", "[j for j in x]", None)
+        check(
+            "def f():\n    try:\n        pass\n    except E as e:\n        raise e",
+            "def f():\n    try:\n        pass\n    except E as f:\n        raise f",
+            None,
+        )
+        check(
+            "def f(a):\n    return a + b",
+            "def f(x):\n    return x + c",
+            ((2, 15), (2, 15), "ast.Name.id differ b c"),
+        )
+        check(
+            "def f():\n    global a\n    a = 1",
+            "def f():\n    global b\n    b = 1",
+            ((2, 4), (2, 4), "ast.Global.names differ"),
+        )
+        check(
+            "def f(*, a):\n    return a",
+            "def f(*, b):\n    return b",
+            ((1, 0), (1, 0), "ast.FunctionDef.args.kwonlyargs[0].arg differ a b"),
+        )
+        # locals swapped
+        check(
+            "def f(a, b):\n    return a - b",
+            "def f(b, a):\n    return a - b",
+            ((2, 11), (2, 11), "ast.Name.id refer to different bindings a a"),
+        )
+        check(
+            "def f(a):\n    return a",
+            "def f(b):\n    return a",
+            ((2, 11), (2, 11), "ast.Name.id refer to different bindings a a"),
+        )
+        # names bound by imports and nested definitions shadow the locals
+        # of enclosing functions
+        for binding in ["import os", "from os import path as os", "def os(): pass"]:
+            check(
+                "def g(os):\n    def f():\n        %s\n        return os" % binding,
+                "def g(x):\n    def f():\n        %s\n        return x" % binding,
+                ((4, 15), (4, 15), "ast.Name.id refer to different bindings os x"),
+            )
+        check(
+            "def g(a):\n    def f():\n        class a: pass\n        return a",
+            "def g(x):\n    def f():\n        class a: pass\n        return x",
+            ((4, 15), (4, 15), "ast.Name.id refer to different bindings a x"),
+        )
+        # a scope added earlier in the module leaves later ones alone
+        code = "def f(x):\n    if x:\n        return %s\n\ndef g(a):\n    return a\n"
+        check(
+            code % "x",
+            code % "[y for y in x]",
+            ((3, 15), (3, 15), "different type Name ListComp"),
+        )
+
+    def test_ranges(self):
+        code1 = (
+            "import os\n\n\n"
+            "def f():\n    a = 1\n    b = 2\n    return a\n\n\n"
+            "@d\ndef g():\n    return 3\n"
+        )
+        code2 = code1.replace("b = 2", "b = 3").replace("return 3", "return 4")
+        tree1 = ast.parse(code1)
+        tree2 = ast.parse(code2)
+        pruned = ast_diff.restrict_to_ranges(tree1, [(6, 6)])
+        self.assertEqual(ast.dump(pruned), ast.dump(ast.parse("def f():\n    b = 2")))
+        self.assertEqual(len(tree1.body[1].body), 3)
+        self.assertIsNone(
+            ast_diff.ast_diff(
+                ast_diff.restrict_to_ranges(tree1, [(1, 5), (10, 10)]),
+                ast_diff.restrict_to_ranges(tree2, [(1, 5), (10, 10)]),
+            )
+        )
+        self.assertEqual(
+            ast_diff.ast_diff(
+                ast_diff.restrict_to_ranges(tree1, [(12, 12)]),
+                ast_diff.restrict_to_ranges(tree2, [(12, 12)]),
+            ),
+            ((12, 11), (12, 11), "ast.Constant.value differ 3 4"),
+        )
+        patch = ast_diff.parse_patch(
+            [
+                "diff --git a/m.py b/m.py\n",
+                "--- a/m.py\n",
+                "+++ b/m.py\n",
+                "@@ -6 +6 @@ def f():\n",
+                "-    b = 2\n",
+                "+    b = 3\n",
+                "@@ -12,0 +13,2 @@ def g():\n",
+            ]
+        )
+        self.assertEqual(patch, {"m.py": ([(6, 6)], [(6, 6), (13, 14)])})
+        self.assertEqual(ast_diff.parse_ranges("1-3,5"), [(1, 3), (5, 5)])
+
+    def test_ast_equal(self):
+        import pathlib
+
+        code1 = "x = 1\n\n\ndef f():\n    return x\n" * 200
+        code2 = code1.replace("\n\n\n", "\n\n")
+        code3 = code1.replace("return x", "return y")
+        dumps = [
+            ast_diff.dump_binary(ast.parse(code), positions=True)
+            for code in [code1, code2, code3]
+        ]
+        for strategy in [None, "flat", "fingerprint", "walk"]:
+            self.assertTrue(ast_diff.ast_equal(code1, code2, strategy))
+            self.assertFalse(ast_diff.ast_equal(code1, code3, strategy))
+            self.assertTrue(ast_diff.ast_equal(dumps[0], dumps[1], strategy))
+            self.assertFalse(ast_diff.ast_equal(dumps[0], dumps[2], strategy))
+            self.assertTrue(ast_diff.ast_equal(ast.parse(code1), code2, strategy))
+            # as in ast_diff, equal constants compare equal
+            self.assertTrue(ast_diff.ast_equal("x = 1", "x = 1.0", strategy))
+        self.assertEqual(ast_diff._equal_strategy(dumps[0], dumps[1]), "flat")
+        self.assertEqual(ast_diff._equal_strategy(code1, code3), "fingerprint")
+        self.assertEqual(ast_diff._equal_strategy("a = 1", "a = 2"), "walk")
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory, "a.py")
+            path.write_text(code1)
+            self.assertTrue(ast_diff.ast_equal(path, code2.encode()))
+
+    def test_differ(self):
+        differ = ast_diff.Differ(ignore_fields=["arg.annotation", "Constant.kind"])
+        self.assertIsNone(
+            differ.diff_sources("def f(a: int, b): pass", "def f(a, b: str): pass")
+        )
+        self.assertIsNone(differ.diff_sources("u'a'", "'a'"))
+        self.assertEqual(
+            differ.diff_sources("def f(a: int): 1", "def f(a: int): 2"),
+            ast_diff.ast_diff(
+                ast.parse("def f(a: int): 1"), ast.parse("def f(a: int): 2")
+            ),
+        )
+        for name in ["FunctionDef.name", "alias.name", "Spam.eggs", "Name.eggs"]:
+            with self.assertRaises(ValueError):
+                ast_diff.Differ(ignore_fields=[name])
+        differ = ast_diff.Differ(ignore_local_names=True, max_differences=2)
+        tree1 = ast.parse("def f(a):\n    return a + 1, 2, 3")
+        tree2 = ast.parse("def f(b):\n    return b + 2, 3, 4")
+        self.assertIsNone(differ.diff_sources("def f(a): a", "def f(b): b"))
+        self.assertEqual(
+            [diff.message for diff in differ.differences(tree1, tree2)],
+            ["ast.Constant.value differ 2 3", "ast.Constant.value differ 3 4"],
+        )
+        self.assertEqual(
+            (differ.counters["calls"], differ.counters["different"]), (2, 1)
+        )
+
+    def test_reference(self):
+        code = "def f(a):\n    return a + 1\n"
+        reference = ast_diff.Reference.from_source(code)
+        candidates = [
+            code,
+            "def f(a):\n    return a + 2\n",
+            ast_diff.dump_binary(ast.parse(code)),
+            "def f(b):\n    return b + 1\n",
+        ]
+        expected = [
+            ast_diff.ast_diff(ast.parse(code), ast_diff._parse_source(c))
+            for c in [c if isinstance(c, bytes) else c.encode() for c in candidates]
+        ]
+        self.assertEqual([reference.diff(c) for c in candidates], expected)
+        self.assertEqual(reference.diff_many(candidates, jobs=2), expected)
+        self.assertIsNone(reference.diff(candidates[3], ignore_local_names=True))
+        copy = ast_diff.Reference.loads(reference.dumps())
+        self.assertEqual(copy.digest, reference.digest)
+        self.assertEqual([copy.diff(c) for c in candidates], expected)
+        self.assertEqual(
+            ast_diff.Reference.from_source("x = 1").digest,
+            ast_diff.Reference.from_source("x = True").digest,
+        )
+
+    def test_parallel(self):
+        code1 = "a = 1\nif t:\n    b = 2\nc = 3\nd = 4\n"
+        for code2 in [
+            code1,
+            "a = 1\nif t:\n    b = 2\nc = 3\nd = 5\n",
+            "a = 1\nif t:\n    b = 3\nc = 3\nd = 5\n",
+            "a = 1\nif t:\n    b = 3\nc = 3\nd = 4\n",
+            "a = 1\nif t:\n    b = 2\nc = 3\n",
+        ]:
+            tree1 = ast.parse(code1)
+            tree2 = ast.parse(code2)
+            for jobs in [1, 2]:
+                self.assertEqual(
+                    ast_diff.ast_diff_parallel(tree1, tree2, jobs=jobs, chunk_size=1),
+                    ast_diff.ast_diff(tree1, tree2),
+                )
+        # chunks of source lines cut between lines, decorators included
+        code1 = "# -*- coding: latin-1 -*-\na = 1; b = 2\n@d\ndef f():\n    'é'\n"
+        code2 = code1.replace("'é'", "'è'")
+        sources = code1.encode("latin-1"), code2.encode("latin-1")
+        tree1, tree2 = map(ast.parse, sources)
+        self.assertEqual(
+            ast_diff._chunk_bounds(tree1.body, tree2.body, 1), [(0, 2), (2, 3)]
+        )
+        self.assertEqual(
+            ast_diff.ast_diff_parallel(
+                tree1, tree2, jobs=2, chunk_size=1, sources=sources
+            ),
+            ((5, 4), (5, 4), "ast.Constant.value differ é è"),
+        )
+
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ast_diff.ResultCache(maxsize=1, directory=directory)
+            key1 = cache.key("a = 1", "a = 1")
+            key2 = cache.key("a = 1", "a = 2")
+            self.assertNotEqual(key1, key2)
+            self.assertEqual(cache.lookup(key1), (False, None))
+            cache.store(key1, None)
+            result = ((1, 4), (1, 4), "ast.Constant.value differ 1 2")
+            cache.store(key2, result)
+            self.assertEqual(cache.lookup(key2), (True, result))
+            # evicted from memory, found on disk
+            self.assertEqual(cache.lookup(key1), (True, None))
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            cache = ast_diff.ResultCache(directory=directory)
+            self.assertEqual(cache.lookup(key2), (True, result))
+            fname = os.path.join(directory, "a.py")
+            with open(fname, "w") as f:
+                f.write("a = 1\n")
+            for _ in range(2):
+                ast_diff._summarize_pair(fname, fname, Counter(), cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_jsonl(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, files in [
+                ("old", {"a.py": "a = 1\nb = 2\n", "b.py": "pass\n"}),
+                ("new", {"a.py": "a = 2\nb = 3\n", "c.py": "pass\n"}),
+            ]:
+                os.makedirs(os.path.join(directory, name))
+                for fname, code in files.items():
+                    with open(os.path.join(directory, name, fname), "w") as f:
+                        f.write(code)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(
+                    [
+                        "--format",
+                        "jsonl",
+                        os.path.join(directory, "old"),
+                        os.path.join(directory, "new"),
+                    ]
+                )
+        self.assertEqual(status, 1)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            [(r["type"], r.get("message"), r.get("status")) for r in records],
+            [
+                ("difference", "ast.Constant.value differ 1 2", None),
+                ("difference", "ast.Constant.value differ 2 3", None),
+                ("pair", None, "different"),
+                ("pair", None, "removed"),
+                ("pair", None, "added"),
+            ],
+        )
+        self.assertEqual(records[1]["pos1"], [2, 4])
+        # nodes are written as their type and position, long lists cut short
+        code1 = "def f():\n    return\n"
+        code2 = "def f():\n    return " + "+".join(["a"] * 1500) + "\n"
+        diff = next(ast_diff.iter_differences(ast.parse(code1), ast.parse(code2)))
+        record = ast_diff._difference_record("a.py", "b.py", diff)
+        self.assertEqual(
+            record["new"], {"node_type": "BinOp", "lineno": 2, "col_offset": 11}
+        )
+        code1 = "{%s}" % ", ".join("%d: 0" % i for i in range(100))
+        code2 = "{**a, %s}" % ", ".join("%d: 0" % i for i in range(99))
+        diff = next(ast_diff.iter_differences(ast.parse(code1), ast.parse(code2)))
+        record = ast_diff._difference_record("a.py", "b.py", diff)
+        self.assertEqual(len(record["old"]), ast_diff.JSON_MAX_ITEMS + 1)
+        self.assertEqual(
+            record["old"][0], {"node_type": "Constant", "lineno": 1, "col_offset": 1}
+        )
+        self.assertEqual(record["old"][-1], "68 more")
+
+    def test_pair_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, files in [
+                ("old", {"a.py": "a = 1\n", "b.py": "b = 1\n", "c.py": "c = 1\n"}),
+                ("new", {"a.py": "a = (\n", "b.py": "b = 1\x00\n", "c.py": "c = 2\n"}),
+            ]:
+                os.makedirs(os.path.join(directory, name))
+                for fname, code in files.items():
+                    with open(os.path.join(directory, name, fname), "w") as f:
+                        f.write(code)
+            outputs = {}
+            for options in [[], ["--format", "jsonl"], ["--summary"]]:
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    status = ast_diff.cli(
+                        options
+                        + [
+                            os.path.join(directory, "old"),
+                            os.path.join(directory, "new"),
+                        ]
+                    )
+                self.assertEqual(status, 1)
+                outputs[tuple(options)] = out.getvalue()
+        # the pairs after the ones that do not parse are still compared
+        lines = outputs[()].splitlines()
+        self.assertIn("a.py: SyntaxError: ", lines[0])
+        self.assertIn("b.py: ", lines[1])
+        self.assertIn("null bytes", lines[1])
+        self.assertEqual(lines[2], "((1, 4), (1, 4), 'ast.Constant.value differ 1 2')")
+        records = [
+            json.loads(line) for line in outputs["--format", "jsonl"].splitlines()
+        ]
+        self.assertEqual(
+            [(r["type"], r["status"]) for r in records if "status" in r],
+            [("pair", "error"), ("pair", "error"), ("pair", "different")],
+        )
+        self.assertEqual(
+            outputs[("--summary",)], "2 error file\n1 ast.Constant.value\n"
+        )
+
+    def test_budget(self):
+        code1 = "a = 1\nb = 2\nc = 3\n"
+        code2 = "a = 1\nb = 2\nc = 4\n"
+        tree1 = ast.parse(code1)
+        tree2 = ast.parse(code2)
+        result = ast_diff.ast_diff(tree1, tree2, budget=ast_diff.Budget(max_nodes=5))
+        self.assertIsInstance(result, ast_diff.Inconclusive)
+        self.assertEqual(result.nodes, 5)
+        self.assertEqual(result[:2], ((1, 4), (1, 4)))
+        self.assertEqual(
+            result[2], "inconclusive: node budget of 5 exhausted after 5 nodes"
+        )
+        self.assertEqual(pickle.loads(pickle.dumps(result)), result)
+        self.assertEqual(
+            ast_diff.ast_diff(tree1, tree2, budget=ast_diff.Budget(max_nodes=100)),
+            ast_diff.ast_diff(tree1, tree2),
+        )
+        result = ast_diff.ast_diff(tree1, tree2, budget=ast_diff.Budget(timeout=-1))
+        self.assertEqual(result.reason, "timeout of -1s exceeded")
+        diffs = list(ast_diff.iter_differences(tree1, tree2, budget=ast_diff.Budget(5)))
+        self.assertEqual([diff.label for diff in diffs], ["inconclusive"])
+        with tempfile.TemporaryDirectory() as directory:
+            fname1 = os.path.join(directory, "a.py")
+            fname2 = os.path.join(directory, "b.py")
+            for fname, code in [(fname1, code1), (fname2, code2)]:
+                with open(fname, "w") as f:
+                    f.write(code)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(
+                    ["--format", "jsonl", "--max-nodes", "5", fname1, fname2]
+                )
+            self.assertEqual(status, 1)
+            record = json.loads(out.getvalue().splitlines()[-1])
+            self.assertEqual(record["status"], "inconclusive")
+            self.assertEqual(record["reason"], "node budget of 5 exhausted")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(["--timeout", "60", fname1, fname2])
+            self.assertEqual(status, 1)
+            self.assertIn("@@ -", out.getvalue())
+            with open(fname2, "w") as f:
+                # too deep for the parser on every version
+                f.write("-" * 100000 + "1")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(["--timeout", "60", fname1, fname2])
+            self.assertEqual(status, 1)
+            self.assertIn("inconclusive: parse failed", out.getvalue())
+        with self.assertRaises(ast_diff._BudgetExceeded):
+            list(
+                ast_diff.unified_diff(
+                    ["a", "b"], ["b", "c"], budget=ast_diff.Budget(timeout=-1)
+                )
+            )
+        deep = ast.parse("-" * 50 + "1")
+        budget = ast_diff.Budget(max_render=1000)
+        with self.assertRaises(ast_diff._BudgetExceeded) as cm:
+            list(ast_diff._render_lines(ast_diff.iter_dump(deep), budget))
+        self.assertEqual(str(cm.exception), "dump longer than 1000 characters")
+
+    def test_locations(self):
+        code1 = "s = 'é'; t = f('ü', x)\r\nu = 1\n"
+        code2 = "s = 'é'; t = f('ü', y)\r\nu = 1\n"
+        index = ast_diff.LineIndex(code1.encode("utf-8"))
+        self.assertEqual(index.starts, [0, 25, 31])
+        self.assertEqual(index.line(1), "s = 'é'; t = f('ü', x)")
+        self.assertEqual(index.column((1, 22)), 20)
+        self.assertEqual(index.excerpt((1, 14), (1, 24)), "f('ü', x)")
+        result = ast_diff.ast_diff(
+            ast.parse(code1),
+            ast.parse(code2),
+            sources=(index, ast_diff.LineIndex(code2)),
+        )
+        self.assertEqual(result, ((1, 22), (1, 22), "ast.Name.id differ x y"))
+        self.assertEqual((result.end1, result.end2), ((1, 23), (1, 23)))
+        self.assertEqual((result.column1, result.end_column1), (20, 21))
+        self.assertEqual((result.excerpt1, result.excerpt2), ("x", "y"))
+        result = pickle.loads(pickle.dumps(result))
+        self.assertEqual(result.excerpt2, "y")
+        with tempfile.TemporaryDirectory() as directory:
+            fname1 = os.path.join(directory, "a.py")
+            fname2 = os.path.join(directory, "b.py")
+            for fname, code in [(fname1, code1), (fname2, code2)]:
+                with open(fname, "w", encoding="utf-8", newline="") as f:
+                    f.write(code)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                ast_diff.cli(["--format", "jsonl", "--locations", fname1, fname2])
+        record = json.loads(out.getvalue().splitlines()[0])
+        self.assertEqual(record["column2"], 20)
+        self.assertEqual(record["end2"], [1, 23])
+        self.assertEqual(record["excerpt1"], "x")
+
+    def test_unordered(self):
+        code1 = (
+            "import os, sys\nx = {1, 2, f(a)}\nd = {'a': 1, 'b': 2, **e}\n"
+            "@a\n@b\nclass C: pass\n"
+        )
+        code2 = (
+            "import sys, os\nx = {f(b), 2, 1}\nd = {**e, 'b': 2, 'a': 1}\n"
+            "@b\n@a\nclass C: pass\n"
+        )
+        tree1 = ast.parse(code1)
+        tree2 = ast.parse(code2)
+        self.assertEqual(
+            ast_diff.ast_diff(tree1, tree2)[2], "ast.alias.name differ os sys"
+        )
+        self.assertEqual(
+            ast_diff.ast_diff(tree1, tree2, unordered_fields=ast_diff.UNORDERED_FIELDS),
+            ((2, 13), (2, 7), "ast.Name.id differ a b"),
+        )
+        differences = list(
+            ast_diff.iter_differences(
+                ast.parse("x = {1, 2}"),
+                ast.parse("x = {2, 3, 1}"),
+                unordered_fields=["Set.elts"],
+            )
+        )
+        self.assertEqual(
+            [diff.as_tuple() for diff in differences],
+            [
+                ((1, 4), (1, 4), "length of ast.Set.elts differ"),
+                (None, (1, 8), "unmatched element of ast.Set.elts None Constant"),
+            ],
+        )
+        differ = ast_diff.Differ(unordered_fields=["ClassDef.decorator_list"])
+        self.assertIsNone(
+            differ.diff_sources("@a\n@b\nclass C: pass", "@b\n@a\nclass C: pass")
+        )
+        for name in ["Set.ctx", "Name.id", "Spam.eggs"]:
+            with self.assertRaises(ValueError):
+                ast_diff.Differ(unordered_fields=[name])
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, files in [
+                ("old", {"a.py": "a = 1\n", "b.py": "b = 1\n", "c.py": "pass\n"}),
+                ("new", {"a.py": "a = 2\n", "b.py": "b = 1\n", "c.py": "pass\n"}),
+            ]:
+                os.makedirs(os.path.join(directory, name))
+                for fname, code in files.items():
+                    with open(os.path.join(directory, name, fname), "w") as f:
+                        f.write(code)
+            journal = os.path.join(directory, "journal")
+            argv = [
+                "--summary",
+                "--journal",
+                journal,
+                os.path.join(directory, "old"),
+                os.path.join(directory, "new"),
+            ]
+            outputs = []
+            for resume in [[], ["--resume"]]:
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    self.assertEqual(ast_diff.cli(resume + argv), 1)
+                outputs.append(out.getvalue())
+                with open(os.path.join(directory, "new", "b.py"), "w") as f:
+                    f.write("b = 2\n")
+            with open(journal) as f:
+                entries = [json.loads(line) for line in f]
+            # the output of a pair is printed and recorded alike
+            printed = []
+            for options in [[], ["--journal", journal]]:
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    self.assertEqual(ast_diff.cli(options + argv[3:]), 1)
+                printed.append(out.getvalue())
+            with open(journal) as f:
+                lines = f.readlines()
+            recorded = "".join(json.loads(line).get("output", "") for line in lines)
+            # a pair started and never finished, as when it takes the
+            # process down, is not tried again
+            with open(journal, "w") as f:
+                f.writelines(
+                    line
+                    for line in lines
+                    if "b.py" not in line or line.startswith('{"started"')
+                )
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(
+                    ast_diff.cli(["--resume", "--journal", journal] + argv[3:]), 1
+                )
+            with open(journal) as f:
+                last = json.loads(f.readlines()[-1])
+        self.assertEqual(printed, [recorded, recorded])
+        self.assertIn("ast.Constant.value differ", recorded)
+        self.assertEqual(outputs, ["1 ast.Constant.value\n", "2 ast.Constant.value\n"])
+        # only the changed pair was compared again
+        self.assertEqual(len(entries), 8)
+        self.assertEqual(entries[-2], {"started": entries[-1]["key"]})
+        self.assertEqual(entries[-1]["counts"], {"ast.Constant.value": 1})
+        self.assertIn("b.py: did not finish in an earlier run\n", out.getvalue())
+        self.assertEqual(last["status"], 1)
+        self.assertIn("did not finish", last["output"])
+
+    def test_stream(self):
+        code1 = (
+            "# -*- coding: latin-1 -*-\n@d\n\n@e\ndef f():\n    return 1\n"
+            "if a:\n    pass\nelse:\n    pass\n"
+            'x = """\nabc\n"""; y = (\n1)\ns = "\xe9"\nz = 1\n'
+        )
+        code2 = code1.replace("z = 1", "z = 2")
+        with tempfile.TemporaryDirectory() as directory:
+            fname1 = os.path.join(directory, "a.py")
+            fname2 = os.path.join(directory, "b.py")
+            for fname, code in [(fname1, code1), (fname2, code2)]:
+                with open(fname, "wb") as f:
+                    f.write(code.encode("latin-1"))
+            tree1 = ast.parse(code1)
+            for chunk_size in [1, 20, 1 << 20]:
+                statements = list(ast_diff.iter_statements(fname1, chunk_size))
+                self.assertEqual(
+                    [ast.dump(node, include_attributes=True) for node in statements],
+                    [ast.dump(node, include_attributes=True) for node in tree1.body],
+                )
+                self.assertEqual(
+                    ast_diff.ast_diff_stream(fname1, fname2, chunk_size=chunk_size),
+                    ast_diff.ast_diff(tree1, ast.parse(code2)),
+                )
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(["--stream", fname1, fname2])
+            # chunks far down the file are shifted rather than padded
+            code = "".join("a%d = (\n%d)\n\n\n" % (i, i) for i in range(100))
+            with open(fname1, "w") as f:
+                f.write(code)
+            statements = ast_diff.iter_statements(fname1, 1)
+            self.assertEqual(
+                [ast.dump(node, include_attributes=True) for node in statements],
+                [
+                    ast.dump(node, include_attributes=True)
+                    for node in ast.parse(code).body
+                ],
+            )
+            with open(fname1, "a") as f:
+                f.write("b = (\n")
+            with self.assertRaises(SyntaxError) as cm:
+                list(ast_diff.iter_statements(fname1, 1))
+            self.assertEqual(cm.exception.lineno, 401)
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            out.getvalue(), "((16, 4), (16, 4), 'ast.Constant.value differ 1 2')\n"
+        )
+
+    def test_renames(self):
+        code = "".join("def f%d(a):\n    return a + %d\n\n" % (i, i) for i in range(20))
+        sketch = ast_diff.minhash(ast.parse(code))
+        self.assertEqual(len(sketch), ast_diff.MINHASH_SIZE)
+        self.assertEqual(sketch, ast_diff.minhash(ast.parse(code)))
+        self.assertGreater(
+            ast_diff.similarity(
+                sketch, ast_diff.minhash(ast.parse(code.replace("+ 3\n", "- 3\n")))
+            ),
+            0.8,
+        )
+        self.assertLess(
+            ast_diff.similarity(sketch, ast_diff.minhash(ast.parse("import os"))),
+            0.2,
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            for name, files in [
+                ("old", {"a.py": code, "b.py": "import os\n"}),
+                ("new", {"pkg/c.py": code.replace("+ 3\n", "- 3\n"), "d.py": "x\n"}),
+            ]:
+                os.makedirs(os.path.join(directory, name, "pkg"))
+                for fname, source in files.items():
+                    with open(os.path.join(directory, name, fname), "w") as f:
+                        f.write(source)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(
+                    [
+                        "--renames",
+                        "--format",
+                        "jsonl",
+                        os.path.join(directory, "old"),
+                        os.path.join(directory, "new"),
+                    ]
+                )
+        self.assertEqual(status, 1)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            [(r["type"], r.get("message"), r.get("status")) for r in records],
+            [
+                ("pair", None, "removed"),
+                ("pair", None, "added"),
+                ("rename", None, None),
+                ("difference", "ast.BinOp.op differ Add Sub", None),
+                ("pair", None, "different"),
+            ],
+        )
+        self.assertTrue(records[2]["file1"].endswith("a.py"))
+        self.assertTrue(records[2]["file2"].endswith("c.py"))
+
+    def test_clones(self):
+        from ast_diff.clones import CloneIndex
+
+        code = "def f(a, b):\n    if a:\n        return a + b * 2\n    return [a, b]\n"
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for name, source in [
+                ("a.py", code),
+                ("b.py", "x = 1\n\n" + code.replace("a", "c")),
+                ("c.py", "pass\n"),
+            ]:
+                paths.append(os.path.join(directory, name))
+                with open(paths[-1], "w") as f:
+                    f.write(source)
+            index_dir = os.path.join(directory, "index")
+            index = CloneIndex(index_dir, min_size=10)
+            self.assertEqual(index.update(paths), 3)
+            self.assertEqual(index.groups(), [])
+            index = CloneIndex(index_dir, min_size=10, normalize=True)
+            self.assertEqual(index.update(paths), 3)
+            ((size, records),) = index.groups()
+            self.assertEqual(size, 24)
+            self.assertEqual(
+                [(record[4], record[6]) for record in records], [(1, 4), (3, 6)]
+            )
+            with open(paths[2], "w") as f:
+                f.write(code)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(
+                io.StringIO()
+            ) as err:
+                status = ast_diff.cli(
+                    ["clones", "--index", index_dir, "--min-size", "10", "--normalize"]
+                    + paths
+                )
+        self.assertEqual(status, 1)
+        self.assertEqual(err.getvalue(), "hashed 1 of 3 files\n")
+        self.assertEqual(out.getvalue().splitlines()[0], "3 copies of 24 nodes")
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, code in [("a.py", "a = 1\n"), ("b.py", "a = 2\n")]:
+                with open(os.path.join(directory, name), "w") as f:
+                    f.write(code)
+            trace = os.path.join(directory, "trace.json")
+            with contextlib.redirect_stdout(io.StringIO()):
+                status = ast_diff.cli(
+                    [
+                        "--trace",
+                        trace,
+                        os.path.join(directory, "a.py"),
+                        os.path.join(directory, "b.py"),
+                    ]
+                )
+            with open(trace) as f:
+                trace = json.load(f)
+        self.assertEqual(status, 1)
+        (pair,) = trace["pairs"]
+        phases = ["read", "parse", "diff", "dump", "unified_diff"]
+        self.assertEqual(list(pair["phases"]), phases)
+        self.assertEqual(list(trace["totals"]), phases)
+        self.assertGreaterEqual(pair["phases"]["parse"]["peak"], 0)
+
+    def test_notebook(self):
+        from ast_diff import notebook
+
+        def cell(id, source):
+            return {"cell_type": "code", "id": id, "source": source}
+
+        cells1 = [
+            cell("a", ["import os\n", "%matplotlib inline\n"]),
+            {"cell_type": "markdown", "id": "m", "source": "# title"},
+            cell("b", "x = 1\nif x:\n    !ls\n"),
+            cell("c", "%%bash\nls\n"),
+            cell("d", "y = 2"),
+        ]
+        cells2 = [
+            cell("a", "import os\n%time f()\n"),
+            cell("b", "x = 2\nif x:\n    !ls\n"),
+            cell("c", "%%bash\nls -l\n"),
+            cell("e", "z = 3"),
+        ]
+        self.assertEqual(notebook.cell_source(cells1[2]), "x = 1\nif x:\n    pass\n")
+        for source in ['msg = ("x %s"\n       % v)\n', 's = """\n!important\n"""\n']:
+            self.assertEqual(notebook.cell_source(cell("f", source)), source)
+        with tempfile.TemporaryDirectory() as directory:
+            for name, cells in [("old", cells1), ("new", cells2)]:
+                os.makedirs(os.path.join(directory, name))
+                with open(os.path.join(directory, name, "n.ipynb"), "w") as f:
+                    json.dump({"cells": cells, "nbformat": 4}, f)
+            pair = tuple(
+                os.path.join(directory, name, "n.ipynb") for name in ["old", "new"]
+            )
+            for jobs in [None, 2]:
+                self.assertEqual(
+                    notebook.diff_notebooks([pair], jobs=jobs)[pair],
+                    [
+                        (
+                            "b",
+                            "result",
+                            ((1, 4), (1, 4), "ast.Constant.value differ 1 2"),
+                        ),
+                        ("d", "removed", None),
+                        ("e", "added", None),
+                    ],
+                )
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                status = ast_diff.cli(
+                    [
+                        "--format",
+                        "jsonl",
+                        os.path.join(directory, "old"),
+                        os.path.join(directory, "new"),
+                    ]
+                )
+        self.assertEqual(status, 1)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            [(r["type"], r.get("cell"), r.get("status")) for r in records],
+            [
+                ("difference", "b", None),
+                ("cell", "d", "removed"),
+                ("cell", "e", "added"),
+                ("pair", None, "different"),
+            ],
+        )
+
+    def test_index(self):
+        from ast_diff import index
+
+        old = "import os\nX = 1\n\n\nclass A:\n    def f(self):\n        return 1\n"
+        new = "import sys\n" + old.replace("return 1", "return 2")
+        with tempfile.TemporaryDirectory() as directory:
+            for name, code in [("old", old), ("new", new)]:
+                os.makedirs(os.path.join(directory, name))
+                with open(os.path.join(directory, name, "m.py"), "w") as f:
+                    f.write(code)
+            with open(os.path.join(directory, "new", "n.py"), "w") as f:
+                f.write("pass\n")
+            with open(os.path.join(directory, "new", "deep.py"), "w") as f:
+                f.write("-" * 100000 + "1\n")
+            conn = index.connect(os.path.join(directory, "index.db"))
+            index.index_snapshot(conn, "old", os.path.join(directory, "old"))
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                index.index_snapshot(conn, "new", os.path.join(directory, "new"))
+            self.assertIn("deep.py: skipped: ", err.getvalue())
+            statement = "<statement %s>" % index.fingerprint(ast.Pass()).hex()[:12]
+            self.assertEqual(
+                index.diff_snapshots(conn, "old", "new"),
+                [
+                    ("m.py", "<statement sys>", "added"),
+                    ("m.py", "A", "changed"),
+                    ("m.py", "A.f", "changed"),
+                    ("n.py", statement, "added"),
+                ],
+            )
+            self.assertEqual(
+                index.definition_diff(conn, "old", "new", "m.py", "A.f"),
+                ((7, 15), (8, 15), "ast.Constant.value differ 1 2"),
+            )
+            conn.close()
+
 
 if __name__ == "__main__":
     unittest.main()